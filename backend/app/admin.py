@@ -1,4 +1,4 @@
 from django.contrib import admin
-from .models import Project, Subject, Sample, Cell, Scientist
+from .models import Project, Subject, Sample, Cell, Scientist, ImportJob, ImportedFile, SampleSummary
 
-admin.site.register([Scientist, Project, Subject, Sample, Cell])
\ No newline at end of file
+admin.site.register([Scientist, Project, Subject, Sample, Cell, SampleSummary, ImportJob, ImportedFile])
\ No newline at end of file
@@ -0,0 +1,173 @@
+import math
+import numpy
+from .models import CELL_TYPES, SampleSummary
+
+
+def _average_ranks(values):
+    '''
+    The 1-based ranks of a 1-D array, ties getting the average of their ranks,
+    and the size of each group of tied values.
+    '''
+    order = numpy.argsort(values, kind='mergesort')
+    ordered = values[order]
+    starts = numpy.r_[True, ordered[1:] != ordered[:-1]]
+    group = numpy.cumsum(starts)
+    counts = numpy.bincount(group)
+    average = numpy.cumsum(counts) - (counts - 1) / 2
+    ranks = numpy.empty(len(values))
+    ranks[order] = average[group]
+    return ranks, counts[1:]
+
+
+def mann_whitney(x, y):
+    '''
+    Two-sided Mann-Whitney U test of samples x and y, with the normal
+    approximation corrected for ties and for continuity.
+    Returns (U of x, p), or (None, None) if either sample is empty.
+    '''
+    n1, n2 = len(x), len(y)
+    if not n1 or not n2:
+        return None, None
+    ranks, ties = _average_ranks(numpy.concatenate([x, y]))
+    u1 = ranks[:n1].sum() - n1 * (n1 + 1) / 2
+    u = max(u1, n1 * n2 - u1)
+
+    n = n1 + n2
+    tie_term = (ties ** 3 - ties).sum() / (n * (n - 1)) if n > 1 else 0.0
+    sigma = math.sqrt(n1 * n2 / 12 * ((n + 1) - tie_term))
+    if sigma == 0:
+        return float(u1), 1.0
+    z = (u - n1 * n2 / 2 - 0.5) / sigma
+    return float(u1), min(1.0, math.erfc(z / math.sqrt(2)))
+
+
+def welch_t(x, y):
+    '''
+    Two-sided Welch's t-test (unequal variances) of samples x and y.
+    Returns (t, degrees of freedom, p), or Nones if either sample has fewer
+    than two values or both have no variance.
+    '''
+    n1, n2 = len(x), len(y)
+    if n1 < 2 or n2 < 2:
+        return None, None, None
+    v1, v2 = x.var(ddof=1) / n1, y.var(ddof=1) / n2
+    if v1 + v2 == 0:
+        return None, None, None
+    t = (x.mean() - y.mean()) / math.sqrt(v1 + v2)
+    df = (v1 + v2) ** 2 / (v1 ** 2 / (n1 - 1) + v2 ** 2 / (n2 - 1))
+    p = _regularized_beta(df / (df + t * t), df / 2, 0.5)
+    return float(t), float(df), min(1.0, p)
+
+
+def _regularized_beta(x, a, b):
+    '''
+    The regularized incomplete beta function I_x(a, b), evaluated with its
+    continued fraction (modified Lentz's method).
+    '''
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    if x > (a + 1) / (a + b + 2):
+        return 1.0 - _regularized_beta(1 - x, b, a)
+
+    front = math.exp(
+        math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b)
+        + a * math.log(x) + b * math.log(1 - x)
+    ) / a
+    tiny = 1e-300
+    f, c, d = 1.0, 1.0, 0.0
+    for i in range(400):
+        m = i // 2
+        if i == 0:
+            numerator = 1.0
+        elif i % 2 == 0:
+            numerator = m * (b - m) * x / ((a + 2 * m - 1) * (a + 2 * m))
+        else:
+            numerator = -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 2 * m + 1))
+        d = 1.0 + numerator * d
+        d = 1.0 / (d if abs(d) > tiny else tiny)
+        c = 1.0 + numerator / c
+        c = c if abs(c) > tiny else tiny
+        f *= c * d
+        if abs(1.0 - c * d) < 1e-14:
+            break
+    return front * (f - 1.0)
+
+
+def benjamini_hochberg(p_values):
+    '''
+    Benjamini-Hochberg adjusted p-values (q-values), controlling the false
+    discovery rate over the given tests. None p-values are left out of the
+    correction and stay None.
+    '''
+    tested = [i for i, p in enumerate(p_values) if p is not None]
+    adjusted = [None] * len(p_values)
+    if not tested:
+        return adjusted
+    p = numpy.array([p_values[i] for i in tested])
+    order = numpy.argsort(p)
+    scaled = p[order] * len(p) / numpy.arange(1, len(p) + 1)
+    q = numpy.minimum.accumulate(scaled[::-1])[::-1].clip(max=1.0)
+    for i, value in zip(numpy.array(tested)[order], q):
+        adjusted[i] = float(value)
+    return adjusted
+
+
+def _describe(values):
+    if not len(values):
+        return {'n': 0, 'mean': None, 'median': None}
+    return {
+        'n': len(values),
+        'mean': float(values.mean()),
+        'median': float(numpy.median(values)),
+    }
+
+
+def compare_responders(samples):
+    '''
+    Compare the relative frequency of every population between the samples
+    of responders and non-responders in a Sample queryset, with a
+    Mann-Whitney U test and Welch's t-test per population, each corrected
+    for multiple testing over the populations with Benjamini-Hochberg.
+
+    Only the response and frequencies are read (from SampleSummary), as one
+    array with a column per population. Samples of subjects with an unknown
+    response, and frequencies of samples without cells, are left out.
+    '''
+    rows = SampleSummary.objects.filter(
+        sample__in=samples, sample__subject__response__isnull=False
+    ).values_list(
+        'sample__subject__response',
+        *[f'{cell_type}_frequency' for cell_type in CELL_TYPES],
+    )
+    data = numpy.array(list(rows), dtype=float).reshape(-1, len(CELL_TYPES) + 1)
+    responders = data[data[:, 0] == 1, 1:]
+    non_responders = data[data[:, 0] == 0, 1:]
+
+    populations = []
+    for i, cell_type in enumerate(CELL_TYPES):
+        x = responders[:, i][numpy.isfinite(responders[:, i])]
+        y = non_responders[:, i][numpy.isfinite(non_responders[:, i])]
+        u, u_p = mann_whitney(x, y)
+        t, df, t_p = welch_t(x, y)
+        populations.append(
+            {
+                'population': cell_type,
+                'responders': _describe(x),
+                'non_responders': _describe(y),
+                'mann_whitney': {'u': u, 'p': u_p},
+                'welch_t': {'t': t, 'df': df, 'p': t_p},
+            }
+        )
+
+    for test in ['mann_whitney', 'welch_t']:
+        q_values = benjamini_hochberg([population[test]['p'] for population in populations])
+        for population, q in zip(populations, q_values):
+            population[test]['q'] = q
+
+    return {
+        'samples': {'responders': len(responders), 'non_responders': len(non_responders)},
+        'correction': 'benjamini-hochberg',
+        'populations': populations,
+    }
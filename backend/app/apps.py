@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.core.signals import request_started
+
+
+class MainConfig(AppConfig):
+    name = 'app'
+
+    def ready(self):
+        from .jobs import RECOVERY_UID, recover_on_first_request
+
+        # Server processes recover the import jobs lost by a restart when they
+        # handle their first request (management commands never do).
+        request_started.connect(recover_on_first_request, dispatch_uid=RECOVERY_UID)
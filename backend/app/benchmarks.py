@@ -0,0 +1,276 @@
+import os
+import resource
+import time
+from contextlib import contextmanager
+import numpy
+import pandas
+from django.core.cache import cache
+from django.db import connection
+from .importer import COL_SPEC
+from .models import CELL_TYPES
+
+CONDITIONS = ['melanoma', 'carcinoma', 'healthy']
+TREATMENTS = ['tr1', 'tr2']
+SAMPLE_TYPES = ['PBMC', 'tumor']
+
+# Days from treatment start of the successive samples of a subject.
+VISIT_INTERVAL = 7
+
+
+def generate_cell_counts(
+    file, rows, projects=3, samples_per_subject=3, error_rate=0.0, seed=0, chunk_rows=100000
+):
+    '''
+    Write a synthetic COL_SPEC CSV file of the given number of rows to an open
+    text file, chunk_rows rows at a time, so millions of rows need little memory.
+
+    Subjects are spread round robin over the projects and keep the same
+    condition, age, sex, treatment and response across their samples, which
+    are taken every VISIT_INTERVAL days from treatment start (no time and no
+    response for healthy subjects). With error_rate, that fraction of the rows
+    gets a negative cell count, which the importer rejects.
+    '''
+    rng = numpy.random.default_rng(seed)
+    # Whole subjects per chunk, so their attributes are drawn only once.
+    chunk_rows = max(samples_per_subject, chunk_rows - chunk_rows % samples_per_subject)
+    file.write(','.join(COL_SPEC) + '\n')
+
+    for start in range(0, rows, chunk_rows):
+        sample = numpy.arange(start, min(start + chunk_rows, rows))
+        subject = sample // samples_per_subject
+        first = subject[0]
+        subjects = subject[-1] - first + 1
+        index = subject - first
+
+        condition = rng.choice(CONDITIONS, subjects)[index]
+        healthy = condition == 'healthy'
+        response = numpy.where(rng.random(subjects) < 0.5, 'yes', 'no')[index]
+        visit = sample % samples_per_subject
+        counts = rng.integers(1000, 100000, (len(sample), len(CELL_TYPES)))
+        if error_rate:
+            counts[rng.random(len(sample)) < error_rate, 0] = -1
+
+        frame = pandas.DataFrame(
+            {
+                'project': 'prj' + pandas.Series(subject % projects + 1).astype(str),
+                'subject': 'sbj' + pandas.Series(subject).astype(str),
+                'condition': condition,
+                'age': rng.integers(20, 90, subjects)[index],
+                'sex': rng.choice(['M', 'F'], subjects)[index],
+                'treatment': numpy.where(
+                    healthy, 'none', rng.choice(TREATMENTS, subjects)[index]
+                ),
+                'response': numpy.where(healthy, '', response),
+                'sample': 's' + pandas.Series(sample).astype(str),
+                'sample_type': rng.choice(SAMPLE_TYPES, len(sample)),
+                'time_from_treatment_start': pandas.Series(
+                    visit * VISIT_INTERVAL, dtype='Int64'
+                ).mask(healthy),
+                **{
+                    cell_type: counts[:, i]
+                    for i, cell_type in enumerate(CELL_TYPES)
+                },
+            }
+        )
+        frame.to_csv(file, header=False, index=False)
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident set size of this process where the kernel allows
+    it (Linux), so peak_rss_mb measures a single scenario.
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as file:
+            file.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    '''
+    The peak resident set size of this process in MB, since the last
+    reset_peak_rss on Linux, else since the process started.
+    '''
+    try:
+        with open('/proc/self/status') as file:
+            for line in file:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, in KB elsewhere.
+    return peak / (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024)
+
+
+class _QueryCounter:
+    '''
+    Number of queries run on the default connection within _count_queries.
+    '''
+
+    def __init__(self):
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __call__(self, execute, sql, params, many, context):
+        self.count += 1
+        return execute(sql, params, many, context)
+
+
+@contextmanager
+def _count_queries():
+    '''
+    Count the queries of the default connection with an execute wrapper.
+    Unlike the query log, which stops at 9000 queries and keeps their SQL
+    (inflating the peak memory of large imports), nothing is kept.
+    '''
+    counter = _QueryCounter()
+    with connection.execute_wrapper(counter):
+        yield counter
+
+
+def _consume(response):
+    '''
+    Read the whole body of a response, streamed or not, returning its size.
+    '''
+    if response.streaming:
+        return sum(len(chunk) for chunk in response.streaming_content)
+    return len(response.content)
+
+
+def _percentiles(timings):
+    timings = numpy.array(timings) * 1000
+    return {
+        'p50_ms': float(numpy.percentile(timings, 50)),
+        'p95_ms': float(numpy.percentile(timings, 95)),
+        'p99_ms': float(numpy.percentile(timings, 99)),
+        'mean_ms': float(timings.mean()),
+        'max_ms': float(timings.max()),
+    }
+
+
+def run_import(client, path):
+    '''
+    Import the CSV file at path through POST /api/import (synchronously, in
+    append mode) and measure its throughput, query count and peak memory.
+    '''
+    with open(path, 'rb') as file:
+        rows = sum(1 for _ in file) - 1
+        file.seek(0)
+        reset_peak_rss()
+        with _count_queries() as queries:
+            start = time.perf_counter()
+            response = client.post('/api/import', {'file': file, 'mode': 'append'})
+            elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError(f'Import failed: {response.content[:500]!r}')
+    return {
+        'rows': rows,
+        'seconds': elapsed,
+        'rows_per_second': rows / elapsed,
+        'queries': len(queries),
+        'peak_rss_mb': peak_rss_mb(),
+        'project_ids': response.json()['project_ids'],
+    }
+
+
+def run_endpoint(client, url, params, requests):
+    '''
+    Request an endpoint requests times with the cache cleared before every
+    request (cold) and then with the cache warm, reading the whole response.
+    Returns the latency percentiles and the query count of each, the size of
+    the response and the peak memory.
+    '''
+    result = {}
+    reset_peak_rss()
+    for name, clear in [('cold', True), ('warm', False)]:
+        # One request with the queries captured, which slows the others down.
+        cache.clear()
+        with _count_queries() as queries:
+            response = client.get(url, params)
+            size = _consume(response)
+        if response.status_code != 200:
+            raise RuntimeError(f'GET {url} failed: {response.status_code}')
+
+        timings = []
+        for _ in range(requests):
+            if clear:
+                cache.clear()
+            start = time.perf_counter()
+            _consume(client.get(url, params))
+            timings.append(time.perf_counter() - start)
+        result[name] = {**_percentiles(timings), 'queries': len(queries)}
+    result['bytes'] = size
+    result['peak_rss_mb'] = peak_rss_mb()
+    return result
+
+
+def endpoint_scenarios(project_id):
+    '''
+    The (name, url, query parameters) of the endpoints to benchmark.
+    '''
+    baseline = {'condition': 'melanoma', 'sample_type': 'PBMC', 'time_from_treatment_start': 0}
+    return [
+        ('results', '/api/results', {}),
+        ('project', f'/api/results/{project_id}/', {}),
+        ('project_page', f'/api/results/{project_id}/', {'page_size': 1000}),
+        ('query_all', '/api/results/filter', {}),
+        ('query_baseline', '/api/results/filter', baseline),
+        ('query_age', '/api/results/filter', {'sex': 'F', 'age': 60, 'age_operator': 'gt'}),
+        ('query_stats_only', '/api/results/filter', {**baseline, 'stats_only': 'true'}),
+        ('cohorts', '/api/cohorts', {**baseline, 'group_by': 'project,response,sex'}),
+        ('analysis', f'/api/results/{project_id}/analysis', {'sample_type': 'PBMC'}),
+        ('charts', f'/api/results/{project_id}/charts', {'sample_type': 'PBMC'}),
+        ('export_csv', '/api/results/export', {**baseline, 'format': 'csv'}),
+    ]
+
+
+# Metrics compared against a baseline run, and whether higher is better.
+COMPARED_METRICS = {
+    'rows_per_second': True,
+    'p50_ms': False,
+    'p95_ms': False,
+    'queries': False,
+}
+
+
+# Latency changes smaller than this are noise, however large relatively.
+MIN_LATENCY_CHANGE_MS = 1.0
+
+
+def compare_results(current, baseline, threshold):
+    '''
+    Compare a benchmark run with a baseline run of the same scenarios.
+    Returns a list of (scenario, metric, baseline value, current value)
+    for every metric that got worse by more than threshold (e.g. 0.2 for 20%).
+    Query counts are compared exactly, latencies must also have grown by
+    at least MIN_LATENCY_CHANGE_MS.
+    '''
+    pairs = [('import', current.get('import', {}), baseline.get('import', {}))]
+    for name, result in current.get('endpoints', {}).items():
+        for phase in ['cold', 'warm']:
+            pairs.append(
+                (
+                    f'{name} ({phase})',
+                    result.get(phase, {}),
+                    baseline.get('endpoints', {}).get(name, {}).get(phase, {}),
+                )
+            )
+
+    regressions = []
+    for scenario, metrics, base in pairs:
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in metrics or metric not in base or not base[metric]:
+                continue
+            change = (metrics[metric] - base[metric]) / base[metric]
+            if higher_is_better:
+                change = -change
+            allowed = 0 if metric == 'queries' else threshold
+            if metric.endswith('_ms') and metrics[metric] - base[metric] < MIN_LATENCY_CHANGE_MS:
+                continue
+            if change > allowed:
+                regressions.append((scenario, metric, base[metric], metrics[metric]))
+    return regressions
@@ -0,0 +1,244 @@
+import hashlib
+from functools import wraps
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, parse_etags, quote_etag
+from .encoding import compress, content_encodings, dumps
+from .models import Project
+
+
+def bump_data_versions(project_ids):
+    '''
+    Mark the data of the given projects as changed, so responses cached
+    for their previous version are no longer served.
+    Runs inside whatever transaction the caller has open, so the new version
+    only becomes visible together with the data it describes.
+    '''
+    Project.objects.filter(id__in=project_ids).update(
+        data_version=F('data_version') + 1, updated_at=timezone.now()
+    )
+
+
+def digest(text):
+    '''
+    A short, stable digest of text for use in cache keys and ETags.
+    '''
+    return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+
+def _body_keys(key, encoding):
+    return [f'{key}:{encoding}', key] if encoding else [key]
+
+
+def _cached_variant(bodies, key, encoding):
+    '''
+    The (body, encoding) to serve for key from the bodies read from the cache,
+    or None if the variant for encoding is not cached.
+    '''
+    if encoding and f'{key}:{encoding}' in bodies:
+        return bodies[f'{key}:{encoding}'], encoding
+    body = bodies.get(key)
+    if body is not None and (
+        encoding is None or len(body) < settings.RESPONSE_COMPRESSION_MIN_BYTES
+    ):
+        return body, None
+    return None
+
+
+def _cache_body(key, body):
+    '''
+    Cache a body unless it is larger than CACHE_MAX_BODY_BYTES, which bounds
+    the bytes held by the cache to its number of entries times that size.
+    '''
+    if len(body) <= settings.CACHE_MAX_BODY_BYTES:
+        cache.set(key, body)
+
+
+def _store_body(key, build, encoding, body=None):
+    '''
+    Encode the dict returned by build(), unless the uncompressed body is
+    given, and cache and return the variant to serve for encoding.
+    '''
+    if body is None:
+        body = dumps(build())
+        if encoding is None or len(body) < settings.RESPONSE_COMPRESSION_MIN_BYTES:
+            _cache_body(key, body)
+    if encoding is None or len(body) < settings.RESPONSE_COMPRESSION_MIN_BYTES:
+        return body, None
+    body = compress(body, encoding)
+    _cache_body(f'{key}:{encoding}', body)
+    return body, encoding
+
+
+def cached_body(key, build, encoding=None):
+    '''
+    Return the JSON encoded body cached under key, or encode the dict
+    returned by build() and cache it on a miss, as (body, encoding used).
+    Bodies are cached already encoded so a hit costs no serialization at all.
+
+    With encoding (see encoding.accepted_encoding), bodies of at least
+    RESPONSE_COMPRESSION_MIN_BYTES are compressed and encoding returned, else
+    encoding is None. Only the variant served is cached: a compressed body
+    under its own key, so it is compressed once, and a small body uncompressed.
+    Bodies larger than CACHE_MAX_BODY_BYTES are built again on every request.
+    '''
+    bodies = cache.get_many(_body_keys(key, encoding))
+    return _cached_variant(bodies, key, encoding) or _store_body(
+        key, build, encoding, bodies.get(key)
+    )
+
+
+async def acached_body(key, build, encoding=None):
+    '''
+    The async counterpart of cached_body: the cache is read with its async
+    API, and on a miss build(), which uses the sync ORM, runs in a thread.
+    '''
+    bodies = await cache.aget_many(_body_keys(key, encoding))
+    return _cached_variant(bodies, key, encoding) or await sync_to_async(_store_body)(
+        key, build, encoding, bodies.get(key)
+    )
+
+
+def _projects_state(rows):
+    versions = [(project_id, version) for project_id, version, _ in rows]
+    last_modified = max((updated_at for *_, updated_at in rows), default=None)
+    return (digest(repr(versions)), last_modified) if rows else None
+
+
+def _state_rows(projects):
+    return projects.order_by('id').values_list('id', 'data_version', 'updated_at')
+
+
+def projects_state(request, projects):
+    '''
+    The (cache key part, last modified) of a Project queryset: a digest of
+    the ids and data versions of its projects, and the latest updated_at.
+    Memoized on the request, since the ETag and Last-Modified checks and
+    the view itself all need it.
+    '''
+    if not hasattr(request, '_projects_state'):
+        request._projects_state = _projects_state(list(_state_rows(projects)))
+    return request._projects_state
+
+
+async def aprojects_state(request, projects):
+    '''
+    The async counterpart of projects_state, reading with the async ORM.
+    '''
+    if not hasattr(request, '_projects_state'):
+        request._projects_state = _projects_state(
+            [row async for row in _state_rows(projects)]
+        )
+    return request._projects_state
+
+
+def _validators(state):
+    '''
+    The quoted ETag and Last-Modified timestamp of a projects state, or Nones.
+    '''
+    if not state:
+        return None, None
+    return quote_etag(state[0]), int(state[1].timestamp())
+
+
+def _encoded_etag(etag, encoding):
+    '''
+    The ETag of a body in a content encoding: the bytes of a compressed body
+    differ from the uncompressed ones, so its ETag is suffixed with the
+    encoding, e.g. "<digest>-gzip".
+    '''
+    return f'{etag[:-1]}-{encoding}"' if etag and encoding else etag
+
+
+def _held_etag(request, etag):
+    '''
+    The variant of etag (uncompressed or in any content encoding) the client
+    holds per its If-None-Match header, or etag itself if it holds none.
+    '''
+    if not etag:
+        return etag
+    held = {
+        tag.removeprefix('W/')
+        for tag in parse_etags(request.headers.get('If-None-Match', ''))
+    }
+    variants = [_encoded_etag(etag, encoding) for encoding in content_encodings()]
+    for variant in [etag, *variants]:
+        if variant in held:
+            return variant
+    return etag
+
+
+def _stamp(request, response, etag, last_modified):
+    '''
+    Set the ETag and Last-Modified of a successful GET or HEAD response, its
+    ETag suffixed with its Content-Encoding (see _encoded_etag), and of a 304,
+    which gets the ETag of the variant the client holds.
+    Error responses describe no version of the projects, so they are left
+    as they are and never revalidated to a 304.
+    '''
+    if request.method not in ('GET', 'HEAD'):
+        return response
+    if response.status_code == 304:
+        etag = _held_etag(request, etag)
+        patch_vary_headers(response, ['Accept-Encoding'])
+    elif 200 <= response.status_code < 300:
+        etag = _encoded_etag(etag, response.get('Content-Encoding'))
+    else:
+        return response
+    if last_modified and not response.has_header('Last-Modified'):
+        response.headers['Last-Modified'] = http_date(last_modified)
+    if etag:
+        response.headers.setdefault('ETag', etag)
+    return response
+
+
+def project_condition(projects):
+    '''
+    View decorator answering conditional requests with a 304 when the
+    projects of the queryset returned by projects(request, *args, **kwargs)
+    have not been added, removed or re-imported into since the client's
+    ETag or Last-Modified, which are set on the successful responses. A
+    client holding the body in any content encoding is answered with a 304.
+    Like django.views.decorators.http.condition, without stamping errors.
+    '''
+    def decorator(view):
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            state = projects_state(request, projects(request, *args, **kwargs))
+            etag, last_modified = _validators(state)
+            response = get_conditional_response(
+                request, etag=_held_etag(request, etag), last_modified=last_modified
+            )
+            if response is None:
+                response = view(request, *args, **kwargs)
+            return _stamp(request, response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
+
+
+def aproject_condition(projects):
+    '''
+    The async counterpart of project_condition for async views, querying
+    the database with the async ORM.
+    '''
+    def decorator(view):
+        @wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            state = await aprojects_state(request, projects(request, *args, **kwargs))
+            etag, last_modified = _validators(state)
+            response = get_conditional_response(
+                request, etag=_held_etag(request, etag), last_modified=last_modified
+            )
+            if response is None:
+                response = await view(request, *args, **kwargs)
+            return _stamp(request, response, etag, last_modified)
+
+        return wrapper
+
+    return decorator
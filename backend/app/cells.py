@@ -0,0 +1,221 @@
+from itertools import islice
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, FloatField
+from django.db.models.functions import Cast
+from .models import CELL_TYPES, Cell, SampleSummary
+
+# Fields of the per-cell rows returned by cell_rows, in order.
+CELL_ROW_FIELDS = [
+    'id',
+    'response',
+    'subject_id',
+    'sample_id',
+    'sample_name',
+    'sample_type',
+    'time_from_treatment_start',
+    'total_count',
+    'population',
+    'count',
+    'relative_frequency',
+]
+
+
+def wide_storage():
+    '''
+    True when cell counts are only stored as one SampleSummary row per sample
+    (CELL_STORAGE='wide') instead of one Cell row per sample and population.
+    '''
+    return settings.CELL_STORAGE == 'wide'
+
+
+def wide_cell_id(sample_id, cell_type):
+    '''
+    The id reported for a population of a sample in wide storage, which has no
+    Cell rows: unique per sample and population, and stable across requests.
+    '''
+    return sample_id * len(CELL_TYPES) + CELL_TYPES.index(cell_type)
+
+
+def cell_rows(samples, after=None, limit=None):
+    '''
+    Iterate one tuple of CELL_ROW_FIELDS per sample and population for the
+    given Sample queryset, ordered by id, whichever storage layout is in use.
+    For keyset pagination, after skips the rows up to and including that id
+    and limit caps the number of rows.
+    '''
+    if wide_storage():
+        rows = _wide_cell_rows(samples, after, limit)
+        return rows if limit is None else islice(rows, limit)
+
+    cells = Cell.objects.filter(sample__in=samples)
+    if after is not None:
+        cells = cells.filter(id__gt=after)
+    cells = (
+        cells.annotate(
+            total_count=F('sample__summary__total_count'),
+            relative_frequency=Cast('count', FloatField())
+            / F('sample__summary__total_count'),
+        )
+        .order_by('id')
+        .values_list(
+            'id',
+            'sample__subject__response',
+            'sample__subject_id',
+            'sample_id',
+            'sample__sample_name',
+            'sample__sample_type',
+            'sample__time_from_treatment_start',
+            'total_count',
+            'type',
+            'count',
+            'relative_frequency',
+        )
+    )
+    return cells if limit is None else cells[:limit]
+
+
+# Fields of the flat rows returned by export_rows, in order.
+EXPORT_FIELDS = [
+    'project_name',
+    'subject_name',
+    'condition',
+    'age',
+    'sex',
+    'treatment',
+    'response',
+    'sample_id',
+    'sample_name',
+    'sample_type',
+    'time_from_treatment_start',
+    'total_count',
+    'population',
+    'count',
+    'relative_frequency',
+]
+
+# Lookups of the EXPORT_FIELDS before total_count, valid from both a Cell
+# and a SampleSummary since both have a sample foreign key.
+_EXPORT_SAMPLE_LOOKUPS = [
+    'sample__subject__project__project_name',
+    'sample__subject__subject_name',
+    'sample__subject__condition',
+    'sample__subject__age',
+    'sample__subject__sex',
+    'sample__subject__treatment',
+    'sample__subject__response',
+    'sample_id',
+    'sample__sample_name',
+    'sample__sample_type',
+    'sample__time_from_treatment_start',
+]
+
+
+def export_rows(samples, chunk_size=2000):
+    '''
+    Iterate one tuple of EXPORT_FIELDS per sample and population for the given
+    Sample queryset, in the order of cell_rows.
+    Rows are read with iterator(), a server-side cursor on Postgres, so only
+    chunk_size rows are held in memory however many are exported. The cursor
+    is read inside a transaction: PgBouncer in transaction pooling mode only
+    keeps a client on the same Postgres connection for a transaction.
+    '''
+    with transaction.atomic():
+        yield from _export_rows(samples, chunk_size)
+
+
+def _export_rows(samples, chunk_size):
+    if wide_storage():
+        summaries = (
+            SampleSummary.objects.filter(sample__in=samples)
+            .order_by('sample_id')
+            .values_list(
+                *_EXPORT_SAMPLE_LOOKUPS,
+                'total_count',
+                *CELL_TYPES,
+                *[f'{cell_type}_frequency' for cell_type in CELL_TYPES],
+            )
+        )
+        sample_fields = len(_EXPORT_SAMPLE_LOOKUPS) + 1
+        types = len(CELL_TYPES)
+        for row in summaries.iterator(chunk_size=chunk_size):
+            sample, values = row[:sample_fields], row[sample_fields:]
+            for i, cell_type in enumerate(CELL_TYPES):
+                yield (*sample, cell_type, values[i], values[types + i])
+        return
+
+    yield from (
+        Cell.objects.filter(sample__in=samples)
+        .annotate(
+            total_count=F('sample__summary__total_count'),
+            relative_frequency=Cast('count', FloatField())
+            / F('sample__summary__total_count'),
+        )
+        .order_by('id')
+        .values_list(
+            *_EXPORT_SAMPLE_LOOKUPS,
+            'total_count',
+            'type',
+            'count',
+            'relative_frequency',
+        )
+        .iterator(chunk_size=chunk_size)
+    )
+
+
+def count_cell_rows(samples):
+    '''
+    The number of rows cell_rows returns for the given Sample queryset,
+    counted in the database.
+    '''
+    if wide_storage():
+        return SampleSummary.objects.filter(sample__in=samples).count() * len(CELL_TYPES)
+    return Cell.objects.filter(sample__in=samples).count()
+
+
+def _wide_cell_rows(samples, after=None, limit=None):
+    '''
+    Expand each SampleSummary row into one row per population.
+    Row ids grow with the sample id (see wide_cell_id), so the rows after
+    a given id start at the sample that id belongs to, and limit rows
+    need at most one summary more than limit / len(CELL_TYPES).
+    '''
+    summaries = SampleSummary.objects.filter(sample__in=samples)
+    if after is not None:
+        summaries = summaries.filter(sample_id__gte=after // len(CELL_TYPES))
+    summaries = (
+        summaries.order_by('sample_id')
+        .values_list(
+            'sample_id',
+            'sample__subject__response',
+            'sample__subject_id',
+            'sample__sample_name',
+            'sample__sample_type',
+            'sample__time_from_treatment_start',
+            'total_count',
+            *CELL_TYPES,
+            *[f'{cell_type}_frequency' for cell_type in CELL_TYPES],
+        )
+    )
+    types = len(CELL_TYPES)
+    if limit is not None:
+        summaries = summaries[: -(-limit // types) + 1]
+    for sample_id, response, subject_id, name, sample_type, time, total, *values in summaries:
+        counts, frequencies = values[:types], values[types:]
+        for i, cell_type in enumerate(CELL_TYPES):
+            cell_id = wide_cell_id(sample_id, cell_type)
+            if after is not None and cell_id <= after:
+                continue
+            yield (
+                cell_id,
+                response,
+                subject_id,
+                sample_id,
+                name,
+                sample_type,
+                time,
+                total,
+                cell_type,
+                counts[i],
+                frequencies[i],
+            )
@@ -0,0 +1,159 @@
+import math
+import numpy
+from .models import CELL_TYPES, SampleSummary
+
+# Response groups of the charts, and the SampleSummary.response value of each
+# (read as a float: 1, 0, or NaN for subjects without a response).
+RESPONSE_GROUPS = {'responders': 1.0, 'non_responders': 0.0, 'unknown': math.nan}
+
+# Whiskers of the box plots reach the furthest values within this many
+# interquartile ranges from the quartiles (Tukey); values beyond are outliers.
+WHISKER_IQR = 1.5
+
+
+def _floats(values):
+    '''
+    A list of the floats of an array, NaN (e.g. the mean of an empty bin) as None.
+    '''
+    return [None if math.isnan(value) else value for value in values.tolist()]
+
+
+def _group_masks(responses):
+    '''
+    A boolean mask of the rows of each response group.
+    '''
+    return {
+        group: numpy.isnan(responses) if math.isnan(value) else responses == value
+        for group, value in RESPONSE_GROUPS.items()
+    }
+
+
+def box_stats(values, max_outliers):
+    '''
+    The box plot of a 1-D array: its quartiles (linear interpolation, as
+    plotly's default), its whiskers (lower_fence, upper_fence) and at most
+    max_outliers of its outliers, the furthest from the median, in order.
+    outliers_total is the number of outliers before capping.
+    '''
+    if not len(values):
+        return {'n': 0}
+    q1, median, q3 = numpy.percentile(values, [25, 50, 75])
+    reach = WHISKER_IQR * (q3 - q1)
+    inside = (values >= q1 - reach) & (values <= q3 + reach)
+    outliers = values[~inside]
+    if len(outliers) > max_outliers:
+        furthest = numpy.argsort(-numpy.abs(outliers - median), kind='stable')
+        outliers = outliers[furthest[:max_outliers]]
+    return {
+        'n': len(values),
+        'mean': float(values.mean()),
+        'min': float(values.min()),
+        'q1': float(q1),
+        'median': float(median),
+        'q3': float(q3),
+        'max': float(values.max()),
+        'lower_fence': float(values[inside].min()),
+        'upper_fence': float(values[inside].max()),
+        'outliers': numpy.sort(outliers).tolist(),
+        'outliers_total': int((~inside).sum()),
+    }
+
+
+def time_bins(times, bins):
+    '''
+    Bin the time_from_treatment_start of the samples (NaN when unknown).
+    With at most bins distinct times each time gets its own bin, else the
+    time range is cut into bins bins of equal width.
+    Returns the [start, end] of each bin and the bin of each sample (-1 for
+    unknown times).
+    '''
+    known = ~numpy.isnan(times)
+    index = numpy.full(len(times), -1)
+    distinct = numpy.unique(times[known])
+    if len(distinct) <= bins:
+        index[known] = numpy.searchsorted(distinct, times[known])
+        return [[time, time] for time in distinct.tolist()], index
+    edges = numpy.linspace(distinct[0], distinct[-1], bins + 1)
+    index[known] = numpy.searchsorted(edges, times[known], side='right') - 1
+    # The last bin includes its end.
+    index[known] = index[known].clip(max=bins - 1)
+    return numpy.column_stack([edges[:-1], edges[1:]]).tolist(), index
+
+
+def binned_stats(values, index, bins):
+    '''
+    The number, mean and quartiles of values per bin, index giving the bin of
+    each value. Values are sorted by bin once, then each bin is a slice.
+    '''
+    n = numpy.bincount(index, minlength=bins)
+    sums = numpy.bincount(index, weights=values, minlength=bins)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / n
+
+    order = numpy.lexsort((values, index))
+    ordered = values[order]
+    bounds = numpy.searchsorted(index[order], numpy.arange(bins + 1))
+    quartiles = numpy.full((bins, 3), numpy.nan)
+    for i in numpy.flatnonzero(n):
+        quartiles[i] = numpy.percentile(ordered[bounds[i]:bounds[i + 1]], [25, 50, 75])
+    return {
+        'n': n.tolist(),
+        'mean': _floats(mean),
+        'q1': _floats(quartiles[:, 0]),
+        'median': _floats(quartiles[:, 1]),
+        'q3': _floats(quartiles[:, 2]),
+    }
+
+
+def chart_data(samples, bins, max_outliers):
+    '''
+    The data of the charts of the relative frequency of every population,
+    per response group (responders, non-responders and subjects with an
+    unknown response), for the samples of a Sample queryset:
+    - a histogram of bins bins over the range of the population,
+    - a box plot (see box_stats),
+    - a time series of its quartiles and mean by time_from_treatment_start
+    (see time_bins).
+
+    Only the response, time and frequencies are read (from SampleSummary), as
+    one array with a column per field, so the size of the result depends only
+    on bins and max_outliers, not on the number of samples. Frequencies of
+    samples without cells are left out.
+    '''
+    rows = SampleSummary.objects.filter(sample__in=samples).values_list(
+        'response',
+        'time_from_treatment_start',
+        *[f'{cell_type}_frequency' for cell_type in CELL_TYPES],
+    )
+    data = numpy.array(list(rows), dtype=float).reshape(-1, len(CELL_TYPES) + 2)
+    groups = _group_masks(data[:, 0])
+    times, time_index = time_bins(data[:, 1], bins)
+
+    populations = []
+    for i, cell_type in enumerate(CELL_TYPES):
+        values = data[:, i + 2]
+        known = ~numpy.isnan(values)
+        edges = numpy.histogram_bin_edges(values[known], bins)
+        histogram = {'edges': edges.tolist()}
+        box = {}
+        time_series = {}
+        for group, mask in groups.items():
+            group_values = values[mask & known]
+            histogram[group] = numpy.histogram(group_values, edges)[0].tolist()
+            box[group] = box_stats(group_values, max_outliers)
+            timed = mask & known & (time_index >= 0)
+            time_series[group] = binned_stats(values[timed], time_index[timed], len(times))
+        populations.append(
+            {
+                'population': cell_type,
+                'histogram': histogram,
+                'box': box,
+                'time_series': time_series,
+            }
+        )
+
+    return {
+        'samples': {group: int(mask.sum()) for group, mask in groups.items()},
+        'time_bins': times,
+        'populations': populations,
+    }
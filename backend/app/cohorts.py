@@ -0,0 +1,75 @@
+from django.db.models import Avg, Count
+from .models import CELL_TYPES, Project, SampleSummary
+
+# SampleSummary cohort columns cohorts can be grouped by.
+COHORT_GROUP_FIELDS = [
+    'project',
+    'condition',
+    'treatment',
+    'sex',
+    'age',
+    'response',
+    'sample_type',
+    'time_from_treatment_start',
+]
+
+
+def cohort_summaries(projects, subject_params, sample_params):
+    '''
+    The SampleSummary rows of the samples matching a query, filtered on their
+    own cohort columns: projects is the filtered Project queryset,
+    subject_params and sample_params the lookups of QueryData, which have the
+    same names on SampleSummary.
+    '''
+    return SampleSummary.objects.filter(
+        project__in=projects.values('id'), **subject_params, **sample_params
+    )
+
+
+def cohort_groups(summaries, group_by):
+    '''
+    Count the samples and distinct subjects, and average the relative
+    frequency of each population, per combination of the group_by columns,
+    in a single grouped query over the cohort columns of SampleSummary.
+    Returns a list of dicts ordered by the group_by columns, or holding a
+    single group of all samples without group_by.
+    '''
+    columns = ['project_id' if name == 'project' else name for name in group_by]
+    aggregates = {
+        'samples': Count('pk'),
+        'subjects': Count('subject', distinct=True),
+        **{
+            f'{cell_type}_mean': Avg(f'{cell_type}_frequency')
+            for cell_type in CELL_TYPES
+        },
+    }
+    if columns:
+        rows = list(
+            summaries.order_by()
+            .values(*columns)
+            .annotate(**aggregates)
+            .order_by(*columns)
+        )
+    else:
+        # A single group of all matching samples.
+        rows = [summaries.aggregate(**aggregates)]
+
+    project_names = {}
+    if 'project' in group_by:
+        project_names = dict(
+            Project.objects.filter(id__in={row['project_id'] for row in rows})
+            .values_list('id', 'project_name')
+        )
+
+    groups = []
+    for row in rows:
+        group = {column: row[column] for column in columns}
+        if 'project' in group_by:
+            group['project_name'] = project_names.get(row['project_id'])
+        group['samples'] = row['samples']
+        group['subjects'] = row['subjects']
+        group['mean_frequency'] = {
+            cell_type: row[f'{cell_type}_mean'] for cell_type in CELL_TYPES
+        }
+        groups.append(group)
+    return groups
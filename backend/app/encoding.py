@@ -0,0 +1,91 @@
+import gzip
+import json
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Optional faster JSON encoder and compressor, used when installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Compression levels favour speed, as a body is compressed on a cache miss
+# while the client waits (then served compressed from the cache).
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+_django_default = DjangoJSONEncoder().default
+
+
+def dumps(data):
+    '''
+    Encode data as compact JSON bytes, with orjson when it is installed
+    (several times faster than the json module), else with DjangoJSONEncoder.
+    Either way, types the encoder does not know, e.g. Decimal, are encoded
+    by DjangoJSONEncoder.
+    '''
+    if orjson is not None:
+        return orjson.dumps(
+            data,
+            default=_django_default,
+            option=orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY,
+        )
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':')).encode()
+
+
+def columns(fields, rows):
+    '''
+    Transpose rows (tuples of values in the order of fields) into the column
+    layout: a dict holding one list of values per field. Column-oriented JSON
+    names each field once rather than once per row, and needs no dict per row.
+    '''
+    rows = list(rows)
+    if not rows:
+        return {name: [] for name in fields}
+    return {name: list(values) for name, values in zip(fields, zip(*rows))}
+
+
+def content_encodings():
+    '''
+    The content encodings responses can be compressed with, preferred first.
+    '''
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def accepted_encoding(request):
+    '''
+    The preferred content encoding the client accepts per its Accept-Encoding
+    header, or None to send responses uncompressed.
+    '''
+    if not settings.RESPONSE_COMPRESSION:
+        return None
+    accepted = set()
+    for item in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = item.partition(';')
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                if float(params[2:]) == 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip().lower())
+    for encoding in content_encodings():
+        if encoding in accepted or '*' in accepted:
+            return encoding
+    return None
+
+
+def compress(body, encoding):
+    '''
+    Compress a response body with a content encoding of content_encodings().
+    '''
+    if encoding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    # No timestamp, so the same body always compresses to the same bytes.
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
@@ -0,0 +1,173 @@
+import csv
+import io
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+
+# Rows are encoded and sent in batches of this many, so each chunk of the
+# streamed response is large enough to be written efficiently.
+EXPORT_BATCH_ROWS = 1000
+
+# Rows per record batch (and Parquet row group) of the columnar formats.
+COLUMNAR_BATCH_ROWS = 65536
+
+EXPORT_CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+
+# Arrow types of the cells.EXPORT_FIELDS, for the columnar formats.
+EXPORT_ARROW_TYPES = {
+    'project_name': 'string',
+    'subject_name': 'string',
+    'condition': 'string',
+    'age': 'int64',
+    'sex': 'string',
+    'treatment': 'string',
+    'response': 'bool',
+    'sample_id': 'int64',
+    'sample_name': 'string',
+    'sample_type': 'string',
+    'time_from_treatment_start': 'int64',
+    'total_count': 'int64',
+    'population': 'string',
+    'count': 'int64',
+    'relative_frequency': 'float64',
+}
+
+
+def ndjson_lines(fields, rows):
+    '''
+    Encode rows as newline delimited JSON objects with the given field names.
+    '''
+    encoder = DjangoJSONEncoder()
+    batch = []
+    for row in rows:
+        batch.append(encoder.encode(dict(zip(fields, row))))
+        if len(batch) >= EXPORT_BATCH_ROWS:
+            yield '\n'.join(batch) + '\n'
+            batch = []
+    if batch:
+        yield '\n'.join(batch) + '\n'
+
+
+def csv_lines(fields, rows):
+    '''
+    Encode rows as CSV, starting with a header line of the field names.
+    Missing values are written as empty fields.
+    '''
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(fields)
+    yield _drain(buffer)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % EXPORT_BATCH_ROWS == 0:
+            yield _drain(buffer)
+    yield _drain(buffer)
+
+
+def _drain(buffer):
+    text = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+    return text
+
+
+class _ChunkSink(io.RawIOBase):
+    '''
+    A write-only file that keeps what is written until it is drained,
+    so pyarrow writers can be streamed out as they write.
+    '''
+
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def columnar_chunks(export_format, fields, rows):
+    '''
+    Encode rows as a Parquet file, or an Arrow IPC stream, one record batch
+    (and row group) of COLUMNAR_BATCH_ROWS rows at a time.
+    Needs the pyarrow package, which is only imported here.
+    '''
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    schema = pyarrow.schema(
+        [(name, pyarrow.type_for_alias(EXPORT_ARROW_TYPES[name])) for name in fields]
+    )
+    sink = _ChunkSink()
+    if export_format == 'parquet':
+        writer = pyarrow.parquet.ParquetWriter(sink, schema)
+    else:
+        writer = pyarrow.ipc.new_stream(sink, schema)
+
+    with writer:
+        for batch in _row_batches(rows, COLUMNAR_BATCH_ROWS):
+            columns = zip(*batch)
+            writer.write_batch(
+                pyarrow.record_batch(
+                    [pyarrow.array(column, type=t) for column, t in zip(columns, schema.types)],
+                    schema=schema,
+                )
+            )
+            yield sink.drain()
+    yield sink.drain()
+
+
+def _row_batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def encode_rows(export_format, fields, rows):
+    '''
+    Encode rows in the given export format, lazily, one batch at a time.
+    '''
+    if export_format == 'csv':
+        return csv_lines(fields, rows)
+    if export_format in ('parquet', 'arrow'):
+        return columnar_chunks(export_format, fields, rows)
+    return ndjson_lines(fields, rows)
+
+
+async def aiterate(chunks):
+    '''
+    Iterate the chunks of a synchronous iterator asynchronously, for an ASGI
+    server to stream them: it would read a synchronous one whole first.
+    Each chunk is produced in the thread of the request (thread sensitive),
+    so a database cursor stays on the connection that opened it.
+    '''
+    done = object()
+    next_chunk = sync_to_async(next)
+    try:
+        while (chunk := await next_chunk(chunks, done)) is not done:
+            yield chunk
+    finally:
+        if hasattr(chunks, 'close'):
+            await sync_to_async(chunks.close)()
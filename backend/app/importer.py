@@ -0,0 +1,695 @@
+import hashlib
+import io
+import multiprocessing
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+from itertools import islice
+import django
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+import numpy
+import pandas
+from .models import CELL_TYPES, Subject, Sample, SampleSummary, Cell, Project, Scientist
+from .pgcopy import copy_insert
+from .cache import bump_data_versions
+from .cells import wide_storage
+from .summaries import refresh_sample_summaries, save_sample_summaries, summarize_counts
+
+COL_SPEC = [
+    'project',
+    'subject',
+    'condition',
+    'age',
+    'sex',
+    'treatment',
+    'response',
+    'sample',
+    'sample_type',
+    'time_from_treatment_start',
+    'b_cell',
+    'cd4_t_cell',
+    'cd8_t_cell',
+    'nk_cell',
+    'monocyte',
+]
+
+# Number of rows sent to the database in a single bulk_create call.
+BATCH_SIZE = 5000
+
+# Accepted spellings of the response column, compared after strip() and lower().
+RESPONSE_VALUES = {
+    'yes': True,
+    'true': True,
+    '1': True,
+    'y': True,
+    'no': False,
+    'false': False,
+    '0': False,
+    'n': False,
+}
+
+# Columns that must be present on every row.
+REQUIRED_COLUMNS = ['project', 'subject', 'sample']
+
+# Text columns of COL_SPEC, read as strings so natural keys like a sample
+# named '1' compare equal to what is stored in the database.
+TEXT_COLUMNS = ['project', 'subject', 'condition', 'sex', 'treatment', 'sample', 'sample_type']
+
+# Columns read as written rather than parsed as numbers, which would turn
+# subject '007' into 7, or into 7.0 in a chunk where the column has a blank.
+STRING_COLUMNS = TEXT_COLUMNS + ['response']
+
+# Only empty cells are missing values, so text like 'None' or 'NA'
+# (e.g. treatment='None') is kept as written.
+READ_CSV_OPTIONS = {
+    'keep_default_na': False,
+    'na_values': [''],
+    'dtype': {column: 'string' for column in STRING_COLUMNS},
+}
+
+# Accepted upload formats by file extension. Arrow IPC (.arrow, .feather) and
+# Parquet files are read with pyarrow, imported only when such a file comes in.
+IMPORT_FORMATS = {
+    '.csv': 'csv',
+    '.parquet': 'parquet',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+}
+
+# Maximum number of row errors kept by the ImportEngine for reporting.
+MAX_REPORTED_ERRORS = 100
+
+# Subjects and samples the ImportEngine keeps between chunks. The oldest are
+# dropped beyond this, and looked up in the database again if a later chunk
+# has rows for them, so memory does not grow with the size of the file.
+MAX_CACHED_KEYS = 50000
+
+
+def _integer_column(column):
+    '''
+    Coerce a column to nullable integers.
+    Returns the Int64 column and a mask of the values that are missing,
+    not numeric or not whole numbers.
+    '''
+    numeric = pandas.to_numeric(column, errors='coerce')
+    invalid = numeric.isna() | ~numpy.isfinite(numeric) | (numeric % 1 != 0)
+    return numeric.where(~invalid).astype('Int64'), invalid
+
+
+def normalize_chunk(chunk):
+    '''
+    Normalize and validate a COL_SPEC DataFrame chunk with column-wise operations.
+    - text columns are converted to strings, empty optional ones to ''.
+    - response is mapped to a nullable boolean (NA when not a known value).
+    - time_from_treatment_start is coerced to a nullable integer (NA when empty
+      or not numeric).
+    - age and the cell counts must be whole numbers (counts also non-negative),
+      and project, subject and sample must be present.
+
+    Returns the valid rows and a DataFrame of errors with the 'row' (the 0-based
+    data row index in the file) and 'reason' of every invalid value.
+    Rows with at least one error are left out of the valid rows.
+    '''
+    chunk = chunk.copy()
+    checks = []
+
+    for column in TEXT_COLUMNS:
+        chunk[column] = chunk[column].astype('string')
+        if column not in REQUIRED_COLUMNS:
+            chunk[column] = chunk[column].fillna('')
+
+    chunk['response'] = (
+        chunk['response']
+        .astype('string')
+        .str.strip()
+        .str.lower()
+        .map(RESPONSE_VALUES)
+        .astype('boolean')
+    )
+    time_from_start = pandas.to_numeric(
+        chunk['time_from_treatment_start'], errors='coerce'
+    )
+    chunk['time_from_treatment_start'] = (
+        numpy.trunc(time_from_start.where(numpy.isfinite(time_from_start)))
+        .astype('Int64')
+    )
+
+    for column in REQUIRED_COLUMNS:
+        checks.append((chunk[column].isna(), f'{column} is missing'))
+
+    chunk['age'], invalid = _integer_column(chunk['age'])
+    checks.append((invalid, 'age is not an integer'))
+
+    for cell_type in CELL_TYPES:
+        chunk[cell_type], invalid = _integer_column(chunk[cell_type])
+        invalid |= chunk[cell_type].fillna(0) < 0
+        checks.append((invalid, f'{cell_type} is not a non-negative integer'))
+
+    errors = pandas.concat(
+        [
+            pandas.DataFrame({'row': chunk.index[mask], 'reason': reason})
+            for mask, reason in checks
+        ],
+        ignore_index=True,
+    ).sort_values('row', kind='stable', ignore_index=True)
+    invalid_rows = numpy.logical_or.reduce([mask.to_numpy() for mask, _ in checks])
+
+    return chunk[~invalid_rows], errors
+
+
+def read_chunks(file, chunk_size=None):
+    '''
+    Read the CSV file chunk_size rows at a time (IMPORT_CHUNK_SIZE by default),
+    yielding a DataFrame with the COL_SPEC columns for each chunk.
+    Only one chunk is held in memory, whatever the size of the file.
+    The file must have the COL_SPEC columns, see missing_columns.
+    '''
+    reader = pandas.read_csv(
+        file, chunksize=chunk_size or settings.IMPORT_CHUNK_SIZE, **READ_CSV_OPTIONS
+    )
+    with reader:
+        for chunk in reader:
+            yield chunk[COL_SPEC]
+
+
+def file_format(name):
+    '''
+    The IMPORT_FORMATS format of a file name, or None if it is not supported.
+    '''
+    return IMPORT_FORMATS.get(os.path.splitext(name)[1].lower())
+
+
+def read_arrow_chunks(file, chunk_size=None):
+    '''
+    Read a Parquet or Arrow IPC file chunk_size rows at a time
+    (IMPORT_CHUNK_SIZE by default), yielding a DataFrame with the COL_SPEC
+    columns for each chunk, indexed by row number like read_chunks.
+    Files on local disk are memory mapped, so Arrow data is read in place
+    instead of being copied into memory first.
+    The file must have the COL_SPEC columns, see missing_columns.
+    '''
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    chunk_size = chunk_size or settings.IMPORT_CHUNK_SIZE
+    path = local_path(file)
+    source = pyarrow.memory_map(path) if path else file
+
+    if file_format(file.name) == 'parquet':
+        reader = pyarrow.parquet.ParquetFile(source)
+        batches = reader.iter_batches(batch_size=chunk_size, columns=COL_SPEC)
+    else:
+        try:
+            table = pyarrow.ipc.open_file(source).read_all()
+        except pyarrow.ArrowInvalid:
+            # Not the random access file format, try the streaming format.
+            source.seek(0)
+            table = pyarrow.ipc.open_stream(source).read_all()
+        batches = table.select(COL_SPEC).to_batches(max_chunksize=chunk_size)
+
+    row = 0
+    for batch in batches:
+        chunk = _strings(batch).to_pandas()
+        chunk.index = pandas.RangeIndex(row, row + len(chunk))
+        row += len(chunk)
+        yield chunk
+
+
+def _strings(batch):
+    '''
+    Cast the STRING_COLUMNS of a record batch to strings in Arrow, so integer
+    columns with nulls are not converted to floats (101 to '101.0') by pandas.
+    '''
+    import pyarrow
+
+    columns = [
+        batch.column(name).cast(pyarrow.string()) if name in STRING_COLUMNS else batch.column(name)
+        for name in batch.schema.names
+    ]
+    return pyarrow.RecordBatch.from_arrays(columns, names=batch.schema.names)
+
+
+def missing_columns(file):
+    '''
+    The COL_SPEC columns missing from the header (or Arrow schema) of an
+    uploaded or stored file, read without reading any rows, so a file can be
+    rejected before it is imported. The file is rewound afterwards.
+    '''
+    if file_format(file.name) in ('parquet', 'arrow'):
+        names = _arrow_schema(file).names
+    else:
+        try:
+            names = pandas.read_csv(file, nrows=0, **READ_CSV_OPTIONS).columns
+        except pandas.errors.EmptyDataError:
+            # Not even a header line.
+            names = []
+    file.seek(0)
+    return [column for column in COL_SPEC if column not in names]
+
+
+def _arrow_schema(file):
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+
+    path = local_path(file)
+    source = pyarrow.memory_map(path) if path else file
+    if file_format(file.name) == 'parquet':
+        return pyarrow.parquet.read_schema(source)
+    try:
+        return pyarrow.ipc.open_file(source).schema
+    except pyarrow.ArrowInvalid:
+        # Not the random access file format, try the streaming format.
+        source.seek(0)
+        return pyarrow.ipc.open_stream(source).schema
+
+
+def content_hash(file):
+    '''
+    Return the SHA-256 hex digest of an uploaded or stored file,
+    reading it block by block, and rewind the file afterwards.
+    '''
+    digest = hashlib.sha256()
+    for block in file.chunks():
+        digest.update(block)
+    file.seek(0)
+    return digest.hexdigest()
+
+
+def local_path(file):
+    '''
+    Return the path of an uploaded or stored file on local disk,
+    or None if it only lives in memory or in remote storage.
+    '''
+    if hasattr(file, 'temporary_file_path'):
+        return file.temporary_file_path()
+    try:
+        return file.path
+    except (AttributeError, NotImplementedError, ValueError):
+        return None
+
+
+def shard_offsets(path, shard_bytes):
+    '''
+    Split the file at path into byte ranges of roughly shard_bytes each.
+    Ranges start right after the header line and every boundary is moved
+    forward to the next newline, so no row is split between two shards.
+    (Quoted fields containing newlines are not supported.)
+    Returns the header line and a list of (start, end) offsets.
+    '''
+    size = os.path.getsize(path)
+    with open(path, 'rb') as file:
+        header = file.readline()
+        offsets = []
+        start = file.tell()
+        while start < size:
+            file.seek(min(start + shard_bytes, size))
+            file.readline()
+            end = min(file.tell(), size)
+            offsets.append((start, end))
+            start = end
+    return header, offsets
+
+
+def _parse_shard(path, header, start, end):
+    '''
+    Parse and normalize the rows between the start and end offsets of the file.
+    Runs in a worker process of read_shards.
+    Returns the normalized rows, the errors and the number of rows read,
+    with row indices starting at 0 for the shard.
+    '''
+    with open(path, 'rb') as file:
+        file.seek(start)
+        data = file.read(end - start)
+    chunk = pandas.read_csv(io.BytesIO(header + data), **READ_CSV_OPTIONS)[COL_SPEC]
+    return *normalize_chunk(chunk), len(chunk)
+
+
+def read_shards(path, workers=None, shard_bytes=None):
+    '''
+    Parse the CSV file at path in parallel, yielding the normalized rows and
+    errors of each byte-range shard, in file order, with row indices counted
+    from the start of the file.
+    Shards are handed to a pool of IMPORT_PARSE_WORKERS processes, with at most
+    two shards per worker in flight so memory stays bounded on huge files.
+    '''
+    workers = workers or settings.IMPORT_PARSE_WORKERS
+    header, offsets = shard_offsets(path, shard_bytes or settings.IMPORT_SHARD_BYTES)
+    with ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=django.setup,
+    ) as executor:
+        def results():
+            pending = deque()
+            for start, end in offsets:
+                pending.append(executor.submit(_parse_shard, path, header, start, end))
+                if len(pending) >= workers * 2:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+        row_offset = 0
+        for chunk, errors, rows_read in results():
+            chunk.index += row_offset
+            errors['row'] += row_offset
+            row_offset += rows_read
+            yield chunk, errors
+
+
+def read_normalized_chunks(file):
+    '''
+    Yield the normalized rows and errors (see normalize_chunk) of the uploaded
+    or stored file, one chunk at a time.
+    Parquet and Arrow files are read with read_arrow_chunks. CSV files on local
+    disk of at least IMPORT_PARALLEL_MIN_BYTES are parsed in parallel with
+    read_shards, everything else is streamed with read_chunks.
+    '''
+    if file_format(file.name) in ('parquet', 'arrow'):
+        for chunk in read_arrow_chunks(file):
+            yield normalize_chunk(chunk)
+        return
+
+    path = local_path(file)
+    if (
+        path
+        and settings.IMPORT_PARSE_WORKERS > 1
+        and os.path.getsize(path) >= settings.IMPORT_PARALLEL_MIN_BYTES
+    ):
+        yield from read_shards(path)
+    else:
+        for chunk in read_chunks(file):
+            yield normalize_chunk(chunk)
+
+
+def _batches(items, size):
+    '''
+    Split a list into lists of at most size items, e.g. to keep
+    the number of parameters of an __in lookup bounded.
+    '''
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _sample_keys(chunk):
+    '''
+    The (project, subject, sample) key of the samples map of each row.
+    '''
+    return zip(chunk['project'], chunk['subject'], chunk['sample'])
+
+
+def _evict_oldest(mapping, size):
+    '''
+    Drop the oldest entries of a dict (in insertion order) beyond size.
+    '''
+    for key in list(islice(mapping, max(len(mapping) - size, 0))):
+        del mapping[key]
+
+
+def _records(frame):
+    '''
+    Iterate the rows of a normalized DataFrame as namedtuples,
+    with missing values as None.
+    '''
+    return frame.astype(object).where(frame.notna(), None).itertuples(index=False)
+
+
+@dataclass
+class ImportEngine:
+    '''
+    Persists normalized DataFrame chunks with a handful of batched queries.
+
+    Instead of saving each Project, Subject and Sample as its row is read,
+    the engine resolves every entity type in one pass over the chunk:
+    - New projects, subjects and samples are collected into the projects,
+      subjects and samples maps and inserted with a single bulk_create each.
+    - Cell rows are then inserted in chunks of batch_size, so the number of
+      round trips grows with the number of chunks, not the number of rows.
+
+    run can be called once per chunk of a streamed file; the maps carry over
+    between chunks so entities are never created twice. They keep the last
+    MAX_CACHED_KEYS subjects and samples, older ones are looked up in the
+    database again when needed, and the samples map only holds sample ids,
+    so memory stays flat on very large files.
+
+    On Postgres, Sample and Cell rows are streamed in with COPY FROM STDIN
+    (see pgcopy.copy_insert); other databases fall back to bulk_create.
+
+    With CELL_STORAGE='wide' no Cell rows are written, each sample's counts
+    go straight to its SampleSummary instead.
+
+    Every project that gets new rows has its data_version bumped, which
+    invalidates its cached responses (see cache.py).
+
+    In upsert mode, projects (by name, for the scientist), subjects (by project
+    and name) and samples (by subject and name) that are already in the
+    database are reused instead of created, and only rows of new samples get
+    cells, so re-importing a file only adds the rows that were not there yet.
+    Samples created before the import started are told apart by their id
+    (samples_before), rather than by keeping a set of them.
+    '''
+
+    scientist: Scientist
+    upsert: bool = False
+    batch_size: int = BATCH_SIZE
+    use_copy: bool = field(
+        default_factory=lambda: connection.vendor == 'postgresql'
+    )
+
+    projects: dict = field(default_factory=dict)
+    subjects: dict = field(default_factory=dict)
+    samples: dict = field(default_factory=dict)
+    created_projects: list = field(default_factory=list)
+    # The highest Sample id when the import started, set by the first run.
+    samples_before: int = None
+    errors: list = field(default_factory=list)
+    error_count: int = 0
+
+    def run(self, chunk, errors=None):
+        '''
+        Create the Projects, Subjects, Samples and Cells for the rows of a
+        normalized chunk, and record the chunk's validation errors, if any.
+        The caller is expected to wrap this in a transaction.
+        Returns the number of rows imported.
+        '''
+        if errors is not None:
+            self._record_errors(errors)
+        if self.samples_before is None:
+            self.samples_before = Sample.objects.aggregate(last=Max('id'))['last'] or 0
+        self._resolve_projects(chunk)
+        self._resolve_subjects(chunk)
+        self._resolve_samples(chunk)
+        new_rows = self._without_existing_samples(chunk)
+        self._create_cells(new_rows)
+        if len(new_rows):
+            bump_data_versions(
+                [self.projects[name].id for name in new_rows['project'].unique()]
+            )
+        _evict_oldest(self.subjects, MAX_CACHED_KEYS)
+        _evict_oldest(self.samples, MAX_CACHED_KEYS)
+        return len(chunk)
+
+    def _record_errors(self, errors):
+        '''
+        Count the validation errors, keeping the first MAX_REPORTED_ERRORS.
+        '''
+        self.error_count += len(errors)
+        room = MAX_REPORTED_ERRORS - len(self.errors)
+        if room > 0:
+            self.errors.extend(
+                {'row': int(row), 'reason': reason}
+                for row, reason in errors.head(room).itertuples(index=False)
+            )
+
+    def _resolve_projects(self, chunk):
+        '''
+        Create a Project for every project name that is not already in the
+        projects map (currently owned by the statically defined scientist).
+        '''
+        names = [name for name in chunk['project'].unique() if name not in self.projects]
+        if self.upsert and names:
+            # Reuse the oldest project with the same name, if any.
+            for project in Project.objects.filter(
+                user=self.scientist, project_name__in=names
+            ).order_by('id'):
+                self.projects.setdefault(project.project_name, project)
+
+        new_projects = {}
+        for name in names:
+            if name not in self.projects:
+                new_projects[name] = Project(
+                    project_name=name,
+                    date=time.strftime('%Y-%m-%d'),
+                    user=self.scientist,
+                )
+
+        Project.objects.bulk_create(new_projects.values(), batch_size=self.batch_size)
+        self.projects.update(new_projects)
+        self.created_projects.extend(new_projects.values())
+
+    def _resolve_subjects(self, chunk):
+        '''
+        Create a Subject for every (project, subject) pair that is neither in
+        the subjects map nor in the database (under its project, which in
+        append mode only holds the subjects of this import). Subject names
+        are only unique within a project.
+        '''
+        rows = [
+            row
+            for row in _records(chunk.drop_duplicates(['project', 'subject']))
+            if (row.project, row.subject) not in self.subjects
+        ]
+        existing = {}
+        if rows:
+            for batch in _batches(rows, self.batch_size):
+                for subject in Subject.objects.filter(
+                    project__in={self.projects[row.project].id for row in batch},
+                    subject_name__in=[row.subject for row in batch],
+                ):
+                    existing[(subject.project_id, subject.subject_name)] = subject
+
+        new_subjects = {}
+        for row in rows:
+            key = (row.project, row.subject)
+            project = self.projects[row.project]
+            if (project.id, row.subject) in existing:
+                self.subjects[key] = existing[(project.id, row.subject)]
+            else:
+                new_subjects[key] = Subject(
+                    subject_name=row.subject,
+                    condition=row.condition,
+                    age=row.age,
+                    sex=row.sex,
+                    treatment=row.treatment,
+                    response=row.response,
+                    project=project,
+                )
+
+        Subject.objects.bulk_create(new_subjects.values(), batch_size=self.batch_size)
+        self.subjects.update(new_subjects)
+
+    def _resolve_samples(self, chunk):
+        '''
+        Per the CSV each sample (s1, s2, s3, etc.) is unique in the CSV.
+        But, key the samples map by a tuple of (project, subject, sample) to
+        ensure uniqueness, as subjects of different projects can share a name.
+        '''
+        rows = [
+            row
+            for row in _records(chunk.drop_duplicates(['project', 'subject', 'sample']))
+            if (row.project, row.subject, row.sample) not in self.samples
+        ]
+        existing = {}
+        if rows:
+            for batch in _batches(rows, self.batch_size):
+                existing.update(
+                    ((subject_id, sample_name), sample_id)
+                    for sample_id, subject_id, sample_name in Sample.objects.filter(
+                        subject__in={
+                            self.subjects[(row.project, row.subject)].id for row in batch
+                        },
+                        sample_name__in=[row.sample for row in batch],
+                    ).values_list('id', 'subject_id', 'sample_name')
+                )
+
+        new_samples = {}
+        for row in rows:
+            key = (row.project, row.subject, row.sample)
+            subject = self.subjects[(row.project, row.subject)]
+            if (subject.id, row.sample) in existing:
+                self.samples[key] = existing[(subject.id, row.sample)]
+            else:
+                new_samples[key] = Sample(
+                    sample_name=row.sample,
+                    sample_type=row.sample_type,
+                    time_from_treatment_start=row.time_from_treatment_start,
+                    subject=subject,
+                )
+
+        self._insert(Sample, list(new_samples.values()), assign_ids=True)
+        for key, sample in new_samples.items():
+            self.samples[key] = sample.id
+
+    def _without_existing_samples(self, chunk):
+        '''
+        Leave out the rows of samples that were already in the database
+        before this import, their cells are not imported again.
+        '''
+        keep = [
+            self.samples[key] > self.samples_before
+            for key in _sample_keys(chunk)
+        ]
+        return chunk[keep]
+
+    def _create_cells(self, chunk):
+        '''
+        Create a Cell for each cell type of each row, inserting them
+        batch_size at a time so only one chunk is held in memory,
+        then refresh the SampleSummary of every sample that got cells.
+        '''
+        sample_ids = [self.samples[key] for key in _sample_keys(chunk)]
+        if wide_storage():
+            self._save_wide_counts(chunk, sample_ids)
+            return
+
+        counts = chunk[CELL_TYPES].to_numpy(dtype='int64').tolist()
+
+        cells = []
+        for sample_id, row_counts in zip(sample_ids, counts):
+            for cell_type, count in zip(CELL_TYPES, row_counts):
+                cells.append(Cell(type=cell_type, count=count, sample_id=sample_id))
+            if len(cells) >= self.batch_size:
+                self._insert(Cell, cells)
+                cells = []
+
+        if cells:
+            self._insert(Cell, cells)
+
+        refresh_sample_summaries(set(sample_ids), batch_size=self.batch_size)
+
+    def _save_wide_counts(self, chunk, sample_ids):
+        '''
+        Write the counts of each sample to its SampleSummary (wide storage).
+        Rows of the same sample are added up: those within the chunk, and
+        the counts saved by earlier chunks of the import for a sample whose
+        rows span several chunks (only samples created by this import get
+        here, so an existing summary can only come from an earlier chunk).
+        '''
+        counts = chunk[CELL_TYPES].astype('int64')
+        counts.index = sample_ids
+        totals = counts.groupby(level=0).sum()
+
+        earlier = pandas.DataFrame(
+            [
+                row
+                for batch in _batches(totals.index.tolist(), self.batch_size)
+                for row in SampleSummary.objects.filter(sample_id__in=batch).values_list(
+                    'sample_id', *CELL_TYPES
+                )
+            ],
+            columns=['sample_id', *CELL_TYPES],
+        ).set_index('sample_id')
+        if len(earlier):
+            totals = totals.add(earlier.reindex(totals.index, fill_value=0)).astype('int64')
+
+        save_sample_summaries(
+            (
+                summarize_counts(sample_id, dict(zip(CELL_TYPES, row_counts)))
+                for sample_id, *row_counts in totals.itertuples(name=None)
+            ),
+            batch_size=self.batch_size,
+        )
+
+    def _insert(self, model, objs, assign_ids=False):
+        '''
+        Insert the unsaved instances with COPY when available, else bulk_create.
+        assign_ids makes sure the instances have their pk set afterwards.
+        '''
+        if self.use_copy:
+            copy_insert(objs, assign_ids=assign_ids)
+        else:
+            model.objects.bulk_create(objs, batch_size=self.batch_size)
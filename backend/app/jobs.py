@@ -0,0 +1,188 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import django
+from django.conf import settings
+from django.core.signals import request_started
+from django.db import DatabaseError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from .importer import ImportEngine, missing_columns, read_normalized_chunks
+from .models import ImportJob, ImportedFile, Project
+
+_executor = None
+
+
+def _get_executor():
+    '''
+    Lazily create the process pool used by the 'process' job runner.
+    Workers are spawned rather than forked so they never share the parent's
+    database connections, and run django.setup() before taking any job.
+    '''
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.IMPORT_JOB_WORKERS,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+    return _executor
+
+
+def enqueue_import_job(job):
+    '''
+    Hand a saved ImportJob to the configured runner once the transaction that
+    created it commits. With the 'queue' runner the job simply stays queued
+    until a run_import_worker process claims it.
+    '''
+    if settings.IMPORT_JOB_RUNNER == 'process':
+        transaction.on_commit(
+            lambda: _get_executor().submit(run_queued_job, job.id)
+        )
+
+
+def claim_job(job_id):
+    '''
+    Mark a queued job running, returning whether it was still queued.
+    The conditional update makes sure two workers never run the same job.
+    '''
+    return bool(
+        ImportJob.objects.filter(id=job_id, status='queued').update(
+            status='running', heartbeat_at=timezone.now()
+        )
+    )
+
+
+def claim_next_job():
+    '''
+    Claim the oldest queued job for this worker, or return None if there is none.
+    '''
+    for job_id in ImportJob.objects.filter(status='queued').order_by('id').values_list(
+        'id', flat=True
+    )[:10]:
+        if claim_job(job_id):
+            return job_id
+    return None
+
+
+def run_queued_job(job_id):
+    '''
+    Run a job submitted to the process pool, unless another process claimed
+    it already (it may have been submitted again by recover_import_jobs).
+    '''
+    if claim_job(job_id):
+        return run_import_job(job_id)
+    return None
+
+
+def _fail_job(job, message):
+    '''
+    Mark a job failed with message, deleting its stored upload.
+    '''
+    job.file.delete(save=False)
+    job.status = 'failed'
+    job.errors.append({'row': None, 'reason': message})
+    job.finished_at = timezone.now()
+    job.save(update_fields=['file', 'status', 'errors', 'finished_at'])
+
+
+def fail_stale_jobs(jobs=None):
+    '''
+    Mark failed the running jobs (of the jobs queryset, by default all jobs)
+    that have not progressed for IMPORT_JOB_STALE_SECONDS: their worker was
+    stopped or restarted while running them. The rows of their completed
+    chunks are kept, importing the file again in upsert mode adds the rest.
+    Returns the number of jobs marked failed.
+    '''
+    jobs = ImportJob.objects.all() if jobs is None else jobs
+    cutoff = timezone.now() - timedelta(seconds=settings.IMPORT_JOB_STALE_SECONDS)
+    stale = Q(status='running') & (Q(heartbeat_at__lt=cutoff) | Q(heartbeat_at__isnull=True))
+    failed = 0
+    for job in jobs.filter(stale):
+        # Only if it is still stale, as its worker may have just progressed.
+        if ImportJob.objects.filter(stale, id=job.id).update(status='failed'):
+            _fail_job(job, 'The import was interrupted by a restart of its worker')
+            failed += 1
+    return failed
+
+
+def recover_import_jobs():
+    '''
+    Recover the jobs lost by a restart, run when a server or worker process
+    starts: stale running jobs are marked failed (see fail_stale_jobs) and,
+    with the 'process' runner, whose pools do not survive a restart, queued
+    jobs are submitted again to the pool of this process. A job submitted to
+    several pools still runs once, see run_queued_job.
+    '''
+    fail_stale_jobs()
+    if settings.IMPORT_ASYNC and settings.IMPORT_JOB_RUNNER == 'process':
+        for job_id in ImportJob.objects.filter(status='queued').values_list('id', flat=True):
+            _get_executor().submit(run_queued_job, job_id)
+
+
+# dispatch_uid of recover_on_first_request.
+RECOVERY_UID = 'recover_import_jobs'
+
+
+def recover_on_first_request(**kwargs):
+    '''
+    request_started receiver connected by AppConfig.ready: runs
+    recover_import_jobs on the first request of a server process, then
+    disconnects itself. It tries again on the next request if the database
+    is not reachable or migrated yet.
+    '''
+    try:
+        recover_import_jobs()
+    except DatabaseError:
+        return
+    request_started.disconnect(dispatch_uid=RECOVERY_UID)
+
+
+def run_import_job(job_id):
+    '''
+    Import the uploaded file of a claimed ImportJob, recording progress as it goes.
+
+    Each chunk is persisted in its own transaction together with the updated
+    rows_processed, so progress is visible to /api/import/<job_id> while the
+    job runs. If a chunk fails, the projects created so far are deleted again
+    (cascading to their subjects, samples and cells) and the job is marked failed.
+    Rows an upsert job already added to existing projects are kept, importing
+    the file again adds the remaining ones. The stored upload is deleted once
+    the job has finished, whether it succeeded or failed.
+    '''
+    job = ImportJob.objects.select_related('user').get(id=job_id)
+    job.started_at = timezone.now()
+    job.save(update_fields=['started_at'])
+
+    engine = ImportEngine(scientist=job.user, upsert=job.upsert)
+    try:
+        with job.file.open('rb') as file:
+            # Uploads are checked by import_view, but the job may have been
+            # queued some other way.
+            if missing_columns(file):
+                raise ValueError('CSV file is missing required columns')
+            for chunk, errors in read_normalized_chunks(file):
+                with transaction.atomic():
+                    job.rows_processed += engine.run(chunk, errors)
+                    job.errors = engine.errors
+                    job.heartbeat_at = timezone.now()
+                    job.save(update_fields=['rows_processed', 'errors', 'heartbeat_at'])
+    except Exception as e:
+        Project.objects.filter(id__in=[p.id for p in engine.created_projects]).delete()
+        _fail_job(job, str(e))
+        return job.id
+
+    # The upload is no longer needed once its rows are in the database.
+    job.file.delete(save=False)
+    job.status = 'succeeded'
+    job.project_ids = [p.id for p in engine.projects.values()]
+    job.finished_at = timezone.now()
+    with transaction.atomic():
+        job.save(update_fields=['file', 'status', 'project_ids', 'finished_at'])
+        if job.upsert:
+            ImportedFile.objects.get_or_create(
+                user=job.user,
+                content_hash=job.content_hash,
+                defaults={'file_name': job.file_name, 'project_ids': job.project_ids},
+            )
+    return job.id
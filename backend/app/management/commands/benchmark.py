@@ -0,0 +1,151 @@
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client, override_settings
+from django.test.utils import setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from app.benchmarks import (
+    compare_results,
+    endpoint_scenarios,
+    generate_cell_counts,
+    run_endpoint,
+    run_import,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Benchmark the import and the results endpoints on a throwaway test '
+        'database of the configured engine (run it once with SQLite and once with '
+        'Postgres settings to compare them). Records import throughput, latency '
+        'percentiles, query counts and peak memory as JSON, and optionally flags '
+        'regressions against an earlier run.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--file',
+            help='CSV file to import, a synthetic one of --rows rows is generated by default.',
+        )
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument(
+            '--requests', type=int, default=20, help='Requests per endpoint and phase.'
+        )
+        parser.add_argument(
+            '--output',
+            help='Where to write the results, benchmarks/<timestamp>-<engine>.json by default.',
+        )
+        parser.add_argument('--compare', help='Results of an earlier run to compare with.')
+        parser.add_argument(
+            '--threshold',
+            type=float,
+            default=0.2,
+            help='Relative slowdown flagged as a regression by --compare.',
+        )
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['compare']:
+            with open(options['compare']) as file:
+                baseline = json.load(file)
+
+        with tempfile.TemporaryDirectory() as workdir:
+            path = options['file']
+            if not path:
+                path = os.path.join(workdir, 'cell-counts.csv')
+                with open(path, 'w', newline='') as file:
+                    generate_cell_counts(file, options['rows'])
+            results = self._run(path, options['requests'], workdir)
+
+        output = options['output'] or os.path.join(
+            settings.BASE_DIR,
+            'benchmarks',
+            f"{timezone.now():%Y%m%d-%H%M%S}-{results['meta']['vendor']}.json",
+        )
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        with open(output, 'w') as file:
+            json.dump(results, file, indent=2)
+        self._report(results)
+        self.stdout.write(self.style.SUCCESS(f'Results written to {output}'))
+
+        if baseline is not None:
+            regressions = compare_results(results, baseline, options['threshold'])
+            for scenario, metric, before, after in regressions:
+                self.stdout.write(
+                    self.style.ERROR(f'{scenario}: {metric} {before:.4g} -> {after:.4g}')
+                )
+            if regressions:
+                raise CommandError(f'{len(regressions)} regressions against {options["compare"]}')
+            self.stdout.write(self.style.SUCCESS('No regressions.'))
+
+    def _run(self, path, requests, workdir):
+        '''
+        Create the test database, import the file and benchmark the endpoints,
+        then destroy the test database again.
+        '''
+        if connection.vendor == 'sqlite':
+            # A file rather than the default in-memory test database,
+            # to measure what a deployment would see.
+            connection.settings_dict['TEST']['NAME'] = os.path.join(workdir, 'bench.sqlite3')
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        setup_test_environment()
+        try:
+            with override_settings(IMPORT_ASYNC=False, MEDIA_ROOT=workdir):
+                client = Client()
+                imported = run_import(client, path)
+                endpoints = {
+                    name: run_endpoint(client, url, params, requests)
+                    for name, url, params in endpoint_scenarios(imported['project_ids'][0])
+                }
+        finally:
+            teardown_test_environment()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        return {
+            'meta': {
+                'timestamp': timezone.now().isoformat(),
+                'commit': self._commit(),
+                'vendor': connection.vendor,
+                'python': platform.python_version(),
+                'django': django.get_version(),
+                'cell_storage': settings.CELL_STORAGE,
+                'cache_backend': settings.CACHE_BACKEND,
+                'requests': requests,
+            },
+            'import': imported,
+            'endpoints': endpoints,
+        }
+
+    def _commit(self):
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True,
+                text=True,
+                cwd=settings.BASE_DIR,
+            ).stdout.strip() or None
+        except OSError:
+            return None
+
+    def _report(self, results):
+        imported = results['import']
+        self.stdout.write(self.style.MIGRATE_HEADING('Import'))
+        self.stdout.write(
+            f"{imported['rows']} rows in {imported['seconds']:.2f}s "
+            f"({imported['rows_per_second']:.0f} rows/s), {imported['queries']} queries, "
+            f"peak RSS {imported['peak_rss_mb']:.0f} MB"
+        )
+        self.stdout.write(self.style.MIGRATE_HEADING('Endpoints (p50 / p95 ms, queries)'))
+        for name, result in results['endpoints'].items():
+            cold, warm = result['cold'], result['warm']
+            self.stdout.write(
+                f"{name:<18} cold {cold['p50_ms']:8.1f} / {cold['p95_ms']:8.1f} {cold['queries']:4d}"
+                f"   warm {warm['p50_ms']:8.1f} / {warm['p95_ms']:8.1f} {warm['queries']:4d}"
+                f"   {result['bytes'] / 1024:8.0f} KB  {result['peak_rss_mb']:6.0f} MB"
+            )
@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand, CommandError
+from app.models import Scientist
+from app.views import QueryData
+
+
+class Command(BaseCommand):
+    help = (
+        'Print the database query plans of the Project, Subject and Sample queries '
+        'that query_results runs for a set of filters, to check the indexes are used.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--project')
+        parser.add_argument('--condition')
+        parser.add_argument('--sex')
+        parser.add_argument('--treatment')
+        parser.add_argument('--sample-type')
+        parser.add_argument('--age', type=int)
+        parser.add_argument('--age-operator', choices=['gt', 'lt', 'eq'])
+        parser.add_argument('--time-from-treatment-start', type=int)
+        parser.add_argument('--time-operator', choices=['gt', 'lt', 'eq'])
+        parser.add_argument(
+            '--analyze',
+            action='store_true',
+            help='Run the queries and show actual timings (EXPLAIN ANALYZE, Postgres only).',
+        )
+
+    def handle(self, *args, **options):
+        scientist = Scientist.objects.filter(name='Bob Loblaw').first()
+        if scientist is None:
+            raise CommandError('No scientist found, import a file first.')
+
+        query_data = QueryData(
+            project=options['project'],
+            condition=options['condition'],
+            sex=options['sex'],
+            treatment=options['treatment'],
+            sample_type=options['sample_type'],
+            age_operator=options['age_operator'],
+            age=options['age'],
+            time_from_treatment_start=options['time_from_treatment_start'],
+            time_operator=options['time_operator'],
+            scientist=scientist,
+        )
+        projects, subjects, samples = query_data.build_querysets()
+
+        # The prefetches of query_results filter each level by the ids of the
+        # level above, which subqueries reproduce here.
+        subjects = subjects.filter(project__in=projects.values('id'))
+        samples = samples.filter(subject__in=subjects.values('id'))
+
+        explain_options = {'analyze': True} if options['analyze'] else {}
+        for name, queryset in [
+            ('Project', projects),
+            ('Subject', subjects),
+            ('Sample', samples),
+        ]:
+            self.stdout.write(self.style.MIGRATE_HEADING(f'{name} query'))
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(queryset.explain(**explain_options))
+            self.stdout.write('')
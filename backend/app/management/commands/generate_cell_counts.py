@@ -0,0 +1,36 @@
+from django.core.management.base import BaseCommand
+from app.benchmarks import generate_cell_counts
+
+
+class Command(BaseCommand):
+    help = (
+        'Write a synthetic cell count CSV file with the importer columns, '
+        'e.g. to benchmark imports. Scales to millions of rows.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the CSV file to write.')
+        parser.add_argument('--rows', type=int, default=100000)
+        parser.add_argument('--projects', type=int, default=3)
+        parser.add_argument('--samples-per-subject', type=int, default=3)
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0.0,
+            help='Fraction of rows with an invalid cell count.',
+        )
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        with open(options['output'], 'w', newline='') as file:
+            generate_cell_counts(
+                file,
+                options['rows'],
+                projects=options['projects'],
+                samples_per_subject=options['samples_per_subject'],
+                error_rate=options['error_rate'],
+                seed=options['seed'],
+            )
+        self.stdout.write(
+            self.style.SUCCESS(f"Wrote {options['rows']} rows to {options['output']}.")
+        )
@@ -0,0 +1,71 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from app.importer import BATCH_SIZE
+from app.models import CELL_TYPES, Cell, SampleSummary
+from app.summaries import refresh_sample_summaries
+
+
+class Command(BaseCommand):
+    help = (
+        'Move existing cell counts between the row layout (one Cell row per sample '
+        'and population) and the wide layout (one SampleSummary row per sample). '
+        'Set CELL_STORAGE to the same layout afterwards.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--to', choices=['wide', 'rows'], required=True)
+        parser.add_argument(
+            '--keep-cells',
+            action='store_true',
+            help='With --to wide, keep the Cell rows instead of deleting them.',
+        )
+        parser.add_argument('--batch-size', type=int, default=BATCH_SIZE)
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            if options['to'] == 'wide':
+                self._to_wide(options['batch_size'], options['keep_cells'])
+            else:
+                self._to_rows(options['batch_size'])
+        self.stdout.write(
+            self.style.SUCCESS(f"Done, now set CELL_STORAGE={options['to']}.")
+        )
+
+    def _to_wide(self, batch_size, keep_cells):
+        '''
+        Make sure every sample with cells has an up to date SampleSummary,
+        then drop the Cell rows.
+        '''
+        sample_ids = list(
+            Cell.objects.order_by('sample_id').values_list('sample_id', flat=True).distinct()
+        )
+        refresh_sample_summaries(sample_ids, batch_size=batch_size)
+        self.stdout.write(f'Summarized {len(sample_ids)} samples.')
+
+        if not keep_cells:
+            deleted, _ = Cell.objects.all().delete()
+            self.stdout.write(f'Deleted {deleted} cell rows.')
+
+    def _to_rows(self, batch_size):
+        '''
+        Create the Cell rows of every summarized sample that has none.
+        '''
+        summaries = (
+            SampleSummary.objects.exclude(sample__cell__isnull=False)
+            .order_by('sample_id')
+            .values_list('sample_id', *CELL_TYPES)
+        )
+        cells = []
+        created = 0
+        for sample_id, *counts in summaries.iterator(chunk_size=batch_size):
+            cells.extend(
+                Cell(type=cell_type, count=count, sample_id=sample_id)
+                for cell_type, count in zip(CELL_TYPES, counts)
+            )
+            if len(cells) >= batch_size:
+                Cell.objects.bulk_create(cells)
+                created += len(cells)
+                cells = []
+        Cell.objects.bulk_create(cells)
+        created += len(cells)
+        self.stdout.write(f'Created {created} cell rows.')
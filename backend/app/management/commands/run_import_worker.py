@@ -0,0 +1,35 @@
+import time
+from django.core.management.base import BaseCommand
+from app.jobs import claim_next_job, fail_stale_jobs, recover_import_jobs, run_import_job
+
+
+class Command(BaseCommand):
+    help = 'Run queued import jobs from the ImportJob table (IMPORT_JOB_RUNNER=queue).'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=2.0,
+            help='Seconds to wait before polling again when the queue is empty.',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit as soon as the queue is empty.',
+        )
+
+    def handle(self, *args, **options):
+        recover_import_jobs()
+        while True:
+            job_id = claim_next_job()
+            if job_id is None:
+                # Jobs of other workers that were stopped while running one.
+                fail_stale_jobs()
+                if options['once']:
+                    return
+                time.sleep(options['poll_interval'])
+                continue
+
+            self.stdout.write(f'Running import job {job_id}')
+            run_import_job(job_id)
@@ -0,0 +1,67 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:14
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0003_importjob"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImportedFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("content_hash", models.CharField(max_length=64)),
+                ("file_name", models.CharField(max_length=255)),
+                ("project_ids", models.JSONField(default=list)),
+                ("imported_at", models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="importjob",
+            name="content_hash",
+            field=models.CharField(blank=True, max_length=64),
+        ),
+        migrations.AddField(
+            model_name="importjob",
+            name="upsert",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddConstraint(
+            model_name="sample",
+            constraint=models.UniqueConstraint(
+                fields=("subject", "sample_name"), name="unique_sample_per_subject"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="subject",
+            constraint=models.UniqueConstraint(
+                fields=("project", "subject_name"), name="unique_subject_per_project"
+            ),
+        ),
+        migrations.AddField(
+            model_name="importedfile",
+            name="user",
+            field=models.ForeignKey(
+                on_delete=django.db.models.deletion.CASCADE, to="app.scientist"
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name="importedfile",
+            constraint=models.UniqueConstraint(
+                fields=("user", "content_hash"), name="unique_imported_file_per_user"
+            ),
+        ),
+    ]
@@ -0,0 +1,59 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0004_natural_keys_and_imported_files"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="project",
+            index=models.Index(
+                fields=["user", "project_name"], name="project_user_name_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sample",
+            index=models.Index(
+                fields=["subject", "sample_type", "time_from_treatment_start"],
+                name="sample_type_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="sample",
+            index=models.Index(
+                condition=models.Q(("time_from_treatment_start__isnull", False)),
+                fields=["subject", "time_from_treatment_start"],
+                name="sample_time_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="subject",
+            index=models.Index(
+                fields=["project", "condition", "treatment"],
+                name="subject_condition_treat_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="subject",
+            index=models.Index(
+                fields=["project", "sex", "age"], name="subject_sex_age_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="subject",
+            index=models.Index(fields=["project", "age"], name="subject_age_idx"),
+        ),
+        migrations.AddIndex(
+            model_name="subject",
+            index=models.Index(
+                condition=models.Q(("response__isnull", False)),
+                fields=["project", "response"],
+                name="subject_response_idx",
+            ),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+CELL_TYPES = ["b_cell", "cd4_t_cell", "cd8_t_cell", "nk_cell", "monocyte"]
+
+
+def backfill_sample_summaries(apps, schema_editor):
+    """
+    Create the SampleSummary of every sample imported before the table existed.
+    """
+    Cell = apps.get_model("app", "Cell")
+    SampleSummary = apps.get_model("app", "SampleSummary")
+    rows = (
+        Cell.objects.values("sample_id")
+        .annotate(
+            **{
+                t: models.Sum("count", filter=models.Q(type=t), default=0)
+                for t in CELL_TYPES
+            }
+        )
+        .order_by("sample_id")
+    )
+    summaries = []
+    for row in rows.iterator(chunk_size=5000):
+        total = sum(row[t] for t in CELL_TYPES) or None
+        summary = SampleSummary(sample_id=row["sample_id"], total_count=total)
+        for t in CELL_TYPES:
+            setattr(summary, t, row[t])
+            setattr(summary, f"{t}_frequency", row[t] / total if total else None)
+        summaries.append(summary)
+        if len(summaries) >= 5000:
+            SampleSummary.objects.bulk_create(summaries)
+            summaries = []
+    SampleSummary.objects.bulk_create(summaries)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0005_query_filter_indexes"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="SampleSummary",
+            fields=[
+                (
+                    "sample",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="summary",
+                        serialize=False,
+                        to="app.sample",
+                    ),
+                ),
+                ("b_cell", models.IntegerField(default=0)),
+                ("cd4_t_cell", models.IntegerField(default=0)),
+                ("cd8_t_cell", models.IntegerField(default=0)),
+                ("nk_cell", models.IntegerField(default=0)),
+                ("monocyte", models.IntegerField(default=0)),
+                ("total_count", models.IntegerField(blank=True, null=True)),
+                ("b_cell_frequency", models.FloatField(blank=True, null=True)),
+                ("cd4_t_cell_frequency", models.FloatField(blank=True, null=True)),
+                ("cd8_t_cell_frequency", models.FloatField(blank=True, null=True)),
+                ("nk_cell_frequency", models.FloatField(blank=True, null=True)),
+                ("monocyte_frequency", models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        migrations.RunPython(backfill_sample_summaries, migrations.RunPython.noop),
+    ]
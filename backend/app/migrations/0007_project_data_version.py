@@ -0,0 +1,24 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:19
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0006_samplesummary"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="project",
+            name="data_version",
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddField(
+            model_name="project",
+            name="updated_at",
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
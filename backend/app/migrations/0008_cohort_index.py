@@ -0,0 +1,130 @@
+# Generated by Django 5.0.6 on 2026-10-18 00:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+COHORT_FIELDS = {
+    "project_id": "subject__project_id",
+    "subject_id": "subject_id",
+    "condition": "subject__condition",
+    "treatment": "subject__treatment",
+    "sex": "subject__sex",
+    "age": "subject__age",
+    "response": "subject__response",
+    "sample_type": "sample_type",
+    "time_from_treatment_start": "time_from_treatment_start",
+}
+
+
+def backfill_cohort_fields(apps, schema_editor):
+    """
+    Copy the cohort columns of the existing SampleSummary rows from their
+    samples, subjects and projects.
+    """
+    Sample = apps.get_model("app", "Sample")
+    SampleSummary = apps.get_model("app", "SampleSummary")
+    rows = (
+        Sample.objects.filter(summary__isnull=False)
+        .values("id", *COHORT_FIELDS.values())
+        .order_by("id")
+    )
+    summaries = []
+    for row in rows.iterator(chunk_size=5000):
+        summary = SampleSummary(sample_id=row["id"])
+        for name, lookup in COHORT_FIELDS.items():
+            setattr(summary, name, row[lookup])
+        summaries.append(summary)
+        if len(summaries) >= 5000:
+            SampleSummary.objects.bulk_update(summaries, list(COHORT_FIELDS))
+            summaries = []
+    SampleSummary.objects.bulk_update(summaries, list(COHORT_FIELDS))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("app", "0007_project_data_version"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="samplesummary",
+            name="age",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="condition",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="project",
+            field=models.ForeignKey(
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="app.project",
+            ),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="response",
+            field=models.BooleanField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="sample_type",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="sex",
+            field=models.CharField(blank=True, default="", max_length=20),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="subject",
+            field=models.ForeignKey(
+                db_index=False,
+                null=True,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="+",
+                to="app.subject",
+            ),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="time_from_treatment_start",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="samplesummary",
+            name="treatment",
+            field=models.CharField(blank=True, default="", max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name="samplesummary",
+            index=models.Index(
+                fields=[
+                    "condition",
+                    "sample_type",
+                    "time_from_treatment_start",
+                    "treatment",
+                ],
+                name="cohort_baseline_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="samplesummary",
+            index=models.Index(
+                fields=["treatment", "sample_type", "time_from_treatment_start"],
+                name="cohort_treatment_idx",
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="samplesummary",
+            index=models.Index(fields=["sex", "age"], name="cohort_demographics_idx"),
+        ),
+        migrations.RunPython(backfill_cohort_fields, migrations.RunPython.noop),
+    ]
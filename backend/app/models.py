@@ -1,5 +1,15 @@
 from django.db import models
 from django.db.models import Sum
+from django.utils import timezone
+
+# The cell populations counted for each sample, in the order of the CSV columns.
+CELL_TYPES = [
+    'b_cell',
+    'cd4_t_cell',
+    'cd8_t_cell',
+    'nk_cell',
+    'monocyte',
+]
 
 
 class Scientist(models.Model):
@@ -15,6 +25,15 @@ class Project(models.Model):
     project_name = models.CharField(max_length=255)
     date = models.DateField()
     user = models.ForeignKey(Scientist, on_delete=models.CASCADE)
+    # Bumped by the importer whenever it writes data for the project,
+    # cached responses are keyed by it (see cache.py).
+    data_version = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['user', 'project_name'], name='project_user_name_idx'),
+        ]
 
     def __str__(self):
         return self.project_name
@@ -30,6 +49,26 @@ class Subject(models.Model):
     response = models.BooleanField(null=True, blank=True) 
     project = models.ForeignKey(Project, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['project', 'subject_name'], name='unique_subject_per_project'
+            ),
+        ]
+        # Match the filter combinations of QueryData on the Data Query page.
+        indexes = [
+            models.Index(
+                fields=['project', 'condition', 'treatment'],
+                name='subject_condition_treat_idx',
+            ),
+            models.Index(fields=['project', 'sex', 'age'], name='subject_sex_age_idx'),
+            models.Index(fields=['project', 'age'], name='subject_age_idx'),
+            models.Index(
+                fields=['project', 'response'],
+                name='subject_response_idx',
+                condition=models.Q(response__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -41,11 +80,33 @@ class Sample(models.Model):
     time_from_treatment_start = models.IntegerField(null=True, blank=True)  # Allow null for 'healthy' subjects
     subject = models.ForeignKey(Subject, on_delete=models.CASCADE)
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['subject', 'sample_name'], name='unique_sample_per_subject'
+            ),
+        ]
+        # Match the sample_type and time_from_treatment_start filters of QueryData.
+        indexes = [
+            models.Index(
+                fields=['subject', 'sample_type', 'time_from_treatment_start'],
+                name='sample_type_time_idx',
+            ),
+            models.Index(
+                fields=['subject', 'time_from_treatment_start'],
+                name='sample_time_idx',
+                condition=models.Q(time_from_treatment_start__isnull=False),
+            ),
+        ]
+
     def __str__(self):
         return self.sample_name
 
     def total_cell_count(self):
-        return self.cell_set.aggregate(total=Sum('count'))['total'] or None
+        try:
+            return self.summary.total_count
+        except SampleSummary.DoesNotExist:
+            return self.cell_set.aggregate(total=Sum('count'))['total'] or None
     
 
 class Cell(models.Model):
@@ -60,4 +121,127 @@ class Cell(models.Model):
     sample = models.ForeignKey(Sample, on_delete=models.CASCADE)
 
     def __str__(self):
-        return f'{self.type} ({self.count})'
\ No newline at end of file
+        return f'{self.type} ({self.count})'
+
+class SampleSummary(models.Model):
+    '''
+    Denormalized per-sample totals, one row per sample: the count of each
+    population, the total count and each population's relative frequency.
+    Refreshed by the importer whenever it writes cells for a sample, see
+    summaries.refresh_sample_summaries.
+
+    The rows double as a cohort index: they also hold the sample's project,
+    subject attributes, type and time from treatment start, so cohorts can be
+    filtered and grouped in one indexed query without joins (see cohorts.py).
+    '''
+    sample = models.OneToOneField(
+        Sample, on_delete=models.CASCADE, primary_key=True, related_name='summary'
+    )
+    b_cell = models.IntegerField(default=0)
+    cd4_t_cell = models.IntegerField(default=0)
+    cd8_t_cell = models.IntegerField(default=0)
+    nk_cell = models.IntegerField(default=0)
+    monocyte = models.IntegerField(default=0)
+    # Null when the counts add up to 0, as are the frequencies.
+    total_count = models.IntegerField(null=True, blank=True)
+    b_cell_frequency = models.FloatField(null=True, blank=True)
+    cd4_t_cell_frequency = models.FloatField(null=True, blank=True)
+    cd8_t_cell_frequency = models.FloatField(null=True, blank=True)
+    nk_cell_frequency = models.FloatField(null=True, blank=True)
+    monocyte_frequency = models.FloatField(null=True, blank=True)
+
+    # Copied from the sample, its subject and project by save_sample_summaries.
+    project = models.ForeignKey(
+        Project, on_delete=models.CASCADE, null=True, related_name='+'
+    )
+    subject = models.ForeignKey(
+        Subject, on_delete=models.CASCADE, null=True, related_name='+', db_index=False
+    )
+    condition = models.CharField(max_length=255, blank=True, default='')
+    treatment = models.CharField(max_length=255, blank=True, default='')
+    sex = models.CharField(max_length=20, blank=True, default='')
+    age = models.IntegerField(null=True, blank=True)
+    response = models.BooleanField(null=True, blank=True)
+    sample_type = models.CharField(max_length=255, blank=True, default='')
+    time_from_treatment_start = models.IntegerField(null=True, blank=True)
+
+    class Meta:
+        # Baseline (condition, sample type, time 0) and longitudinal
+        # (treatment over time) cohorts, and demographic breakdowns.
+        indexes = [
+            models.Index(
+                fields=['condition', 'sample_type', 'time_from_treatment_start', 'treatment'],
+                name='cohort_baseline_idx',
+            ),
+            models.Index(
+                fields=['treatment', 'sample_type', 'time_from_treatment_start'],
+                name='cohort_treatment_idx',
+            ),
+            models.Index(fields=['sex', 'age'], name='cohort_demographics_idx'),
+        ]
+
+    def __str__(self):
+        return f'Summary of sample {self.sample_id}'
+
+
+class ImportJob(models.Model):
+    '''
+    A CSV upload waiting to be, or being, imported in the background.
+    The table doubles as the queue read by the run_import_worker command.
+    '''
+    STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('succeeded', 'Succeeded'),
+        ('failed', 'Failed'),
+    ]
+    file = models.FileField(upload_to='imports/')
+    file_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    upsert = models.BooleanField(default=True)
+    content_hash = models.CharField(max_length=64, blank=True)
+    rows_processed = models.IntegerField(default=0)
+    project_ids = models.JSONField(default=list)
+    errors = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # Set when the job is claimed and after every chunk: a running job that
+    # has not progressed for IMPORT_JOB_STALE_SECONDS lost its worker.
+    heartbeat_at = models.DateTimeField(null=True, blank=True)
+    user = models.ForeignKey(Scientist, on_delete=models.CASCADE)
+
+    def __str__(self):
+        return f'{self.file_name} ({self.status})'
+
+    def throughput(self):
+        '''
+        Rows imported per second since the job started, or None if it has not.
+        '''
+        if not self.started_at:
+            return None
+        end = self.finished_at or timezone.now()
+        elapsed = (end - self.started_at).total_seconds()
+        return self.rows_processed / elapsed if elapsed else None
+
+
+class ImportedFile(models.Model):
+    '''
+    The SHA-256 content hash of a file that was imported in upsert mode,
+    so uploading the exact same file again can be skipped.
+    '''
+    content_hash = models.CharField(max_length=64)
+    file_name = models.CharField(max_length=255)
+    project_ids = models.JSONField(default=list)
+    imported_at = models.DateTimeField(auto_now_add=True)
+    user = models.ForeignKey(Scientist, on_delete=models.CASCADE)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'content_hash'], name='unique_imported_file_per_user'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.file_name} ({self.content_hash[:12]})'
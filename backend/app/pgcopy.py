@@ -0,0 +1,50 @@
+import csv
+import io
+from django.db import connection
+
+
+def copy_insert(objs, assign_ids=False):
+    '''
+    Insert unsaved model instances of a single model with Postgres
+    COPY FROM STDIN over the current psycopg2 connection.
+    Runs inside whatever transaction the caller has open.
+
+    COPY does not return the generated primary keys, so with assign_ids=True
+    the ids are first reserved from the table's id sequence and written
+    explicitly, and each instance gets its pk set as with bulk_create.
+    '''
+    if not objs:
+        return
+
+    opts = objs[0]._meta
+    quote_name = connection.ops.quote_name
+    fields = [f for f in opts.concrete_fields if not f.primary_key]
+
+    with connection.cursor() as cursor:
+        if assign_ids:
+            cursor.execute(
+                'SELECT nextval(pg_get_serial_sequence(%s, %s)) '
+                'FROM generate_series(1, %s)',
+                [opts.db_table, opts.pk.column, len(objs)],
+            )
+            for obj, (pk,) in zip(objs, cursor.fetchall()):
+                obj.pk = pk
+            fields = [opts.pk] + fields
+
+        # QUOTE_NOTNULL leaves None unquoted, which COPY reads as NULL,
+        # while empty strings are quoted and stay empty strings.
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, quoting=csv.QUOTE_NOTNULL, lineterminator='\n')
+        for obj in objs:
+            writer.writerow([getattr(obj, f.attname) for f in fields])
+        buffer.seek(0)
+
+        columns = ', '.join(quote_name(f.column) for f in fields)
+        cursor.copy_expert(
+            f'COPY {quote_name(opts.db_table)} ({columns}) FROM STDIN WITH (FORMAT csv)',
+            buffer,
+        )
+
+    for obj in objs:
+        obj._state.adding = False
+        obj._state.db = connection.alias
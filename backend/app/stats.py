@@ -0,0 +1,127 @@
+from collections import defaultdict
+from django.db import connection
+from django.db.models import Aggregate, Avg, Count, FloatField, Q
+import pandas
+from .models import CELL_TYPES, SampleSummary
+
+# Subject fields the population stats can be grouped by.
+GROUP_BY_FIELDS = ['response', 'sex', 'condition', 'treatment', 'age']
+
+
+class Median(Aggregate):
+    '''
+    The median of an expression, as an ordered-set aggregate (Postgres only).
+    '''
+
+    function = 'PERCENTILE_CONT'
+    template = '%(function)s(0.5) WITHIN GROUP (ORDER BY %(expressions)s)'
+    output_field = FloatField()
+
+
+def _prefixed(prefix, params):
+    return Q(**{f'{prefix}{lookup}': value for lookup, value in params.items()})
+
+
+def query_stats(projects, subject_params, sample_params):
+    '''
+    Count the subjects and samples of a query in one grouped aggregate query.
+    projects is the filtered Project queryset, subject_params and
+    sample_params the lookups subjects and samples are filtered on.
+
+    Each project is joined to its subjects and their samples, and conditional
+    (FILTER) counts pick out the matching subjects by response and sex, and
+    the matching samples. Subjects are counted distinct, as the join repeats
+    them once per sample. Only one row per project name comes back.
+    '''
+    subject_q = _prefixed('subject__', subject_params)
+    sample_q = subject_q & _prefixed('subject__sample__', sample_params)
+
+    rows = (
+        projects.order_by()
+        .values('project_name')
+        .annotate(
+            subjects=Count('subject', filter=subject_q, distinct=True),
+            responders=Count(
+                'subject', filter=subject_q & Q(subject__response=True), distinct=True
+            ),
+            non_responders=Count(
+                'subject', filter=subject_q & Q(subject__response=False), distinct=True
+            ),
+            males=Count(
+                'subject', filter=subject_q & Q(subject__sex__istartswith='m'), distinct=True
+            ),
+            females=Count(
+                'subject', filter=subject_q & Q(subject__sex__istartswith='f'), distinct=True
+            ),
+            samples=Count('subject__sample', filter=sample_q),
+        )
+    )
+
+    stats = {
+        'responders': 0,
+        'non_responders': 0,
+        'males': 0,
+        'females': 0,
+        'subjects': 0,
+        'samples': 0,
+        'samples_per_project': {},
+    }
+    for row in rows:
+        for name in ['responders', 'non_responders', 'males', 'females', 'subjects', 'samples']:
+            stats[name] += row[name]
+        stats['samples_per_project'][row['project_name']] = row['samples']
+    return stats
+
+
+def population_stats(samples, group_by):
+    '''
+    The number of samples and the mean and median relative frequency of each
+    population, per value of the subject field group_by, for the given Sample
+    queryset. Frequencies come from SampleSummary.
+
+    Means are aggregated in the database. Medians too on Postgres, elsewhere
+    they are computed with pandas from the frequencies alone.
+    Returns a list of {'group', 'samples', 'populations'} dicts ordered by group.
+    '''
+    if group_by not in GROUP_BY_FIELDS:
+        raise ValueError(f'group_by must be one of {", ".join(GROUP_BY_FIELDS)}')
+
+    field = f'sample__subject__{group_by}'
+    frequencies = [f'{cell_type}_frequency' for cell_type in CELL_TYPES]
+    summaries = SampleSummary.objects.filter(sample__in=samples).order_by()
+
+    aggregates = {f'{name}_mean': Avg(name) for name in frequencies}
+    database_medians = connection.vendor == 'postgresql'
+    if database_medians:
+        aggregates.update({f'{name}_median': Median(name) for name in frequencies})
+    rows = list(
+        summaries.values(field).annotate(samples=Count('sample'), **aggregates).order_by(field)
+    )
+
+    if not database_medians:
+        groups = defaultdict(list)
+        for group, *values in summaries.values_list(field, *frequencies):
+            groups[group].append(values)
+        for row in rows:
+            medians = pandas.DataFrame(
+                groups[row[field]], columns=frequencies, dtype=float
+            ).median()
+            for name in frequencies:
+                row[f'{name}_median'] = (
+                    None if pandas.isna(medians[name]) else float(medians[name])
+                )
+
+    return [
+        {
+            'group': row[field],
+            'samples': row['samples'],
+            'populations': {
+                cell_type: {
+                    'mean': row[f'{cell_type}_frequency_mean'],
+                    'median': row[f'{cell_type}_frequency_median'],
+                }
+                for cell_type in CELL_TYPES
+            },
+        }
+        for row in rows
+    ]
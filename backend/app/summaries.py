@@ -0,0 +1,94 @@
+from django.db.models import Q, Sum
+from .models import CELL_TYPES, Cell, Sample, SampleSummary
+
+# SampleSummary columns rewritten by refresh_sample_summaries.
+SUMMARY_FIELDS = (
+    CELL_TYPES
+    + ['total_count']
+    + [f'{cell_type}_frequency' for cell_type in CELL_TYPES]
+)
+
+
+# SampleSummary cohort columns and the Sample lookups they are copied from.
+COHORT_FIELDS = {
+    'project_id': 'subject__project_id',
+    'subject_id': 'subject_id',
+    'condition': 'subject__condition',
+    'treatment': 'subject__treatment',
+    'sex': 'subject__sex',
+    'age': 'subject__age',
+    'response': 'subject__response',
+    'sample_type': 'sample_type',
+    'time_from_treatment_start': 'time_from_treatment_start',
+}
+
+
+def summarize_counts(sample_id, counts):
+    '''
+    Build the SampleSummary of a sample from a dict of counts per population.
+    '''
+    total = sum(counts.values()) or None
+    summary = SampleSummary(sample_id=sample_id, total_count=total)
+    for cell_type in CELL_TYPES:
+        setattr(summary, cell_type, counts[cell_type])
+        setattr(
+            summary,
+            f'{cell_type}_frequency',
+            counts[cell_type] / total if total else None,
+        )
+    return summary
+
+
+def refresh_sample_summaries(sample_ids, batch_size=5000):
+    '''
+    Recompute the SampleSummary rows of the given samples from their Cell rows,
+    batch_size samples at a time: one grouped query and one upsert per batch.
+    '''
+    sample_ids = list(sample_ids)
+    per_type = {
+        cell_type: Sum('count', filter=Q(type=cell_type), default=0)
+        for cell_type in CELL_TYPES
+    }
+    for i in range(0, len(sample_ids), batch_size):
+        rows = (
+            Cell.objects.filter(sample_id__in=sample_ids[i:i + batch_size])
+            .values('sample_id')
+            .annotate(**per_type)
+            .order_by()
+        )
+        save_sample_summaries(
+            summarize_counts(row['sample_id'], {t: row[t] for t in CELL_TYPES})
+            for row in rows
+        )
+
+
+def fill_cohort_fields(summaries):
+    '''
+    Copy the cohort columns of the SampleSummary instances from their samples,
+    subjects and projects, with one query.
+    '''
+    rows = Sample.objects.filter(
+        id__in=[summary.sample_id for summary in summaries]
+    ).values('id', *COHORT_FIELDS.values())
+    by_sample = {row['id']: row for row in rows}
+    for summary in summaries:
+        row = by_sample[summary.sample_id]
+        for name, lookup in COHORT_FIELDS.items():
+            setattr(summary, name, row[lookup])
+
+
+def save_sample_summaries(summaries, batch_size=5000):
+    '''
+    Insert the SampleSummary instances, overwriting existing summaries
+    of the same samples. Their cohort columns are filled in first.
+    '''
+    summaries = list(summaries)
+    for i in range(0, len(summaries), batch_size):
+        fill_cohort_fields(summaries[i:i + batch_size])
+    SampleSummary.objects.bulk_create(
+        summaries,
+        batch_size=batch_size,
+        update_conflicts=True,
+        unique_fields=['sample'],
+        update_fields=SUMMARY_FIELDS + list(COHORT_FIELDS),
+    )
@@ -0,0 +1,1211 @@
+import gzip
+import io
+import re
+import tempfile
+from datetime import timedelta
+from unittest import mock
+import numpy
+import pandas
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile, TemporaryUploadedFile
+from django.core.management import call_command
+from django.core.signals import request_started
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from program.metrics import QueryBudgetExceeded
+from . import views
+from .analysis import benjamini_hochberg, mann_whitney, welch_t
+from .cache import cached_body
+from .cells import EXPORT_FIELDS
+from .charts import binned_stats, box_stats, time_bins
+from .encoding import accepted_encoding, columns, compress, content_encodings, dumps
+from .export import EXPORT_CONTENT_TYPES, aiterate
+from .importer import (
+    COL_SPEC,
+    normalize_chunk,
+    read_arrow_chunks,
+    read_chunks,
+    read_normalized_chunks,
+    shard_offsets,
+)
+from .jobs import (
+    RECOVERY_UID,
+    claim_job,
+    fail_stale_jobs,
+    recover_on_first_request,
+    run_import_job,
+)
+from .models import (
+    CELL_TYPES,
+    Cell,
+    ImportJob,
+    ImportedFile,
+    Project,
+    Sample,
+    SampleSummary,
+    Scientist,
+    Subject,
+)
+from .summaries import COHORT_FIELDS
+
+# Tests run against SQLite, e.g. from backend/:
+#   DATABASE_ENGINE=sqlite3 IMPORT_ASYNC=false python manage.py test app
+
+CSV_HEADER = (
+    'project,subject,condition,age,sex,treatment,response,sample,sample_type,'
+    'time_from_treatment_start,b_cell,cd4_t_cell,cd8_t_cell,nk_cell,monocyte\n'
+)
+
+
+def scientist():
+    return Scientist.objects.get_or_create(
+        name='Bob Loblaw', email='b@company.com', company='Loblaw Bio'
+    )[0]
+
+
+@override_settings(MEDIA_ROOT=tempfile.mkdtemp())
+class ImportJobTests(TestCase):
+    def job(self, content, **fields):
+        return ImportJob.objects.create(
+            file=ContentFile(content, name='upload.csv'),
+            file_name='upload.csv',
+            user=scientist(),
+            **fields,
+        )
+
+    def test_upload_deleted_when_job_succeeds(self):
+        job = self.job(CSV_HEADER + 'prj1,sbj1,melanoma,40,M,tr1,yes,s1,PBMC,0,1,2,3,4,5\n')
+        storage, name = job.file.storage, job.file.name
+        self.assertTrue(claim_job(job.id))
+        run_import_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'succeeded')
+        self.assertEqual(job.rows_processed, 1)
+        self.assertFalse(storage.exists(name))
+
+    def test_upload_deleted_when_job_fails(self):
+        job = self.job('project,subject\nprj1,sbj1\n')
+        storage, name = job.file.storage, job.file.name
+        self.assertTrue(claim_job(job.id))
+        run_import_job(job.id)
+
+        job.refresh_from_db()
+        self.assertEqual(job.status, 'failed')
+        self.assertEqual(job.errors[-1]['reason'], 'CSV file is missing required columns')
+        self.assertFalse(job.file)
+        self.assertFalse(storage.exists(name))
+
+    def test_job_claimed_once(self):
+        job = self.job(CSV_HEADER)
+        self.assertTrue(claim_job(job.id))
+        self.assertFalse(claim_job(job.id))
+
+    @override_settings(IMPORT_JOB_STALE_SECONDS=60)
+    def test_stale_running_job_failed(self):
+        stale = self.job(CSV_HEADER, status='running')
+        stale.heartbeat_at = timezone.now() - timedelta(seconds=120)
+        stale.save()
+        live = self.job(CSV_HEADER, status='running', heartbeat_at=timezone.now())
+        queued = self.job(CSV_HEADER)
+        storage, name = stale.file.storage, stale.file.name
+
+        self.assertEqual(fail_stale_jobs(), 1)
+        stale.refresh_from_db()
+        self.assertEqual(stale.status, 'failed')
+        self.assertIsNotNone(stale.finished_at)
+        self.assertFalse(storage.exists(name))
+        self.assertEqual(ImportJob.objects.get(id=live.id).status, 'running')
+        self.assertEqual(ImportJob.objects.get(id=queued.id).status, 'queued')
+
+    @override_settings(IMPORT_JOB_STALE_SECONDS=60)
+    def test_job_view_reports_lost_job_failed(self):
+        job = self.job(CSV_HEADER, status='running')
+        response = self.client.get(f'/api/import/{job.id}')
+        self.assertEqual(response.json()['job']['status'], 'failed')
+
+    @override_settings(IMPORT_JOB_STALE_SECONDS=60, IMPORT_ASYNC=False)
+    def test_jobs_recovered_on_first_request(self):
+        job = self.job(CSV_HEADER, status='running')
+        job.heartbeat_at = timezone.now() - timedelta(seconds=120)
+        job.save()
+        request_started.connect(recover_on_first_request, dispatch_uid=RECOVERY_UID)
+        self.client.get('/ping/')
+        self.assertEqual(ImportJob.objects.get(id=job.id).status, 'failed')
+        # Only once per process.
+        self.assertFalse(request_started.disconnect(dispatch_uid=RECOVERY_UID))
+
+
+def read_csv_text(text, chunk_size=None):
+    return list(read_chunks(io.BytesIO((CSV_HEADER + text).encode()), chunk_size))
+
+
+class NormalizeChunkTests(TestCase):
+    def normalize(self, text):
+        [chunk] = read_csv_text(text)
+        return normalize_chunk(chunk)
+
+    def test_values_normalized(self):
+        rows, errors = self.normalize(
+            'prj1,sbj1,melanoma,40,M,tr1, Yes ,s1,PBMC,7,1,2,3,4,5\n'
+            'prj1,sbj2,healthy,35,F,None,,s2,tumor,,0,0,0,0,0\n'
+            'prj1,sbj3,melanoma,61,F,tr2,n,s3,PBMC,abc,6,7,8,9,10\n'
+        )
+        self.assertEqual(len(errors), 0)
+        self.assertEqual(list(rows.columns), COL_SPEC)
+        self.assertEqual(rows['response'].tolist(), [True, pandas.NA, False])
+        self.assertEqual(rows['time_from_treatment_start'].tolist(), [7, pandas.NA, pandas.NA])
+        self.assertEqual(rows['age'].tolist(), [40, 35, 61])
+        # Only empty cells are missing, 'None' is a treatment like any other.
+        self.assertEqual(rows['treatment'].tolist(), ['tr1', 'None', 'tr2'])
+        self.assertEqual(rows['condition'].tolist(), ['melanoma', 'healthy', 'melanoma'])
+        self.assertEqual(rows['monocyte'].tolist(), [5, 0, 10])
+
+    def test_invalid_rows_reported(self):
+        rows, errors = self.normalize(
+            'prj1,sbj1,melanoma,40,M,tr1,yes,s1,PBMC,0,1,2,3,4,5\n'
+            'prj1,sbj2,melanoma,,M,tr1,yes,s2,PBMC,0,1,2,3,4,5\n'
+            'prj1,sbj3,melanoma,40,M,tr1,yes,s3,PBMC,0,-1,2,x,4,5\n'
+            'prj1,sbj4,melanoma,40,M,tr1,yes,,PBMC,0,1,2,3,4,5\n'
+        )
+        self.assertEqual(rows['sample'].tolist(), ['s1'])
+        self.assertEqual(
+            errors.to_dict('records'),
+            [
+                {'row': 1, 'reason': 'age is not an integer'},
+                {'row': 2, 'reason': 'b_cell is not a non-negative integer'},
+                {'row': 2, 'reason': 'cd8_t_cell is not a non-negative integer'},
+                {'row': 3, 'reason': 'sample is missing'},
+            ],
+        )
+
+    def test_rows_numbered_across_chunks(self):
+        chunks = read_csv_text(
+            'prj1,sbj1,melanoma,40,M,tr1,yes,s1,PBMC,0,1,2,3,4,5\n'
+            'prj1,sbj2,melanoma,40,M,tr1,yes,s2,PBMC,0,1,2,3,4,5\n'
+            'prj1,sbj3,melanoma,x,M,tr1,yes,s3,PBMC,0,1,2,3,4,5\n',
+            chunk_size=2,
+        )
+        self.assertEqual([len(chunk) for chunk in chunks], [2, 1])
+        _, errors = normalize_chunk(chunks[1])
+        self.assertEqual(errors['row'].tolist(), [2])
+
+
+# Natural keys that look like numbers, with leading zeros, and a row without
+# a subject (rejected) that makes the column have a blank.
+NUMERIC_KEY_ROWS = (
+    '101,101,melanoma,40,M,tr1,1,01,PBMC,0,1,2,3,4,5\n'
+    '101,007,melanoma,50,F,tr1,0,1,PBMC,0,1,2,3,4,5\n'
+    '101,,melanoma,50,F,tr1,0,2,PBMC,0,1,2,3,4,5\n'
+)
+
+
+def upload(client, text, mode='upsert'):
+    '''
+    Import CSV rows through POST /api/import (with IMPORT_ASYNC off).
+    '''
+    file = SimpleUploadedFile('cells.csv', (CSV_HEADER + text).encode())
+    return client.post('/api/import', {'file': file, 'mode': mode}).json()
+
+
+@override_settings(IMPORT_ASYNC=False)
+class ImportColumnTests(TestCase):
+    def post(self, name, content):
+        return self.client.post('/api/import', {'file': SimpleUploadedFile(name, content)})
+
+    def test_missing_columns_rejected(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        buffer = io.BytesIO()
+        pyarrow.parquet.write_table(pyarrow.table({'project': ['prj1']}), buffer)
+        for name, content in [
+            ('cells.csv', b'project,subject\nprj1,sbj1\n'),
+            ('cells.csv', b''),
+            ('cells.parquet', buffer.getvalue()),
+        ]:
+            response = self.post(name, content)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['message'], 'CSV file is missing required columns')
+
+    @override_settings(IMPORT_ASYNC=True)
+    def test_missing_columns_not_queued(self):
+        response = self.post('cells.csv', b'project,subject\nprj1,sbj1\n')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(ImportJob.objects.exists())
+
+    def test_other_errors_propagate(self):
+        with mock.patch('app.views.ImportEngine.run', side_effect=KeyError('bug')):
+            with self.assertRaises(KeyError):
+                self.post('cells.csv', (CSV_HEADER + PROJECT_ROWS).encode())
+        self.assertFalse(Subject.objects.exists())
+
+
+# Rows with quoted fields (with commas and quotes), invalid rows, and a last
+# line without a newline.
+SHARD_ROWS = (
+    ''.join(
+        f'prj1,sbj{i},"melanoma, stage {i % 3}",{40 + i},F,"tr ""{i}""",yes,s{i},PBMC,'
+        f'{i},{i},2,3,4,5\n'
+        if i % 7
+        else f'prj1,sbj{i},melanoma,old,F,tr1,yes,s{i},PBMC,0,-1,2,3,4,5\n'
+        for i in range(60)
+    )
+    + 'prj1,sbj60,melanoma,40,M,tr1,no,s60,PBMC,0,1,2,3,4,5'
+)
+
+
+class ShardedReadTests(TestCase):
+    def read(self, text, **settings):
+        file = TemporaryUploadedFile('cells.csv', 'text/csv', len(text), 'utf-8')
+        file.write(text.encode())
+        file.seek(0)
+        with override_settings(**settings):
+            chunks = list(read_normalized_chunks(file))
+        file.close()
+        return (
+            pandas.concat([rows for rows, _ in chunks]),
+            pandas.concat([errors for _, errors in chunks], ignore_index=True),
+            len(chunks),
+        )
+
+    def test_shards_start_at_lines(self):
+        with tempfile.NamedTemporaryFile(suffix='.csv') as file:
+            file.write((CSV_HEADER + SHARD_ROWS).encode())
+            file.flush()
+            header, offsets = shard_offsets(file.name, 100)
+            file.seek(0)
+            data = file.read()
+
+        self.assertEqual(header, CSV_HEADER.encode())
+        self.assertEqual(offsets[0][0], len(header))
+        self.assertEqual(offsets[-1][1], len(data))
+        for (_, end), (start, _) in zip(offsets, offsets[1:]):
+            self.assertEqual(end, start)
+            self.assertEqual(data[start - 1:start], b'\n')
+
+    def test_parallel_read_matches_sequential(self):
+        rows, errors, chunk_count = self.read(
+            CSV_HEADER + SHARD_ROWS, IMPORT_PARSE_WORKERS=1, IMPORT_CHUNK_SIZE=1000
+        )
+        self.assertEqual(chunk_count, 1)
+        # Shards of 100 bytes end in the middle of a line, and are moved
+        # forward to the next one.
+        shard_rows, shard_errors, shard_count = self.read(
+            CSV_HEADER + SHARD_ROWS,
+            IMPORT_PARSE_WORKERS=2,
+            IMPORT_PARALLEL_MIN_BYTES=0,
+            IMPORT_SHARD_BYTES=100,
+        )
+        self.assertGreater(shard_count, 10)
+
+        self.assertEqual(len(rows), 52)
+        self.assertEqual(rows.loc[1, 'condition'], 'melanoma, stage 1')
+        self.assertEqual(rows.loc[1, 'treatment'], 'tr "1"')
+        self.assertEqual(rows.index[-1], 60)
+        # Two errors (age and b_cell) for every seventh row.
+        self.assertEqual(errors['row'].tolist(), sorted(list(range(0, 60, 7)) * 2))
+        pandas.testing.assert_frame_equal(shard_rows, rows)
+        pandas.testing.assert_frame_equal(shard_errors, errors)
+
+
+@override_settings(IMPORT_ASYNC=False)
+class UpsertImportTests(TestCase):
+    def upload(self, text, mode='upsert'):
+        return upload(self.client, text, mode)
+
+    def test_natural_keys_read_as_written(self):
+        [chunk] = read_csv_text(NUMERIC_KEY_ROWS)
+        rows, errors = normalize_chunk(chunk)
+        self.assertEqual(rows['project'].tolist(), ['101', '101'])
+        self.assertEqual(rows['subject'].tolist(), ['101', '007'])
+        self.assertEqual(rows['sample'].tolist(), ['01', '1'])
+        self.assertEqual(rows['response'].tolist(), [True, False])
+        self.assertEqual(errors.to_dict('records'), [{'row': 2, 'reason': 'subject is missing'}])
+
+    def test_arrow_natural_keys_read_as_written(self):
+        import pyarrow
+        import pyarrow.parquet
+
+        table = pyarrow.table(
+            {
+                column: [None, 7] if column == 'subject' else [101, 101]
+                for column in COL_SPEC
+            }
+        )
+        buffer = io.BytesIO()
+        pyarrow.parquet.write_table(table, buffer)
+        buffer.seek(0)
+        buffer.name = 'cells.parquet'
+        [chunk] = read_arrow_chunks(buffer)
+        rows, errors = normalize_chunk(chunk)
+        self.assertEqual(rows['subject'].tolist(), ['7'])
+        self.assertEqual(rows['sample'].tolist(), ['101'])
+        self.assertEqual(errors.to_dict('records'), [{'row': 0, 'reason': 'subject is missing'}])
+
+    def test_same_file_skipped(self):
+        first = self.upload(NUMERIC_KEY_ROWS)
+        self.assertEqual(first['error_count'], 1)
+        again = self.upload(NUMERIC_KEY_ROWS)
+        self.assertTrue(again['unchanged'])
+        self.assertEqual(again['project_ids'], first['project_ids'])
+        self.assertEqual(ImportedFile.objects.count(), 1)
+        self.assertEqual(Sample.objects.count(), 2)
+
+    def test_appended_file_adds_new_rows_only(self):
+        first = self.upload(NUMERIC_KEY_ROWS)
+        second = self.upload(
+            NUMERIC_KEY_ROWS + '101,007,melanoma,50,F,tr1,0,3,PBMC,7,1,2,3,4,5\n'
+        )
+        self.assertEqual(second['project_ids'], first['project_ids'])
+        self.assertEqual(
+            sorted(Subject.objects.values_list('subject_name', flat=True)), ['007', '101']
+        )
+        self.assertEqual(
+            sorted(Sample.objects.values_list('sample_name', flat=True)), ['01', '1', '3']
+        )
+        self.assertEqual(Cell.objects.count(), 3 * 5)
+
+    def test_append_mode_creates_new_projects(self):
+        first = self.upload(NUMERIC_KEY_ROWS, mode='append')
+        second = self.upload(NUMERIC_KEY_ROWS, mode='append')
+        self.assertNotEqual(first['project_ids'], second['project_ids'])
+        self.assertEqual(Sample.objects.count(), 4)
+
+    def test_subject_names_scoped_to_project(self):
+        rows = (
+            'prj1,sbj1,melanoma,40,M,tr1,yes,s1,PBMC,0,1,2,3,4,5\n'
+            'prj2,sbj1,healthy,60,F,none,no,s1,PBMC,0,6,7,8,9,10\n'
+        )
+        first = self.upload(rows)
+        second = self.upload(rows + 'prj2,sbj1,healthy,60,F,none,no,s2,PBMC,7,1,1,1,1,1\n')
+        self.assertEqual(second['project_ids'], first['project_ids'])
+
+        subjects = Subject.objects.order_by('project__project_name')
+        self.assertEqual(
+            [(s.project.project_name, s.subject_name, s.age) for s in subjects],
+            [('prj1', 'sbj1', 40), ('prj2', 'sbj1', 60)],
+        )
+        self.assertEqual(
+            sorted(
+                Sample.objects.values_list(
+                    'subject__project__project_name', 'sample_name'
+                )
+            ),
+            [('prj1', 's1'), ('prj2', 's1'), ('prj2', 's2')],
+        )
+        self.assertEqual(
+            sorted(
+                Cell.objects.filter(type='b_cell').values_list(
+                    'sample__subject__project__project_name', 'count'
+                )
+            ),
+            [('prj1', 1), ('prj2', 1), ('prj2', 6)],
+        )
+
+
+# Two subjects per response group with two samples each, in one project.
+PROJECT_ROWS = ''.join(
+    f'prj1,sbj{subject},melanoma,{40 + subject},{"MF"[subject % 2]},tr1,'
+    f'{"yes" if subject < 2 else "no"},s{subject}{visit},PBMC,{visit * 7},'
+    f'{10 + subject},{20 + visit},30,40,{50 + subject * visit}\n'
+    for subject in range(4)
+    for visit in range(2)
+)
+
+
+@override_settings(IMPORT_ASYNC=False)
+class ConditionalResultsTests(TestCase):
+    def setUp(self):
+        [self.project_id] = upload(self.client, PROJECT_ROWS)['project_ids']
+
+    def test_unchanged_project_revalidated(self):
+        for i, url in enumerate([
+            f'/api/results/{self.project_id}/',
+            f'/api/results/{self.project_id}/analysis',
+            f'/api/results/{self.project_id}/charts',
+        ]):
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            etag = response['ETag']
+            self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+            upload(self.client, PROJECT_ROWS.replace('s0', f'new{i}-'))
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response['ETag'], etag)
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_BYTES=0)
+    def test_etag_per_content_encoding(self):
+        url = f'/api/results/{self.project_id}/'
+        etags = {}
+        for encoding in [None, *content_encodings()]:
+            headers = {'HTTP_ACCEPT_ENCODING': encoding} if encoding else {}
+            response = self.client.get(url, **headers)
+            self.assertEqual(response.get('Content-Encoding'), encoding)
+            self.assertIn('Accept-Encoding', response['Vary'])
+            etags[encoding] = response['ETag']
+
+            # The variant the client holds is revalidated, in any encoding.
+            for held in [response['ETag'], 'W/' + response['ETag']]:
+                response = self.client.get(url, HTTP_IF_NONE_MATCH=held, **headers)
+                self.assertEqual(response.status_code, 304)
+                self.assertEqual(response['ETag'], etags[encoding])
+                self.assertIn('Accept-Encoding', response['Vary'])
+
+        self.assertEqual(len(set(etags.values())), len(etags))
+        self.assertTrue(etags['gzip'].endswith('-gzip"'))
+        self.assertEqual(etags['gzip'], etags[None][:-1] + '-gzip"')
+
+        upload(self.client, PROJECT_ROWS.replace('s0', 'new-'))
+        response = self.client.get(
+            url, HTTP_IF_NONE_MATCH=etags['gzip'], HTTP_ACCEPT_ENCODING='gzip'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etags['gzip'])
+
+    def test_invalid_project_id_not_found(self):
+        for url in ['/api/results/abc/', '/api/results/abc/analysis', '/api/results/abc/charts']:
+            self.assertEqual(self.client.get(url).status_code, 404)
+
+    def test_missing_project_not_found(self):
+        for url in ['/api/results/999/', '/api/results/999/analysis', '/api/results/999/charts']:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 404)
+            self.assertEqual(response.json()['message'], 'Project not found')
+            self.assertFalse(response.has_header('ETag'))
+
+    def test_errors_not_stamped(self):
+        for url, params in [
+            (f'/api/results/{self.project_id}/', {'layout': 'wide'}),
+            (f'/api/results/{self.project_id}/charts', {'bins': 0}),
+        ]:
+            response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 400)
+            self.assertFalse(response.has_header('ETag'))
+            self.assertFalse(response.has_header('Last-Modified'))
+
+
+
+@override_settings(RESPONSE_COMPRESSION_MIN_BYTES=10, CACHE_MAX_BODY_BYTES=100)
+class CachedBodyTests(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_small_bodies_cached(self):
+        build = mock.Mock(return_value={'data': 'x' * 50})
+        for encoding in [None, 'gzip']:
+            first = cached_body('small', build, encoding)
+            self.assertEqual(cached_body('small', build, encoding), first)
+        self.assertEqual(build.call_count, 1)
+
+    def test_large_bodies_not_cached(self):
+        build = mock.Mock(return_value={'data': 'x' * 200})
+        body, _ = cached_body('large', build)
+        self.assertEqual(cached_body('large', build), (body, None))
+        self.assertEqual(build.call_count, 2)
+        self.assertIsNone(cache.get('large'))
+
+    def test_compressed_size_counts(self):
+        # Too large to cache as is, but small once compressed.
+        build = mock.Mock(return_value={'data': 'x' * 200})
+        body, encoding = cached_body('large', build, 'gzip')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(cache.get('large:gzip'), body)
+        self.assertIsNone(cache.get('large'))
+
+
+class EncodingTests(TestCase):
+    def accepted(self, header):
+        request = RequestFactory().get('/', HTTP_ACCEPT_ENCODING=header)
+        return accepted_encoding(request)
+
+    def test_columns(self):
+        self.assertEqual(
+            columns(['id', 'name'], [(1, 'a'), (2, 'b')]),
+            {'id': [1, 2], 'name': ['a', 'b']},
+        )
+        self.assertEqual(columns(['id', 'name'], iter([])), {'id': [], 'name': []})
+
+    def test_negotiation(self):
+        with mock.patch('app.encoding.brotli', object()):
+            for header, expected in [
+                ('gzip, deflate, br', 'br'),
+                ('gzip', 'gzip'),
+                ('br;q=0, gzip', 'gzip'),
+                ('gzip;q=0', None),
+                ('gzip;q=0.0, br;q=0', None),
+                ('gzip;q=0.5', 'gzip'),
+                ('GZIP ; q=1', 'gzip'),
+                ('gzip;q=x', None),
+                ('*', 'br'),
+                ('identity', None),
+                ('', None),
+            ]:
+                self.assertEqual(self.accepted(header), expected, header)
+
+    def test_gzip_without_brotli(self):
+        with mock.patch('app.encoding.brotli', None):
+            self.assertEqual(content_encodings(), ['gzip'])
+            self.assertEqual(self.accepted('br, gzip'), 'gzip')
+            self.assertEqual(self.accepted('br'), None)
+            self.assertEqual(self.accepted('*'), 'gzip')
+
+    @override_settings(RESPONSE_COMPRESSION=False)
+    def test_compression_disabled(self):
+        self.assertIsNone(self.accepted('gzip, br'))
+
+    @override_settings(RESPONSE_COMPRESSION_MIN_BYTES=100)
+    def test_compression_threshold(self):
+        cache.clear()
+        small = mock.Mock(return_value={'data': 'x' * 10})
+        large = mock.Mock(return_value={'data': 'x' * 200})
+        self.assertEqual(cached_body('small', small, 'gzip'), (dumps(small()), None))
+        body, encoding = cached_body('large', large, 'gzip')
+        self.assertEqual(encoding, 'gzip')
+        self.assertEqual(gzip.decompress(body), dumps(large()))
+        self.assertEqual(body, compress(dumps(large()), 'gzip'))
+
+@override_settings(IMPORT_ASYNC=False, RESULTS_MAX_PAGE_SIZE=10)
+class PaginationTests(TestCase):
+    def setUp(self):
+        [self.project_id] = upload(self.client, PROJECT_ROWS)['project_ids']
+
+    def pages(self, url, page_size, results):
+        '''
+        Follow next_cursor from the first page to the last, returning the
+        rows of every page and the page objects.
+        '''
+        params, pages, items = {'page_size': page_size}, [], []
+        while True:
+            rows, page = results(self.client.get(url, params).json())
+            pages.append(page)
+            items += rows
+            if page['next_cursor'] is None:
+                return items, pages
+            params['cursor'] = page['next_cursor']
+
+    def test_project_pages(self):
+        url = f'/api/results/{self.project_id}/'
+        everything = self.client.get(url).json()['project_data']['samples']
+        self.assertEqual(len(everything), 8 * 5)
+
+        rows, pages = self.pages(url, 7, lambda data: (data['project_data']['samples'], data['page']))
+        self.assertEqual(rows, everything)
+        self.assertEqual(len(pages), 6)
+        self.assertEqual({page['total'] for page in pages}, {40})
+        self.assertEqual(
+            [page['cursor'] for page in pages[1:]], [page['next_cursor'] for page in pages[:-1]]
+        )
+
+    def test_query_pages(self):
+        url = '/api/results/filter'
+        everything = self.client.get(url).json()['results']['query_results']['samples']
+        self.assertEqual(len(everything), 8)
+
+        rows, pages = self.pages(
+            url,
+            3,
+            lambda data: (data['results']['query_results']['samples'], data['results']['page']),
+        )
+        self.assertEqual([row['id'] for row in rows], [row['id'] for row in everything])
+        self.assertEqual(len(pages), 3)
+        self.assertEqual({page['total'] for page in pages}, {8})
+
+    def test_page_size_capped(self):
+        for url in [f'/api/results/{self.project_id}/', '/api/results/filter']:
+            response = self.client.get(url, {'page_size': 11})
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response.json()['message'], 'page_size must be between 1 and 10')
+            self.assertEqual(self.client.get(url, {'cursor': 'x'}).status_code, 400)
+            self.assertEqual(self.client.get(url, {'page_size': 10}).status_code, 200)
+
+
+def without_cell_ids(data):
+    '''
+    A results payload without the ids of its cell rows and the page cursors
+    (made of them), which differ between the row and wide layouts.
+    '''
+    data = dict(data)
+    data['project_data'] = dict(
+        data['project_data'],
+        samples=[{**row, 'id': None} for row in data['project_data']['samples']],
+    )
+    data.pop('page', None)
+    return data
+
+
+@override_settings(IMPORT_ASYNC=False)
+class CellStorageTests(TestCase):
+    def summaries(self):
+        return sorted(SampleSummary.objects.values_list('sample__sample_name', *CELL_TYPES))
+
+    def cells(self):
+        return sorted(Cell.objects.values_list('sample_id', 'type', 'count'))
+
+    def test_migrate_round_trip(self):
+        upload(self.client, PROJECT_ROWS)
+        cells, summaries = self.cells(), self.summaries()
+        self.assertEqual(len(cells), 8 * 5)
+
+        call_command('migrate_cell_storage', to='wide', stdout=io.StringIO())
+        self.assertFalse(Cell.objects.exists())
+        self.assertEqual(self.summaries(), summaries)
+
+        call_command('migrate_cell_storage', to='rows', stdout=io.StringIO())
+        self.assertEqual(self.cells(), cells)
+        self.assertEqual(self.summaries(), summaries)
+
+    @override_settings(IMPORT_CHUNK_SIZE=2)
+    def test_wide_counts_added_across_chunks(self):
+        # The rows of s00 are in the first, third and last chunks.
+        rows = (
+            PROJECT_ROWS[: PROJECT_ROWS.index('prj1,sbj1')]
+            + 'prj1,sbj0,melanoma,40,M,tr1,yes,s00,PBMC,0,1,1,1,1,1\n'
+            + PROJECT_ROWS[PROJECT_ROWS.index('prj1,sbj1'):]
+            + 'prj1,sbj0,melanoma,40,M,tr1,yes,s00,PBMC,0,2,0,0,0,3\n'
+        )
+        upload(self.client, rows, 'append')
+        summaries = self.summaries()
+        self.assertEqual(summaries[0], ('s00', 13, 21, 31, 41, 54))
+
+        Project.objects.all().delete()
+        with override_settings(CELL_STORAGE='wide'):
+            upload(self.client, rows, 'append')
+        self.assertFalse(Cell.objects.exists())
+        self.assertEqual(self.summaries(), summaries)
+
+    def payloads(self, project_id):
+        cache.clear()
+        url = f'/api/results/{project_id}/'
+        export = self.client.get('/api/results/export', {'format': 'csv'})
+        return {
+            'project': without_cell_ids(self.client.get(url).json()),
+            'pages': [
+                without_cell_ids(self.client.get(url, {'page_size': 7}).json()),
+                self.client.get(url, {'page_size': 7}).json()['page']['total'],
+            ],
+            'query': self.client.get('/api/results/filter').json(),
+            'query_page': self.client.get('/api/results/filter', {'page_size': 3}).json(),
+            'export': b''.join(export.streaming_content).decode(),
+        }
+
+    def test_same_payloads_in_both_layouts(self):
+        [project_id] = upload(self.client, PROJECT_ROWS)['project_ids']
+        rows = self.payloads(project_id)
+        self.assertEqual(len(rows['project']['project_data']['samples']), 8 * 5)
+        self.assertEqual(rows['pages'][1], 8 * 5)
+        self.assertEqual(len(rows['export'].splitlines()), 1 + 8 * 5)
+
+        call_command('migrate_cell_storage', to='wide', stdout=io.StringIO())
+        with override_settings(CELL_STORAGE='wide'):
+            wide = self.payloads(project_id)
+        self.assertEqual(wide, rows)
+
+
+
+class FilterKeyTests(TestCase):
+    def key(self, query):
+        request = RequestFactory().get(f'/api/results/filter?{query}')
+        query_data = views._query_data(request, scientist())
+        query_data.build_querysets()
+        return query_data.filter_key()
+
+    def test_same_filters_share_key(self):
+        for first, second in [
+            ('condition=melanoma&sex=M&age=40', 'age=40&sex=M&condition=melanoma'),
+            ('age=40', 'age_operator=eq&age=040'),
+            (
+                'time_from_treatment_start=7&sample_type=PBMC',
+                'sample_type=PBMC&time_from_treatment_start=07',
+            ),
+            ('', 'time_operator=gt'),
+            ('', 'page_size=10&layout=columns'),
+        ]:
+            self.assertEqual(self.key(first), self.key(second), (first, second))
+
+    def test_different_filters_do_not_collide(self):
+        queries = [
+            '',
+            'condition=melanoma',
+            'treatment=melanoma',
+            'project=melanoma',
+            'sample_type=melanoma',
+            'age=40',
+            'age_operator=gt&age=40',
+            'age_operator=lt&age=40',
+            'age=41',
+            'time_from_treatment_start=40',
+            'time_operator=gt&time_from_treatment_start=40',
+            'condition=melanoma&sex=M',
+        ]
+        keys = [self.key(query) for query in queries]
+        self.assertEqual(len(set(keys)), len(queries))
+
+
+def export_frame(rows, samples):
+    '''
+    The rows the export should have for CSV text, one per sample and
+    population, in the order they were imported; samples maps the sample
+    names to their ids.
+    '''
+    records = []
+    for line in rows.splitlines():
+        values = dict(zip(COL_SPEC, line.split(',')))
+        counts = [int(values[cell_type]) for cell_type in CELL_TYPES]
+        for cell_type, count in zip(CELL_TYPES, counts):
+            records.append(
+                [
+                    values['project'],
+                    values['subject'],
+                    values['condition'],
+                    int(values['age']),
+                    values['sex'],
+                    values['treatment'],
+                    values['response'] == 'yes',
+                    samples[values['sample']],
+                    values['sample'],
+                    values['sample_type'],
+                    int(values['time_from_treatment_start']),
+                    sum(counts),
+                    cell_type,
+                    count,
+                    count / sum(counts),
+                ]
+            )
+    return pandas.DataFrame(records, columns=EXPORT_FIELDS)
+
+
+@override_settings(IMPORT_ASYNC=False)
+class ExportTests(TestCase):
+    def setUp(self):
+        upload(self.client, PROJECT_ROWS)
+        self.samples = dict(Sample.objects.values_list('sample_name', 'id'))
+
+    def read(self, body, export_format):
+        if export_format == 'csv':
+            return pandas.read_csv(io.BytesIO(body), keep_default_na=False)
+        if export_format == 'ndjson':
+            return pandas.read_json(io.BytesIO(body), lines=True)
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(io.BytesIO(body)).to_pandas()
+
+    def assert_export(self, body, export_format, rows):
+        pandas.testing.assert_frame_equal(
+            self.read(body, export_format),
+            export_frame(rows, self.samples),
+            check_dtype=False,
+        )
+
+    def test_export_matches_rows(self):
+        for export_format in ['csv', 'ndjson', 'parquet']:
+            response = self.client.get('/api/results/export', {'format': export_format})
+            self.assertEqual(response['Content-Type'], EXPORT_CONTENT_TYPES[export_format])
+            self.assert_export(b''.join(response.streaming_content), export_format, PROJECT_ROWS)
+
+    def test_export_filtered(self):
+        response = self.client.get(
+            '/api/results/export', {'format': 'csv', 'age_operator': 'gt', 'age': 41}
+        )
+        rows = ''.join(
+            line + '\n'
+            for line in PROJECT_ROWS.splitlines()
+            if line.startswith(('prj1,sbj2,', 'prj1,sbj3,'))
+        )
+        self.assert_export(b''.join(response.streaming_content), 'csv', rows)
+
+    async def test_asgi_export_streamed(self):
+        with mock.patch('app.views.aiterate', wraps=aiterate) as streamed:
+            response = await self.async_client.get('/api/results/export', {'format': 'csv'})
+            body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertTrue(streamed.called)
+        self.assert_export(body, 'csv', PROJECT_ROWS)
+
+
+# Two projects of the PROJECT_ROWS subjects, the second with another
+# condition, sample names and sample type, for filters and groups that span
+# projects.
+COHORT_ROWS = PROJECT_ROWS + re.sub(
+    r',s(\d+),PBMC,', r',t\1,tumor,', PROJECT_ROWS.replace('prj1', 'prj2')
+).replace('melanoma', 'healthy')
+
+
+@override_settings(IMPORT_ASYNC=False)
+class CohortTests(TestCase):
+    def setUp(self):
+        upload(self.client, COHORT_ROWS)
+
+    def reference(self, lookups, group_by):
+        '''
+        The cohort groups of the samples matching the Sample lookups, computed
+        from the Sample, Subject and Cell tables rather than SampleSummary.
+        '''
+        counts = {}
+        for sample_id, cell_type, count in Cell.objects.values_list(
+            'sample_id', 'type', 'count'
+        ):
+            counts.setdefault(sample_id, {})[cell_type] = count
+        groups = {}
+        for sample in Sample.objects.filter(**lookups).select_related('subject'):
+            values = {
+                'project': sample.subject.project_id,
+                'condition': sample.subject.condition,
+                'response': sample.subject.response,
+                'sex': sample.subject.sex,
+                'sample_type': sample.sample_type,
+            }
+            key = tuple(values[name] for name in group_by)
+            total = sum(counts[sample.id].values())
+            group = groups.setdefault(key, {'samples': 0, 'subjects': set(), 'frequencies': []})
+            group['samples'] += 1
+            group['subjects'].add(sample.subject_id)
+            group['frequencies'].append(
+                {cell_type: counts[sample.id][cell_type] / total for cell_type in CELL_TYPES}
+            )
+        return {
+            key: (
+                group['samples'],
+                len(group['subjects']),
+                {
+                    cell_type: numpy.mean([f[cell_type] for f in group['frequencies']])
+                    for cell_type in CELL_TYPES
+                },
+            )
+            for key, group in groups.items()
+        }
+
+    def assert_cohorts(self, params, lookups, group_by):
+        data = self.client.get(
+            '/api/cohorts', {**params, 'group_by': ','.join(group_by)}
+        ).json()
+        expected = self.reference(lookups, group_by)
+        if not group_by and not expected:
+            # A single empty group of all samples.
+            expected = {(): (0, 0, dict.fromkeys(CELL_TYPES))}
+        self.assertEqual(len(data['groups']), len(expected), params)
+        self.assertEqual(data['samples'], sum(group[0] for group in expected.values()))
+        for group in data['groups']:
+            key = tuple(group['project_id' if name == 'project' else name] for name in group_by)
+            samples, subjects, means = expected[key]
+            self.assertEqual((group['samples'], group['subjects']), (samples, subjects), key)
+            for cell_type in CELL_TYPES:
+                self.assertAlmostEqual(group['mean_frequency'][cell_type], means[cell_type])
+
+    def test_filters_match_orm(self):
+        for params, lookups in [
+            ({}, {}),
+            ({'condition': 'melanoma'}, {'subject__condition': 'melanoma'}),
+            ({'project': 'prj2'}, {'subject__project__project_name': 'prj2'}),
+            ({'sex': 'F', 'sample_type': 'tumor'}, {'subject__sex': 'F', 'sample_type': 'tumor'}),
+            ({'age_operator': 'gt', 'age': 41}, {'subject__age__gt': 41}),
+            (
+                {'time_operator': 'lt', 'time_from_treatment_start': 7},
+                {'time_from_treatment_start__lt': 7},
+            ),
+            ({'condition': 'none'}, {'subject__condition': 'none'}),
+        ]:
+            for group_by in [[], ['response'], ['project', 'sex'], ['condition', 'sample_type']]:
+                self.assert_cohorts(params, lookups, group_by)
+
+    def test_cohort_fields_synced_after_upsert(self):
+        # New samples of existing subjects, and a new subject.
+        upload(
+            self.client,
+            COHORT_ROWS
+            + 'prj1,sbj0,melanoma,40,M,tr1,yes,s02,tumor,14,5,5,5,5,5\n'
+            + 'prj2,sbj4,healthy,70,F,tr2,,t40,PBMC,0,1,2,3,4,5\n',
+        )
+        summaries = SampleSummary.objects.values('sample_id', *COHORT_FIELDS)
+        samples = {
+            row['id']: row for row in Sample.objects.values('id', *COHORT_FIELDS.values())
+        }
+        self.assertEqual(len(summaries), 16 + 2)
+        for summary in summaries:
+            sample = samples[summary['sample_id']]
+            for name, lookup in COHORT_FIELDS.items():
+                self.assertEqual(summary[name], sample[lookup], name)
+        self.assert_cohorts({'sample_type': 'tumor'}, {'sample_type': 'tumor'}, ['project'])
+
+def frequencies(rows, cell_type):
+    '''
+    The relative frequency of a population in every row of CSV text, by
+    response, computed from the counts as a reference.
+    '''
+    result = {True: [], False: []}
+    for line in rows.splitlines():
+        values = dict(zip(COL_SPEC, line.split(',')))
+        counts = [int(values[column]) for column in COL_SPEC[10:]]
+        result[values['response'] == 'yes'].append(int(values[cell_type]) / sum(counts))
+    return result
+
+
+@override_settings(IMPORT_ASYNC=False)
+class QueryStatsTests(TestCase):
+    def setUp(self):
+        upload(self.client, PROJECT_ROWS)
+
+    def stats(self, **params):
+        response = self.client.get('/api/results/filter', {'stats_only': 'true', **params})
+        return response.json()['results']
+
+    def test_counts(self):
+        results = self.stats()
+        self.assertNotIn('query_results', results)
+        self.assertEqual(
+            results['query_stats'],
+            {
+                'responders': 2,
+                'non_responders': 2,
+                'males': 2,
+                'females': 2,
+                'subjects': 4,
+                'samples': 8,
+                'samples_per_project': {'prj1': 8},
+            },
+        )
+
+    def test_filtered_counts_match_results(self):
+        params = {'sex': 'F', 'time_from_treatment_start': 7}
+        stats = self.stats(**params)['query_stats']
+        results = self.client.get('/api/results/filter', params).json()['results']
+        self.assertEqual(stats, results['query_stats'])
+        self.assertEqual(stats['samples'], len(results['query_results']['samples']))
+        self.assertEqual((stats['responders'], stats['non_responders']), (1, 1))
+        self.assertEqual((stats['males'], stats['females']), (0, 2))
+
+    def test_population_stats_by_response(self):
+        groups = self.stats(group_by='response')['query_stats']['populations']
+        self.assertEqual(
+            [(group['group'], group['samples']) for group in groups], [(False, 4), (True, 4)]
+        )
+        for cell_type in ['b_cell', 'monocyte']:
+            reference = frequencies(PROJECT_ROWS, cell_type)
+            for group in groups:
+                values = reference[group['group']]
+                self.assertAlmostEqual(
+                    group['populations'][cell_type]['mean'], numpy.mean(values)
+                )
+                self.assertAlmostEqual(
+                    group['populations'][cell_type]['median'], numpy.median(values)
+                )
+
+
+class AnalysisTests(TestCase):
+    # Reference values from scipy.stats (mannwhitneyu with method='asymptotic',
+    # ttest_ind with equal_var=False and false_discovery_control).
+    x = numpy.array([1.83, 0.50, 1.62, 2.48, 1.68, 1.88, 1.55, 3.06, 1.30])
+    y = numpy.array([0.878, 0.647, 0.598, 2.05, 1.06, 1.29, 1.06, 3.14, 1.29])
+    tied_x = numpy.array([1, 2, 2, 3, 3, 3, 4.0])
+    tied_y = numpy.array([3, 4, 4, 5, 5, 6.0])
+
+    def test_mann_whitney(self):
+        u, p = mann_whitney(self.x, self.y)
+        self.assertEqual(u, 58.0)
+        self.assertAlmostEqual(p, 0.13291945818531892, places=12)
+
+    def test_mann_whitney_with_ties(self):
+        u, p = mann_whitney(self.tied_x, self.tied_y)
+        self.assertEqual(u, 3.5)
+        self.assertAlmostEqual(p, 0.012999854364387305, places=12)
+
+    def test_mann_whitney_empty_sample(self):
+        self.assertEqual(mann_whitney(self.x, numpy.array([])), (None, None))
+
+    def test_welch_t(self):
+        t, df, p = welch_t(self.x, self.y)
+        self.assertAlmostEqual(t, 1.2051727991066508, places=12)
+        self.assertAlmostEqual(df, 15.795035582541257, places=10)
+        self.assertAlmostEqual(p, 0.24588283853317094, places=12)
+
+        t, df, p = welch_t(self.tied_x, self.tied_y)
+        self.assertAlmostEqual(t, -3.4125309393675205, places=12)
+        self.assertAlmostEqual(df, 10.401226679291549, places=10)
+        self.assertAlmostEqual(p, 0.006270845178780979, places=12)
+
+    def test_welch_t_undefined(self):
+        self.assertEqual(welch_t(self.x, numpy.array([1.0])), (None, None, None))
+        self.assertEqual(welch_t(numpy.ones(3), numpy.ones(4)), (None, None, None))
+
+    def test_benjamini_hochberg(self):
+        q = benjamini_hochberg([0.01, 0.04, None, 0.03, 0.005, 0.5])
+        self.assertIsNone(q[2])
+        for value, expected in zip(q[:2] + q[3:], [0.025, 0.05, 0.05, 0.025, 0.5]):
+            self.assertAlmostEqual(value, expected, places=12)
+        self.assertEqual(benjamini_hochberg([None]), [None])
+
+    @override_settings(IMPORT_ASYNC=False)
+    def test_analysis_view(self):
+        [project_id] = upload(self.client, PROJECT_ROWS)['project_ids']
+        data = self.client.get(f'/api/results/{project_id}/analysis').json()
+        self.assertEqual(data['samples'], {'responders': 4, 'non_responders': 4})
+
+        reference = frequencies(PROJECT_ROWS, 'b_cell')
+        [b_cell] = [p for p in data['populations'] if p['population'] == 'b_cell']
+        self.assertAlmostEqual(b_cell['responders']['mean'], numpy.mean(reference[True]))
+        u, p = mann_whitney(numpy.array(reference[True]), numpy.array(reference[False]))
+        self.assertEqual(b_cell['mann_whitney']['u'], u)
+        self.assertAlmostEqual(b_cell['mann_whitney']['p'], p)
+        self.assertEqual(
+            [population['welch_t']['q'] for population in data['populations']],
+            benjamini_hochberg([population['welch_t']['p'] for population in data['populations']]),
+        )
+
+
+
+@override_settings(IMPORT_ASYNC=False)
+class ChartTests(TestCase):
+    def test_box_stats(self):
+        values = numpy.array([-50, *range(1, 11), 100], dtype=float)
+        # Quartiles 2.75, 5.5 and 8.25: whiskers reach 1.5 IQR (8.25) beyond them.
+        box = box_stats(values, max_outliers=1)
+        self.assertEqual(
+            box,
+            {
+                'n': 12,
+                'mean': values.mean(),
+                'min': -50.0,
+                'q1': 2.75,
+                'median': 5.5,
+                'q3': 8.25,
+                'max': 100.0,
+                'lower_fence': 1.0,
+                'upper_fence': 10.0,
+                # The furthest from the median only.
+                'outliers': [100.0],
+                'outliers_total': 2,
+            },
+        )
+        self.assertEqual(box_stats(values, max_outliers=5)['outliers'], [-50.0, 100.0])
+        self.assertEqual(box_stats(numpy.array([]), max_outliers=5), {'n': 0})
+
+    def test_time_bins(self):
+        # Few distinct times: a bin each, unknown times in none.
+        bins, index = time_bins(numpy.array([0, 7, numpy.nan, 7, 14]), 5)
+        self.assertEqual(bins, [[0.0, 0.0], [7.0, 7.0], [14.0, 14.0]])
+        self.assertEqual(index.tolist(), [0, 1, -1, 1, 2])
+
+        # Many: equal width bins, the last one including its end.
+        bins, index = time_bins(numpy.arange(11, dtype=float), 2)
+        self.assertEqual(bins, [[0.0, 5.0], [5.0, 10.0]])
+        self.assertEqual(index.tolist(), [0] * 5 + [1] * 6)
+
+    def test_binned_stats(self):
+        stats = binned_stats(numpy.array([2, 1, 10, 3, 4.0]), numpy.array([0, 0, 1, 1, 1]), 3)
+        self.assertEqual(stats['n'], [2, 3, 0])
+        self.assertEqual(stats['mean'][0], 1.5)
+        self.assertAlmostEqual(stats['mean'][1], 17 / 3)
+        self.assertEqual(stats['q1'], [1.25, 3.5, None])
+        self.assertEqual(stats['median'], [1.5, 4.0, None])
+        self.assertEqual(stats['q3'], [1.75, 7.0, None])
+        self.assertIsNone(stats['mean'][2])
+
+    def test_chart_view(self):
+        [project_id] = upload(self.client, PROJECT_ROWS)['project_ids']
+        data = self.client.get(f'/api/results/{project_id}/charts', {'bins': 4}).json()
+        self.assertEqual(data['samples'], {'responders': 4, 'non_responders': 4, 'unknown': 0})
+        self.assertEqual(data['time_bins'], [[0, 0], [7, 7]])
+
+        for population in data['populations']:
+            reference = frequencies(PROJECT_ROWS, population['population'])
+            edges = numpy.histogram_bin_edges(reference[True] + reference[False], 4)
+            histogram = population['histogram']
+            numpy.testing.assert_allclose(histogram['edges'], edges)
+            for group, response in [('responders', True), ('non_responders', False)]:
+                self.assertEqual(
+                    histogram[group], numpy.histogram(reference[response], edges)[0].tolist()
+                )
+                box = population['box'][group]
+                self.assertEqual(box['n'], 4)
+                self.assertAlmostEqual(box['median'], numpy.median(reference[response]))
+                # Samples alternate between the two visits, at days 0 and 7.
+                series = population['time_series'][group]
+                self.assertEqual(series['n'], [2, 2])
+                for i in range(2):
+                    self.assertAlmostEqual(
+                        series['mean'][i], numpy.mean(reference[response][i::2])
+                    )
+            self.assertEqual(sum(histogram['unknown']), 0)
+            self.assertEqual(population['box']['unknown'], {'n': 0})
+
+@override_settings(IMPORT_ASYNC=False, QUERY_BUDGET_ACTION='raise')
+class QueryBudgetTests(TestCase):
+    def setUp(self):
+        [self.project_id] = upload(self.client, PROJECT_ROWS)['project_ids']
+        upload(self.client, PROJECT_ROWS.replace('prj1', 'prj2'))
+
+    def read_urls(self):
+        return [
+            ('/api/results', {}),
+            (f'/api/results/{self.project_id}/', {}),
+            (f'/api/results/{self.project_id}/', {'page_size': 7, 'layout': 'columns'}),
+            ('/api/results/filter', {}),
+            ('/api/results/filter', {'sex': 'F', 'page_size': 3}),
+            ('/api/results/filter', {'stats_only': 'true', 'group_by': 'response'}),
+        ]
+
+    def test_read_views_within_budget(self):
+        for url, params in self.read_urls():
+            # Cold, so the response is built rather than read from the cache.
+            cache.clear()
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url, params)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(queries), views.READ_QUERY_BUDGET, f'{url} {params}')
+
+    def test_budget_independent_of_data_size(self):
+        url = '/api/results/filter'
+        cache.clear()
+        with CaptureQueriesContext(connection) as before:
+            self.client.get(url)
+        upload(self.client, PROJECT_ROWS.replace('prj1', 'prj3'))
+        cache.clear()
+        with CaptureQueriesContext(connection) as after:
+            self.client.get(url)
+        self.assertEqual(len(after), len(before))
+
+    def test_overrun_raises(self):
+        for view, url in [
+            (views.results_view, '/api/results'),
+            (views.results_view_with_id, f'/api/results/{self.project_id}/'),
+            (views.query_results, '/api/results/filter'),
+        ]:
+            cache.clear()
+            with mock.patch.object(view, 'query_budget', 1):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(url)
+
+    @override_settings(QUERY_BUDGET_ACTION='log')
+    def test_overrun_logged(self):
+        cache.clear()
+        with mock.patch.object(views.query_results, 'query_budget', 1):
+            with self.assertLogs('program.metrics', 'WARNING') as logs:
+                response = self.client.get('/api/results/filter')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('over its budget of 1', logs.output[0])
+
+
+@override_settings(IMPORT_ASYNC=False, IMPORT_CHUNK_SIZE=2)
+class ImportMemoryTests(TestCase):
+    @mock.patch('app.importer.MAX_CACHED_KEYS', 1)
+    def test_evicted_keys_looked_up_again(self):
+        # Only one subject and sample are kept between chunks, so sbj0 and its
+        # samples have to be found in the database again for the last rows.
+        rows = PROJECT_ROWS + 'prj1,sbj0,melanoma,40,M,tr1,yes,s02,PBMC,14,1,2,3,4,5\n'
+        for mode in ['upsert', 'append']:
+            upload(self.client, rows, mode)
+            self.assertEqual(Subject.objects.count(), 4)
+            self.assertEqual(Sample.objects.count(), 9)
+            self.assertEqual(Cell.objects.count(), 9 * 5)
+            Subject.objects.all().delete()
+
+    @mock.patch('app.importer.MAX_CACHED_KEYS', 1)
+    def test_upsert_adds_new_rows_only(self):
+        upload(self.client, PROJECT_ROWS)
+        upload(self.client, PROJECT_ROWS + 'prj1,sbj0,melanoma,40,M,tr1,yes,s02,PBMC,14,1,2,3,4,5\n')
+        self.assertEqual(Subject.objects.count(), 4)
+        self.assertEqual(Sample.objects.count(), 9)
+        self.assertEqual(Cell.objects.count(), 9 * 5)
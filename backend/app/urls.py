@@ -3,7 +3,12 @@ from . import views
 
 urlpatterns = [
     path('import', views.import_view, name='import_view'),
+    path('import/<int:job_id>', views.import_job_view, name='import_job_view'),
     path('results', views.results_view, name='results_view'),
-    path('results/<str:project_id>/', views.results_view_with_id, name='results_view_with_id'),
-    path('results/filter', views.query_results, name='query_results')
+    path('results/<int:project_id>/', views.results_view_with_id, name='results_view_with_id'),
+    path('results/<int:project_id>/analysis', views.analysis_view, name='analysis_view'),
+    path('results/<int:project_id>/charts', views.chart_view, name='chart_view'),
+    path('results/filter', views.query_results, name='query_results'),
+    path('results/export', views.query_export, name='query_export'),
+    path('cohorts', views.cohort_view, name='cohort_view'),
 ]
\ No newline at end of file
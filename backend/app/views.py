@@ -1,181 +1,72 @@
-import time
+import json
 from dataclasses import dataclass, field
-from django.http import JsonResponse
-import pandas
-from .models import Subject, Sample, Cell, Project, Scientist
-from django.db import models
-from collections import defaultdict
-
-COL_SPEC = [
-    'project',
-    'subject',
-    'condition',
-    'age',
-    'sex',
-    'treatment',
-    'response',
-    'sample',
-    'sample_type',
-    'time_from_treatment_start',
-    'b_cell',
-    'cd4_t_cell',
-    'cd8_t_cell',
-    'nk_cell',
-    'monocyte',
-]
-
-
-@dataclass
-class FileData:
-    '''
-    Dataclass to hold the data for each row in the inputCSV file.
-    This class is used to create instances of Project, Subject, Sample, and Cell,
-    and prevents creation of duplicate entries in the database.
-    '''
-
-    project: str
-    subject: str
-    condition: str
-    age: int
-    sex: str
-    treatment: str
-    response: str
-    sample: str
-    sample_type: str
-    time_from_treatment_start: int
-    b_cell: int
-    cd4_t_cell: int
-    cd8_t_cell: int
-    nk_cell: int
-    monocyte: int
-    scientist: Scientist
-
-    created_project: Project | None = None
-    created_subject: Subject | None = None
-    created_samples: Sample | None = None
-    created_cells: list[Cell] | None = None
-
-    def _parse_response(self):
-        '''
-        Parse the response field to a boolean value.
-        '''
-        if isinstance(self.response, str):
-            self.response = self.response.strip().lower()
-            if self.response in ['yes', 'true', '1', 'y']:
-                return True
-            elif self.response in ['no', 'false', '0', 'n']:
-                return False
-        return None
-    
-    def _parse_time_from_treatment_start(self):
-        '''
-        Parse the time_from_treatment_start field to an integer.
-        If the field is empty or not a valid integer, return None.
-        '''
-        try:
-            return int(self.time_from_treatment_start)
-        except (ValueError, TypeError):
-            return None
-
-    def create_project(self, projects):
-        '''
-        Create a Project instance based on the project name from the CSV file and user
-        (currently statically defined as 'Bob Loblaw', in production this would be done
-        using the logged in user).
-        - If the project does not exist in the projects dict, create a new Project
-        instance.
-        - If it does exist, retrieve the existing Project instance and assign it
-        to self.created_project.
-        '''
-        if self.project not in projects:
-            project = Project(
-                project_name=self.project,
-                date=time.strftime('%Y-%m-%d'),
-                user=self.scientist,
-            )
-            project.save()
-            projects[self.project] = project
-        else:
-            project = projects[self.project]
-
-        self.created_project = project
-        return
-
-    def create_subject(self, subjects):
-        '''
-        Create a Subject instance based on the data from the CSV file.
-        - If the subject does not exist in the subjects dict, create a new Subject 
-          instance.
-        - If it does exist, retrieve the existing Subject instance and assign it 
-          to self.created_subject.
-        The 'response' is parsed to a boolean value, if applicable.
-        '''
-        if self.subject not in subjects:
-            response = self._parse_response()
-            # Create a new Subject instance
-            subject = Subject(
-                subject_name=self.subject,
-                condition=self.condition,
-                age=self.age,
-                treatment=self.treatment,
-                response=response,
-                project=self.created_project,
-            )
-
-            subject.save()
-            subjects[self.subject] = subject
-        else:
-            subject = subjects[self.subject]
-
-        self.created_subject = subject
-        return
-
-    def create_sample_and_cells(self, samples):
-        '''
-        Per the CSV each sample (s1, s2, s3, etc.) is unique in the CSV.
-        But, add to samples dict as a tuple of (subject,sample) to ensure uniqueness.
-
-        - If the sample does not exist in the samples dict, create a new Sample instance.
-        - Else If it does exist, retrieve the existing Sample instance and assign 
-          it to self.created_sample.
-        - Then create Cell instances for each cell type with the corresponding count.
-        '''
-        time_from_start = self._parse_time_from_treatment_start()
-
-        if (self.subject, self.sample) not in samples:
-            sample = Sample(
-                sample_name=self.sample,
-                sample_type=self.sample_type,
-                time_from_treatment_start=time_from_start,
-                subject=self.created_subject,
-            )
-            sample.save()
-            samples[(self.subject, self.sample)] = sample
-        else:
-            sample = samples[(self.subject, self.sample)]
-
-        self.created_sample = sample
-
-        # Create cells for the sample
-        cells = [
-            Cell(type='b_cell', count=self.b_cell, sample=sample),
-            Cell(type='cd4_t_cell', count=self.cd4_t_cell, sample=sample),
-            Cell(type='cd8_t_cell', count=self.cd8_t_cell, sample=sample),
-            Cell(type='nk_cell', count=self.nk_cell, sample=sample),
-            Cell(type='monocyte', count=self.monocyte, sample=sample),
-        ]
-        created_cells = Cell.objects.bulk_create(cells)
-        self.created_cells = created_cells
-
-        return
+from operator import itemgetter
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIRequest
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.cache import patch_vary_headers
+from django.views.decorators.cache import cache_control
+from .models import (
+    CELL_TYPES,
+    Subject,
+    Sample,
+    SampleSummary,
+    Project,
+    Scientist,
+    ImportJob,
+    ImportedFile,
+)
+from .analysis import compare_responders
+from .charts import chart_data
+from .cache import (
+    acached_body,
+    aproject_condition,
+    aprojects_state,
+    cached_body,
+    digest,
+    project_condition,
+    projects_state,
+)
+from .cells import (
+    CELL_ROW_FIELDS,
+    EXPORT_FIELDS,
+    cell_rows,
+    count_cell_rows,
+    export_rows,
+)
+from .encoding import accepted_encoding, columns
+from .export import EXPORT_CONTENT_TYPES, aiterate, encode_rows
+from .importer import (
+    ImportEngine,
+    content_hash,
+    file_format,
+    missing_columns,
+    read_normalized_chunks,
+)
+from .cohorts import COHORT_GROUP_FIELDS, cohort_groups, cohort_summaries
+from .jobs import enqueue_import_job, fail_stale_jobs
+from .stats import GROUP_BY_FIELDS, population_stats, query_stats
+from django.db import models, transaction
+from program.metrics import query_budget
+
+# Queries a read view may run per request, whatever the size of the data:
+# going over it means a query per row crept in (see program/metrics.py).
+READ_QUERY_BUDGET = 10
 
 
 def import_view(request):
     '''
     Handles the import of a CSV file containing data about projects, subjects, samples, and cells.
     - The CSV file should have the columns found in COL_SPEC.
+    - Parquet (.parquet) and Arrow IPC (.arrow, .feather) files with the same
+    columns are imported the same way.
     - The function reads the CSV file, creates instances of Project, Subject, Sample, and Cell,
     and returns a JSON response with the status of the import and the IDs of the created projects.
+    - With IMPORT_ASYNC enabled, the file is stored as an ImportJob instead and the
+    response only contains the job ID, whose progress is reported by import_job_view.
+    - In 'upsert' mode (IMPORT_MODE, or the 'mode' form field), a file with the same
+    content as an earlier import is not imported again, and only new rows are added.
     '''
     if request.method == 'POST':
 
@@ -190,20 +81,32 @@ def import_view(request):
 
         # Again, the frontend should prevent a submission without a CSV file,
         # but we check here to avoid server errors.
-        if not uploaded_file.name.lower().endswith('.csv'):
+        # Parquet and Arrow IPC files with the same columns are accepted too.
+        if file_format(uploaded_file.name) is None:
             return JsonResponse(
-                {'status': 'error', 'message': 'Uploaded file is not a CSV'}, status=400
+                {
+                    'status': 'error',
+                    'message': 'Uploaded file is not a CSV, Parquet or Arrow file',
+                },
+                status=400,
             )
 
-        # Read the CSV file and retrieve the columns specified in COL_SPEC
-        try:
-            df = pandas.read_csv(uploaded_file)[COL_SPEC]
-        except KeyError:
+        # Check the header before importing or queuing anything, so a file
+        # without the required columns is rejected right away.
+        if missing_columns(uploaded_file):
             return JsonResponse(
                 {'status': 'error', 'message': 'CSV file is missing required columns'},
                 status=400,
             )
 
+        mode = request.POST.get('mode', settings.IMPORT_MODE)
+        if mode not in ('upsert', 'append'):
+            return JsonResponse(
+                {'status': 'error', 'message': 'Import mode must be upsert or append'},
+                status=400,
+            )
+        upsert = mode == 'upsert'
+
         # Statically define the scientist for now.
         # In production, the logged in user would be used,
         # but user authentication has not been added to this app for demo purposes.
@@ -213,27 +116,63 @@ def import_view(request):
             company='Loblaw Bio',
         )
 
-        projects = {}
-        subjects = {}
-        samples = {}
-
-        # Create a list of FileData instances from the DataFrame
-        # This will allow us to create the Project, Subject, Sample, and Cell instances
-        data_class_list = [
-            FileData(**row, scientist=scientist) for row in df.to_dict(orient='records')
-        ]
+        # Re-uploading an unchanged file is a no-op in upsert mode.
+        digest = content_hash(uploaded_file) if upsert else ''
+        if upsert:
+            imported_file = ImportedFile.objects.filter(
+                user=scientist, content_hash=digest
+            ).first()
+            if imported_file:
+                return JsonResponse(
+                    {
+                        'status': 'success',
+                        'project_ids': imported_file.project_ids,
+                        'unchanged': True,
+                    },
+                    status=200,
+                )
 
-        for dc in data_class_list:
-            dc.create_project(projects)
-            dc.create_subject(subjects)
-            dc.create_sample_and_cells(samples)
+        if settings.IMPORT_ASYNC:
+            job = ImportJob.objects.create(
+                file=uploaded_file,
+                file_name=uploaded_file.name,
+                upsert=upsert,
+                content_hash=digest,
+                user=scientist,
+            )
+            enqueue_import_job(job)
+            return JsonResponse({'status': 'queued', 'job_id': job.id}, status=202)
+
+        # Stream the CSV file in chunks of the columns specified in COL_SPEC,
+        # persisting each chunk with batched inserts before reading the next.
+        # The whole import is all or nothing.
+        engine = ImportEngine(scientist=scientist, upsert=upsert)
+        with transaction.atomic():
+            for chunk, errors in read_normalized_chunks(uploaded_file):
+                engine.run(chunk, errors)
+            if upsert:
+                ImportedFile.objects.get_or_create(
+                    user=scientist,
+                    content_hash=digest,
+                    defaults={
+                        'file_name': uploaded_file.name,
+                        'project_ids': [p.id for p in engine.projects.values()],
+                    },
+                )
 
         # Get the project IDs from the created projects,
         # this will be used to navigate to the project view after import.
-        project_ids = [p.id for p in projects.values()]
+        project_ids = [p.id for p in engine.projects.values()]
 
+        # Rows that failed validation are skipped and reported back.
         return JsonResponse(
-            {'status': 'success', 'project_ids': project_ids}, status=200
+            {
+                'status': 'success',
+                'project_ids': project_ids,
+                'errors': engine.errors,
+                'error_count': engine.error_count,
+            },
+            status=200,
         )
     else:
         return JsonResponse(
@@ -241,15 +180,144 @@ def import_view(request):
         )
 
 
-def results_view(request):
+def import_job_view(request, job_id):
+    '''
+    Returns a JSON response with the progress of a background import job:
+    its status, rows processed so far, throughput in rows per second,
+    any errors, and the IDs of the created projects once it has succeeded.
+    A running job that lost its worker is reported failed.
+    '''
+    fail_stale_jobs(ImportJob.objects.filter(id=job_id))
+    try:
+        job = ImportJob.objects.get(id=job_id)
+    except ImportJob.DoesNotExist:
+        return JsonResponse(
+            {'status': 'error', 'message': 'Import job not found'}, status=404
+        )
+
+    return JsonResponse(
+        {
+            'status': 'success',
+            'job': {
+                'id': job.id,
+                'file_name': job.file_name,
+                'status': job.status,
+                'rows_processed': job.rows_processed,
+                'throughput': job.throughput(),
+                'errors': job.errors,
+                'project_ids': job.project_ids,
+                'created_at': job.created_at.isoformat(),
+                'started_at': job.started_at.isoformat() if job.started_at else None,
+                'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+            },
+        },
+        status=200,
+    )
+
+
+def _page_params(request):
+    '''
+    The (cursor, page_size) keyset pagination parameters of a request, or None
+    when it asks for everything at once. The cursor is the id of the last
+    row of the previous page, page_size defaults to RESULTS_PAGE_SIZE.
+    Raises ValueError for parameters that are not valid.
+    '''
+    if 'cursor' not in request.GET and 'page_size' not in request.GET:
+        return None
+    cursor = request.GET.get('cursor') or None
+    cursor = int(cursor) if cursor is not None else None
+    page_size = int(request.GET.get('page_size') or settings.RESULTS_PAGE_SIZE)
+    if not 0 < page_size <= settings.RESULTS_MAX_PAGE_SIZE:
+        raise ValueError(
+            f'page_size must be between 1 and {settings.RESULTS_MAX_PAGE_SIZE}'
+        )
+    return cursor, page_size
+
+
+def _page_info(rows, cursor, page_size, total, row_id=itemgetter('id')):
+    '''
+    Trim rows, fetched with one row more than page_size, to the page and
+    describe it. next_cursor is None on the last page.
+    '''
+    has_more = len(rows) > page_size
+    del rows[page_size:]
+    return {
+        'cursor': cursor,
+        'next_cursor': row_id(rows[-1]) if has_more else None,
+        'page_size': page_size,
+        'total': total,
+    }
+
+
+def _scientist_projects(request):
+    return Project.objects.filter(user__name='Bob Loblaw')
+
+
+def _project(request, project_id):
+    return Project.objects.filter(id=project_id)
+
+
+# Layouts of the results: a list of objects per row (the default), or
+# 'columns', one list of values per field (see encoding.columns).
+RESULT_LAYOUTS = ['rows', 'columns']
+
+
+def _layout(request):
+    '''
+    The layout query parameter of a request.
+    Raises ValueError for a layout that is not valid.
+    '''
+    layout = request.GET.get('layout') or 'rows'
+    if layout not in RESULT_LAYOUTS:
+        raise ValueError(f'layout must be one of {", ".join(RESULT_LAYOUTS)}')
+    return layout
+
+
+def _json_response(request, key, build):
+    '''
+    A JSON response with the body cached under key (see cache.cached_body),
+    compressed when the client accepts it.
+    '''
+    return _body_response(*cached_body(key, build, accepted_encoding(request)))
+
+
+async def _ajson_response(request, key, build):
+    '''
+    The async counterpart of _json_response (see cache.acached_body).
+    '''
+    return _body_response(*await acached_body(key, build, accepted_encoding(request)))
+
+
+def _body_response(body, encoding):
+    response = HttpResponse(body, content_type='application/json', status=200)
+    if encoding:
+        response['Content-Encoding'] = encoding
+    patch_vary_headers(response, ['Accept-Encoding'])
+    return response
+
+
+# The results endpoints send an ETag and Last-Modified derived from the data
+# version of the projects they cover, and no-cache makes browsers revalidate
+# them on every use: an unchanged project costs a 304 and one small query.
+# On the server, response bodies are cached per project data version, so an
+# import (which bumps the version) invalidates them without any explicit purge.
+# The read endpoints are async views: under ASGI, revalidations and cache hits
+# are answered with the async ORM and cache without holding a worker, and only
+# building a missing body runs in a thread.
+@query_budget(READ_QUERY_BUDGET)
+@cache_control(no_cache=True)
+@aproject_condition(_scientist_projects)
+async def results_view(request):
     '''
     Returns a JSON response with all Projects that belong to a specific Scientis.
     '''
     try:
-        scientist = Scientist.objects.get(name='Bob Loblaw')
+        scientist = await Scientist.objects.aget(name='Bob Loblaw')
         projects = Project.objects.filter(user=scientist)
-        return JsonResponse(
-            {
+        state = await aprojects_state(request, projects)
+
+        def build():
+            return {
                 'status': 'success',
                 'projects': [
                     {
@@ -259,61 +327,77 @@ def results_view(request):
                     }
                     for project in projects
                 ],
-            },
-            status=200,
-        )
+            }
+
+        if state is None:
+            return JsonResponse(await sync_to_async(build)(), status=200)
+        return await _ajson_response(request, f'results:{scientist.id}:{state[0]}', build)
     except Exception as e:
         return JsonResponse(
             {'status': 'error', 'message': str(e)}, status=500
         )
     
-def results_view_with_id(request, project_id):
+
+@query_budget(READ_QUERY_BUDGET)
+@cache_control(no_cache=True)
+@aproject_condition(_project)
+async def results_view_with_id(request, project_id):
     '''
     Returns a JSON response with all Subjects, Samples, and Cells for a specific Project ID.
+    Per-sample totals are read from SampleSummary, so the cells of the whole
+    project are read in a single query (see cells.cell_rows) instead of one
+    aggregate query per sample.
+
+    With a cursor or page_size query parameter, only one page of the cell rows
+    is returned, with the subjects of that page and a 'page' object holding
+    the next_cursor to ask for the following page and the total row count.
+
+    With layout=columns, the cell rows and subjects are returned as one list
+    of values per field (see encoding.columns) instead of one object per row.
     '''
     try:
-        project = Project.objects.get(id=project_id)
-        subjects = subjects = Subject.objects.filter(project=project).prefetch_related(
-            models.Prefetch(
-                'sample_set',
-                queryset=Sample.objects.prefetch_related('cell_set')
-            )
-        )
-        subject_dict = {}
-        samples_list = []
-
-        for subject in subjects:
-            subject_dict[subject.id] = {
-                'subject_name': subject.subject_name,
-                'condition': subject.condition,
-                'age': subject.age,
-            }
+        page = _page_params(request)
+        layout = _layout(request)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
 
-            for sample in subject.sample_set.all():
-                cell_sum = sample.total_cell_count()
-                for cell in sample.cell_set.all():
-                    samples_list.append(
-                        {
-                            'id': cell.id,
-                            'response': subject.response,
-                            'subject_id': sample.subject.id,
-                            'sample_id': sample.id,
-                            'sample_name': sample.sample_name,
-                            'sample_type': sample.sample_type,
-                            'time_from_treatment_start': sample.time_from_treatment_start,
-                            'total_count': cell_sum,
-                            'population': cell.type,
-                            'count': cell.count,
-                            'relative_frequency': (
-                                cell.count / cell_sum if cell_sum else None
-                            ),
-
-                        }
-                    )
+    try:
+        project = await Project.objects.aget(id=project_id)
+        samples = Sample.objects.filter(subject__project=project)
+        subject_id = itemgetter(CELL_ROW_FIELDS.index('subject_id'))
+
+        def build():
+            # Totals come from the SampleSummary maintained by the importer,
+            # a total of 0 is stored as None like Sample.total_cell_count.
+            if page is None:
+                rows = list(cell_rows(samples))
+                subjects = Subject.objects.filter(project=project)
+            else:
+                cursor, page_size = page
+                rows = list(cell_rows(samples, after=cursor, limit=page_size + 1))
+                page_info = _page_info(
+                    rows, cursor, page_size, count_cell_rows(samples), row_id=itemgetter(0)
+                )
+                subjects = Subject.objects.filter(id__in={subject_id(row) for row in rows})
 
+            subject_fields = ['id', 'subject_name', 'condition', 'age']
+            if layout == 'columns':
+                samples_result = columns(CELL_ROW_FIELDS, rows)
+                subjects_result = columns(
+                    subject_fields, subjects.order_by('id').values_list(*subject_fields)
+                )
+            else:
+                samples_result = [dict(zip(CELL_ROW_FIELDS, row)) for row in rows]
+                subjects_result = {
+                    subject['id']: {
+                        'subject_name': subject['subject_name'],
+                        'condition': subject['condition'],
+                        'age': subject['age'],
+                    }
+                    for subject in subjects.values(*subject_fields)
+                }
 
-        return JsonResponse(
-            {
+            data = {
                 'status': 'success',
                 'project_data': {
                     'project': {
@@ -321,16 +405,202 @@ def results_view_with_id(request, project_id):
                     'project_name': project.project_name,
                     'date': project.date.strftime('%Y-%m-%d'),
                 },
-                'subjects': subject_dict,
-                'samples': samples_list,
+                'subjects': subjects_result,
+                'samples': samples_result,
                 }
-                }, status=200)
+                }
+            if page is not None:
+                data['page'] = page_info
+            return data
+
+        # The storage layout is part of the key as it decides the cell ids.
+        key = f'project:{project.id}:v{project.data_version}:{settings.CELL_STORAGE}'
+        if page is not None:
+            key += ':page:{}:{}'.format(*page)
+        if layout == 'columns':
+            key += ':columns'
+        return await _ajson_response(request, key, build)
     
+    except Project.DoesNotExist:
+        return JsonResponse(
+            {'status': 'error', 'message': 'Project not found'}, status=404
+        )
+    except Exception as e:
+        return JsonResponse(
+            {'status': 'error', 'message': str(e)}, status=500
+        )
+
+# Fields of the projects, subjects and samples of the query results, which
+# _retrieve_columns reads with values_list. Samples also have their
+# relative_frequency per population.
+PROJECT_RESULT_FIELDS = ['id', 'project_name', 'date']
+SUBJECT_RESULT_FIELDS = [
+    'id',
+    'subject_name',
+    'condition',
+    'age',
+    'sex',
+    'treatment',
+    'response',
+    'project_id',
+]
+SAMPLE_RESULT_FIELDS = [
+    'id',
+    'sample_name',
+    'sample_type',
+    'time_from_treatment_start',
+    'subject_id',
+    'total_count',
+]
+
+
+def _project_result(project):
+    return {
+        'id': project.id,
+        'project_name': project.project_name,
+        'date': project.date.strftime('%Y-%m-%d'),
+    }
+
+
+def _subject_result(subject):
+    return {
+        'id': subject.id,
+        'subject_name': subject.subject_name,
+        'condition': subject.condition,
+        'age': subject.age,
+        'sex': subject.sex,
+        'treatment': subject.treatment,
+        'response': subject.response,
+        'project_id': subject.project_id,
+    }
+
+
+def _sample_result(sample):
+    return {
+        'id': sample.id,
+        'sample_name': sample.sample_name,
+        'sample_type': sample.sample_type,
+        'time_from_treatment_start': sample.time_from_treatment_start,
+        'subject_id': sample.subject_id,
+        **_summary_fields(sample),
+    }
+
+
+@query_budget(READ_QUERY_BUDGET)
+@cache_control(no_cache=True)
+@project_condition(_project)
+def analysis_view(request, project_id):
+    '''
+    Returns a summary comparing the relative frequency of each population
+    between responders and non-responders of a project (see
+    analysis.compare_responders). The samples can be narrowed down with the
+    query_results filters, e.g. sample_type and time_from_treatment_start.
+    Results are cached per project data version and filter set.
+    '''
+    try:
+        project = Project.objects.get(id=project_id)
+        query_data = _query_data(request, project.user)
+        _, subjects, samples = query_data.build_querysets()
+        samples = samples.filter(subject__in=subjects.filter(project=project).values('id'))
+
+        key = 'analysis:{}:v{}:{}'.format(
+            project.id, project.data_version, digest(query_data.filter_key())
+        )
+        return _json_response(
+            request,
+            key,
+            lambda: {
+                'status': 'success',
+                'project_id': project.id,
+                **compare_responders(samples),
+            },
+        )
+    except Project.DoesNotExist:
+        return JsonResponse(
+            {'status': 'error', 'message': 'Project not found'}, status=404
+        )
+    except Exception as e:
+        return JsonResponse(
+            {'status': 'error', 'message': str(e)}, status=500
+        )
+
+
+def _chart_bins(request):
+    '''
+    The bins query parameter of a request, CHART_BINS by default.
+    Raises ValueError for a number of bins that is not valid.
+    '''
+    bins = int(request.GET.get('bins') or settings.CHART_BINS)
+    if not 0 < bins <= settings.CHART_MAX_BINS:
+        raise ValueError(f'bins must be between 1 and {settings.CHART_MAX_BINS}')
+    return bins
+
+
+@query_budget(READ_QUERY_BUDGET)
+@cache_control(no_cache=True)
+@project_condition(_project)
+def chart_view(request, project_id):
+    '''
+    Returns the data of the charts of a project page, computed on the server
+    so the page does not need every cell row: per population and response
+    group, a histogram of the relative frequency, a box plot and a time
+    series by time_from_treatment_start (see charts.chart_data). The bins
+    query parameter sets the number of histogram and time bins, and the
+    samples can be narrowed down with the query_results filters, e.g.
+    sample_type=PBMC. Results are cached per project data version,
+    filter set and number of bins.
+    '''
+    try:
+        bins = _chart_bins(request)
+    except ValueError as e:
+        return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+    try:
+        project = Project.objects.get(id=project_id)
+        query_data = _query_data(request, project.user)
+        _, subjects, samples = query_data.build_querysets()
+        samples = samples.filter(subject__in=subjects.filter(project=project).values('id'))
+
+        key = 'charts:{}:v{}:{}:{}'.format(
+            project.id, project.data_version, digest(query_data.filter_key()), bins
+        )
+        return _json_response(
+            request,
+            key,
+            lambda: {
+                'status': 'success',
+                'project_id': project.id,
+                'bins': bins,
+                **chart_data(samples, bins, settings.CHART_MAX_OUTLIERS),
+            },
+        )
+    except Project.DoesNotExist:
+        return JsonResponse(
+            {'status': 'error', 'message': 'Project not found'}, status=404
+        )
     except Exception as e:
         return JsonResponse(
             {'status': 'error', 'message': str(e)}, status=500
         )
 
+
+def _summary_fields(sample):
+    '''
+    The total count and relative frequency per population of a sample,
+    read from its SampleSummary (select_related('summary') avoids a query).
+    '''
+    try:
+        summary = sample.summary
+    except SampleSummary.DoesNotExist:
+        return {'total_count': None, 'relative_frequency': {}}
+    return {
+        'total_count': summary.total_count,
+        'relative_frequency': {
+            cell_type: getattr(summary, f'{cell_type}_frequency')
+            for cell_type in CELL_TYPES
+        },
+    }
+
+
 @dataclass
 class QueryData:
     '''
@@ -348,6 +618,11 @@ class QueryData:
     time_from_treatment_start: int | None
     time_operator: str | None
     scientist: Scientist
+    cursor: int | None = None
+    page_size: int | None = None
+    stats_only: bool = False
+    group_by: str | None = None
+    layout: str = 'rows'
 
     project_query_params: dict = field(default_factory=dict)
     subject_query_params: dict = field(default_factory=dict)
@@ -401,127 +676,348 @@ class QueryData:
             self.sample_query_params['sample_type'] = self.sample_type
 
 
+    def build_querysets(self):
+        '''
+        Build the filtered Project, Subject and Sample querysets for the provided
+        attributes. Also used by the explain_queries management command.
+        '''
+        self._build_project_query_params()
+        self._build_subject_query_params()
+        self._build_sample_query_params()
+        return (
+            Project.objects.filter(**self.project_query_params),
+            Subject.objects.filter(**self.subject_query_params),
+            Sample.objects.filter(**self.sample_query_params),
+        )
+
+    def filter_key(self):
+        '''
+        The normalized filter set, for keying cached results: the lookups
+        build_querysets filters on, with values coerced to their field types.
+        Requests that filter the same way share a key, e.g. age=40 and
+        age_operator=eq&age=040, or a time_operator without a time.
+        Call after build_querysets.
+        '''
+        filters = {}
+        for model, params in [
+            (Project, self.project_query_params),
+            (Subject, self.subject_query_params),
+            (Sample, self.sample_query_params),
+        ]:
+            for lookup, value in params.items():
+                if lookup == 'user':
+                    continue
+                field = model._meta.get_field(lookup.split('__')[0])
+                filters[f'{model.__name__}.{lookup}'] = field.get_prep_value(value)
+        return json.dumps(filters, sort_keys=True)
+
     def retrieve_query_results(self):
         '''
         Retrieve the query results based on the provided attributes.
         - Filter projects based on the project name.
         - Filter subjects based on the provided attributes.
         '''
-        self._build_project_query_params()
-        self._build_subject_query_params()
-        self._build_sample_query_params()
-        projects = Project.objects.filter(**self.project_query_params).prefetch_related(
+        if self.stats_only:
+            self._analyze_query_results(*self.build_querysets())
+            return {'query_stats': self.query_stats}
+        if self.layout == 'columns':
+            return self._retrieve_columns()
+        if self.page_size:
+            return self._retrieve_page()
+
+        projects, subjects, samples = self.build_querysets()
+        self._analyze_query_results(projects, subjects, samples)
+        projects = projects.prefetch_related(
             models.Prefetch(
             'subject_set',
-            queryset=Subject.objects.filter(**self.subject_query_params).prefetch_related(
+            queryset=subjects.prefetch_related(
                 models.Prefetch(
                 'sample_set',
-                queryset=Sample.objects.filter(**self.sample_query_params)
+                queryset=samples.select_related('summary')
                 )
             )
             )
         )
         self.query_results = {
-            'projects': [
-                {
-                    'id': project.id,
-                    'project_name': project.project_name,
-                    'date': project.date.strftime('%Y-%m-%d'),
-                }
-                for project in projects
-            ],
+            'projects': [_project_result(project) for project in projects],
             'subjects': [
-                {
-                    'id': subject.id,
-                    'subject_name': subject.subject_name,
-                    'condition': subject.condition,
-                    'age': subject.age,
-                    'sex': subject.sex,
-                    'treatment': subject.treatment,
-                    'response': subject.response,
-                    'project_id': subject.project_id,
-                }
+                _subject_result(subject)
                 for project in projects
                 for subject in project.subject_set.all()
             ],
             'samples': [
-                {
-                    'id': sample.id,
-                    'sample_name': sample.sample_name,
-                    'sample_type': sample.sample_type,
-                    'time_from_treatment_start': sample.time_from_treatment_start,
-                    'subject_id': sample.subject_id,
-                }
+                _sample_result(sample)
                 for project in projects
                 for subject in project.subject_set.all()
                 for sample in subject.sample_set.all()
-    ],
-}
+            ],
+        }
         
-        self._analyze_query_results()
         return {'query_results': self.query_results, 'query_stats': self.query_stats}
     
-    def _analyze_query_results(self):
+    def _retrieve_page(self):
+        '''
+        Retrieve one page of the query results: all matching projects, the
+        page_size matching samples with an id above cursor, and the subjects
+        of those samples. The stats still cover all matching subjects, and
+        'page' holds the next_cursor and the total number of samples.
+        '''
+        projects, subjects, samples = self.build_querysets()
+        self._analyze_query_results(projects, subjects, samples)
+        projects = list(projects.order_by('id'))
+        subjects = subjects.filter(project__in=projects)
+        samples = samples.filter(subject__in=subjects)
+
+        page = samples.select_related('summary').order_by('id')
+        if self.cursor is not None:
+            page = page.filter(id__gt=self.cursor)
+        page_samples = [_sample_result(sample) for sample in page[: self.page_size + 1]]
+        page_info = _page_info(
+            page_samples, self.cursor, self.page_size, samples.count()
+        )
+        page_subjects = subjects.filter(
+            id__in={sample['subject_id'] for sample in page_samples}
+        ).order_by('id')
+
+        self.query_results = {
+            'projects': [_project_result(project) for project in projects],
+            'subjects': [_subject_result(subject) for subject in page_subjects],
+            'samples': page_samples,
+        }
+        return {
+            'query_results': self.query_results,
+            'query_stats': self.query_stats,
+            'page': page_info,
+        }
+
+    def _retrieve_columns(self):
+        '''
+        Retrieve the query results in the column layout: the projects, subjects
+        and samples each as one list of values per field (see encoding.columns),
+        ordered by id. They are read with values_list, so no model instance or
+        dict is built per row. With page_size, the samples are paged as in
+        _retrieve_page.
+        '''
+        projects, subjects, samples = self.build_querysets()
+        self._analyze_query_results(projects, subjects, samples)
+        subjects = subjects.filter(project__in=projects.values('id'))
+        samples = samples.filter(subject__in=subjects.values('id')).order_by('id')
+
+        page = samples
+        if self.page_size and self.cursor is not None:
+            page = page.filter(id__gt=self.cursor)
+        page = page.values_list(
+            *SAMPLE_RESULT_FIELDS[:-1],
+            'summary__total_count',
+            *[f'summary__{cell_type}_frequency' for cell_type in CELL_TYPES],
+        )
+        if self.page_size:
+            sample_rows = list(page[: self.page_size + 1])
+            page_info = _page_info(
+                sample_rows, self.cursor, self.page_size, samples.count(), row_id=itemgetter(0)
+            )
+            subject_id = SAMPLE_RESULT_FIELDS.index('subject_id')
+            subjects = subjects.filter(id__in={row[subject_id] for row in sample_rows})
+        else:
+            sample_rows = list(page)
+
+        fields = len(SAMPLE_RESULT_FIELDS)
+        sample_columns = columns(SAMPLE_RESULT_FIELDS, (row[:fields] for row in sample_rows))
+        sample_columns['relative_frequency'] = columns(
+            CELL_TYPES, (row[fields:] for row in sample_rows)
+        )
+        self.query_results = {
+            'projects': columns(
+                PROJECT_RESULT_FIELDS,
+                projects.order_by('id').values_list(*PROJECT_RESULT_FIELDS),
+            ),
+            'subjects': columns(
+                SUBJECT_RESULT_FIELDS,
+                subjects.order_by('id').values_list(*SUBJECT_RESULT_FIELDS),
+            ),
+            'samples': sample_columns,
+        }
+        results = {'query_results': self.query_results, 'query_stats': self.query_stats}
+        if self.page_size:
+            results['page'] = page_info
+        return results
+
+    def _analyze_query_results(self, projects, subjects, samples):
         '''
         Analyze the query results to count the number of samples per project,
         based on these parameters:
         -   How many samples from each project
         -   How many subjects were responders/non-responders 
         -   How many subjects were males/females
+        The counts are computed by the database in one grouped query
+        (see stats.query_stats), so no subject rows are loaded for them.
+        With group_by, 'populations' also holds the mean and median relative
+        frequency of each population per value of that subject field.
         '''
-        samples_per_project = defaultdict(int)
-        responders = 0
-        non_responders = 0
-        males = 0
-        females = 0
-
-        for subject in self.query_results['subjects']:
-            if subject['response'] is True:
-                responders += 1
-            elif subject['response'] is False:
-                non_responders += 1
-            if subject['sex'].lower().startswith('m'):
-                males += 1
-            elif subject['sex'].lower().startswith('f'):
-                females += 1
-            
-
-        for project in self.query_results['projects']:
-            samples_per_project[project['project_name']] += 1
-        
-        self.query_stats = {
-            'responders': responders,
-            'non_responders': non_responders,
-            'males': males,
-            'females': females,
-            'samples_per_project': samples_per_project
-        }
+        self.query_stats = query_stats(
+            projects, self.subject_query_params, self.sample_query_params
+        )
+        if self.group_by:
+            subjects = subjects.filter(project__in=projects.values('id'))
+            self.query_stats['populations'] = population_stats(
+                samples.filter(subject__in=subjects.values('id')), self.group_by
+            )
 
 
-def query_results(request):
+def _query_data(request, scientist, **kwargs):
+    '''
+    A QueryData for the filters in the query parameters of a request.
+    '''
+    return QueryData(
+        project = request.GET.get('project'),
+        condition = request.GET.get('condition'),
+        sex = request.GET.get('sex'),
+        treatment = request.GET.get('treatment'),
+        sample_type = request.GET.get('sample_type'),
+        age_operator = request.GET.get('age_operator'),
+        age = request.GET.get('age'),
+        time_from_treatment_start = request.GET.get('time_from_treatment_start'),
+        time_operator = request.GET.get('time_operator'),
+        scientist=scientist,
+        **kwargs,
+    )
+
+
+@query_budget(READ_QUERY_BUDGET)
+async def query_results(request):
     if request.method == 'GET':
-        scientist, _ = Scientist.objects.get_or_create(
+        scientist, _ = await Scientist.objects.aget_or_create(
                 name='Bob Loblaw',
                 email='b@company.com',
                 company='Loblaw Bio',
         )
-        
-        query_data = QueryData(
-            project = request.GET.get('project'),
-            condition = request.GET.get('condition'),
-            sex = request.GET.get('sex'),
-            treatment = request.GET.get('treatment'),
-            sample_type = request.GET.get('sample_type'),
-            age_operator = request.GET.get('age_operator'),
-            age = request.GET.get('age'),
-            time_from_treatment_start = request.GET.get('time_from_treatment_start'),
-            time_operator = request.GET.get('time_operator'),
-            scientist=scientist
+        try:
+            page = _page_params(request)
+            layout = _layout(request)
+        except ValueError as e:
+            return JsonResponse({'status': 'error', 'message': str(e)}, status=400)
+        cursor, page_size = page or (None, None)
+        group_by = request.GET.get('group_by') or None
+        if group_by is not None and group_by not in GROUP_BY_FIELDS:
+            return JsonResponse(
+                {
+                    'status': 'error',
+                    'message': f'group_by must be one of {", ".join(GROUP_BY_FIELDS)}',
+                },
+                status=400,
             )
-        
-        results = query_data.retrieve_query_results()
+        stats_only = request.GET.get('stats_only', '').lower() in ('true', '1', 'yes')
+
+        query_data = _query_data(
+            request,
+            scientist,
+            cursor=cursor,
+            page_size=page_size,
+            stats_only=stats_only,
+            group_by=group_by,
+            layout=layout,
+        )
+
+        # Results are cached per normalized filter set and per data version
+        # of the matching projects, so switching back to a previous filter is
+        # served from the cache until an import touches one of those projects.
+        projects, _, _ = query_data.build_querysets()
+        state = await aprojects_state(request, projects)
+        key = 'query:{}:{}:{}'.format(
+            scientist.id,
+            digest(query_data.filter_key()),
+            state[0] if state else 'none',
+        )
+        if page is not None:
+            key += ':page:{}:{}'.format(*page)
+        if stats_only:
+            key += ':stats'
+        if group_by:
+            key += f':group:{group_by}'
+        if layout == 'columns' and not stats_only:
+            key += ':columns'
+        return await _ajson_response(
+            request, key, lambda: {'results': query_data.retrieve_query_results()}
+        )
+            
+
+@query_budget(READ_QUERY_BUDGET)
+def query_export(request):
+    '''
+    Streams one row per sample and population matching the query_results
+    filters, as NDJSON (the default) or, with ?format=, as CSV, Parquet or
+    an Arrow IPC stream.
+    Rows are read through a server-side cursor and encoded in batches as
+    the response is sent, so memory use does not grow with the export size.
+    '''
+    export_format = request.GET.get('format', 'ndjson')
+    if export_format not in EXPORT_CONTENT_TYPES:
+        return JsonResponse(
+            {
+                'status': 'error',
+                'message': f'Unsupported format, use one of {", ".join(EXPORT_CONTENT_TYPES)}',
+            },
+            status=400,
+        )
+
+    scientist = Scientist.objects.filter(name='Bob Loblaw').first()
+    projects, subjects, samples = _query_data(request, scientist).build_querysets()
+    samples = samples.filter(
+        subject__in=subjects.filter(project__in=projects.values('id')).values('id')
+    )
+
+    chunks = encode_rows(export_format, EXPORT_FIELDS, export_rows(samples))
+    if isinstance(request, ASGIRequest):
+        chunks = aiterate(chunks)
+    response = StreamingHttpResponse(
+        chunks, content_type=EXPORT_CONTENT_TYPES[export_format]
+    )
+    response['Content-Disposition'] = f'attachment; filename="results.{export_format}"'
+    return response
+
 
+@query_budget(READ_QUERY_BUDGET)
+def cohort_view(request):
+    '''
+    Returns cohort summaries: the number of samples and subjects and the mean
+    relative frequency of each population, for the samples matching the
+    query_results filters, per combination of the comma separated group_by
+    fields (see cohorts.COHORT_GROUP_FIELDS), e.g.
+    ?condition=melanoma&sample_type=PBMC&time_from_treatment_start=0&group_by=project,response,sex
+    Read from the cohort columns of SampleSummary in one indexed query, and
+    cached per filter set and data version of the matching projects.
+    '''
+    group_by = [name for name in request.GET.get('group_by', '').split(',') if name]
+    invalid = [name for name in group_by if name not in COHORT_GROUP_FIELDS]
+    if invalid:
         return JsonResponse(
-            {'results': results}, status=200
+            {
+                'status': 'error',
+                'message': f'group_by must be among {", ".join(COHORT_GROUP_FIELDS)}',
+            },
+            status=400,
         )
-            
\ No newline at end of file
+
+    scientist = Scientist.objects.filter(name='Bob Loblaw').first()
+    query_data = _query_data(request, scientist)
+    projects, _, _ = query_data.build_querysets()
+    state = projects_state(request, projects)
+    key = 'cohorts:{}:{}:{}'.format(
+        digest(query_data.filter_key()),
+        ','.join(group_by),
+        state[0] if state else 'none',
+    )
+
+    def build():
+        summaries = cohort_summaries(
+            projects, query_data.subject_query_params, query_data.sample_query_params
+        )
+        groups = cohort_groups(summaries, group_by)
+        return {
+            'status': 'success',
+            'group_by': group_by,
+            'samples': sum(group['samples'] for group in groups),
+            'groups': groups,
+        }
+
+    return _json_response(request, key, build)
@@ -1,4 +1,4 @@
 #!/bin/bash
 python manage.py migrate --noinput
 python manage.py collectstatic --noinput
-exec gunicorn program.wsgi:application --bind 0.0.0.0:8000
\ No newline at end of file
+exec gunicorn program.asgi:application --worker-class uvicorn_worker.UvicornWorker --bind 0.0.0.0:8000
\ No newline at end of file
@@ -2,5 +2,8 @@ from django.core.asgi import get_asgi_application
 import os
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'program.settings')
+# Each request runs its queries in a thread of its own, which persistent
+# connections would outlive: they are pooled by PgBouncer instead.
+os.environ.setdefault('DATABASE_CONN_MAX_AGE', '0')
 
 application = get_asgi_application()
\ No newline at end of file
@@ -0,0 +1,294 @@
+import bisect
+import contextvars
+import logging
+import threading
+import time
+import tracemalloc
+from dataclasses import dataclass, field
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+logger = logging.getLogger(__name__)
+
+# Logged slow queries are cut to this many characters, as bulk inserts run long.
+MAX_LOGGED_SQL = 1000
+
+# Upper bounds of the histogram buckets of each per-view metric.
+HISTOGRAMS = {
+    'http_request_duration_seconds': (
+        'Wall time of the requests of a view.',
+        [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30],
+    ),
+    'http_request_db_queries': (
+        'Database queries run by the requests of a view.',
+        [0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000],
+    ),
+    'http_request_db_duration_seconds': (
+        'Time spent in database queries by the requests of a view.',
+        [0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    ),
+    'http_response_size_bytes': (
+        'Size of the response bodies of a view.',
+        [1e2, 1e3, 1e4, 1e5, 1e6, 1e7, 1e8, 1e9],
+    ),
+    'http_request_allocated_bytes': (
+        'Peak Python memory allocated while handling the requests of a view '
+        '(with METRICS_TRACK_MEMORY).',
+        [1e4, 1e5, 1e6, 1e7, 1e8, 1e9],
+    ),
+}
+
+
+class QueryBudgetExceeded(Exception):
+    '''
+    Raised when a request runs more queries than its view's budget
+    and QUERY_BUDGET_ACTION is 'raise'.
+    '''
+
+
+def query_budget(queries):
+    '''
+    Decorator setting the maximum number of queries a view may run per
+    request, instead of the QUERY_BUDGET default.
+    '''
+    def decorator(view):
+        view.query_budget = queries
+        return view
+
+    return decorator
+
+
+@dataclass
+class RequestStats:
+    '''
+    What the queries of a single request add up to.
+    '''
+
+    queries: int = 0
+    db_seconds: float = 0.0
+    # (seconds, sql) of the slowest queries, when METRICS_LOG_SLOWEST_SQL is set.
+    slowest: list = field(default_factory=list)
+
+
+_current = contextvars.ContextVar('request_stats', default=None)
+
+
+def _record_query(execute, sql, params, many, context):
+    '''
+    Database execute wrapper adding each query to the stats of the request
+    being handled, if any.
+    '''
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = time.perf_counter() - start
+        stats.queries += 1
+        stats.db_seconds += elapsed
+        keep = settings.METRICS_LOG_SLOWEST_SQL
+        if keep:
+            bisect.insort(stats.slowest, (-elapsed, sql))
+            del stats.slowest[keep:]
+
+
+class Registry:
+    '''
+    The per-view histograms and request counters of this process, in the
+    Prometheus data model: buckets are cumulative and never reset, so rolling
+    windows come from rate() or increase() over a range when querying.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # (metric, view) -> [bucket counts..., +Inf count, sum]
+        self.histograms = {}
+        # (view, method, status) -> count
+        self.requests = {}
+
+    def observe(self, metric, view, value):
+        bounds = HISTOGRAMS[metric][1]
+        with self.lock:
+            values = self.histograms.setdefault((metric, view), [0] * (len(bounds) + 2))
+            values[bisect.bisect_left(bounds, value)] += 1
+            values[-1] += value
+
+    def count_request(self, view, method, status):
+        with self.lock:
+            key = (view, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+
+    def render(self):
+        '''
+        The metrics in the Prometheus text exposition format.
+        '''
+        with self.lock:
+            histograms = {key: list(values) for key, values in self.histograms.items()}
+            requests = dict(self.requests)
+
+        lines = [
+            '# HELP http_requests_total Requests handled, by view, method and status.',
+            '# TYPE http_requests_total counter',
+        ]
+        for (view, method, status), count in sorted(requests.items()):
+            lines.append(
+                f'http_requests_total{{view="{view}",method="{method}",status="{status}"}} {count}'
+            )
+
+        for metric, (description, bounds) in HISTOGRAMS.items():
+            lines += [f'# HELP {metric} {description}', f'# TYPE {metric} histogram']
+            for (name, view), values in sorted(histograms.items()):
+                if name != metric:
+                    continue
+                cumulative = 0
+                for bound, count in zip([*bounds, '+Inf'], values):
+                    cumulative += count
+                    lines.append(f'{metric}_bucket{{view="{view}",le="{bound}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{view="{view}"}} {values[-1]}')
+                lines.append(f'{metric}_count{{view="{view}"}} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+
+@receiver(connection_created)
+def _install_query_recorder(sender, connection, **kwargs):
+    '''
+    Record the queries of every new database connection, including those of
+    the threads the async ORM runs queries in under ASGI.
+    '''
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+
+class MetricsMiddleware:
+    '''
+    Records, per view, the wall time, number of database queries, time spent
+    in the database, response size and (with METRICS_TRACK_MEMORY) the peak
+    Python memory allocated of every request, exposed by the /metrics view.
+
+    With METRICS_LOG_SLOWEST_SQL set to N, the N slowest queries of each
+    request are logged. A request running more queries than QUERY_BUDGET
+    (or its view's @query_budget) is logged, or fails with QueryBudgetExceeded
+    when QUERY_BUDGET_ACTION is 'raise', e.g. in tests.
+
+    Streamed responses are measured until their last chunk has been sent.
+    Metrics are kept per process, so each worker process reports its own.
+    Works under WSGI and ASGI, where memory is shared by concurrent requests.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+        if settings.METRICS_TRACK_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        # Connections opened before this module was imported.
+        for connection in connections.all():
+            _install_query_recorder(None, connection)
+
+        stats, start, memory_start = self._start()
+        token = _current.set(stats)
+        try:
+            response = self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._measure(request, response, stats, start, memory_start)
+
+    async def __acall__(self, request):
+        stats, start, memory_start = self._start()
+        token = _current.set(stats)
+        try:
+            response = await self.get_response(request)
+        finally:
+            _current.reset(token)
+        return self._measure(request, response, stats, start, memory_start)
+
+    def _start(self):
+        memory_start = None
+        if settings.METRICS_TRACK_MEMORY:
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+        return RequestStats(), time.perf_counter(), memory_start
+
+    def _measure(self, request, response, stats, start, memory_start):
+        if not response.streaming:
+            self._finish(request, response, stats, start, memory_start, len(response.content))
+        elif response.is_async:
+            response.streaming_content = self._ameasure_stream(
+                request, response, response.streaming_content, stats, start, memory_start
+            )
+        else:
+            response.streaming_content = self._measure_stream(
+                request, response, response.streaming_content, stats, start, memory_start
+            )
+        return response
+
+    def _measure_stream(self, request, response, chunks, stats, start, memory_start):
+        # The chunks may be produced in another context (e.g. a thread of the
+        # ASGI handler), so the stats are set around each one rather than reset.
+        size = 0
+        try:
+            _current.set(stats)
+            for chunk in chunks:
+                size += len(chunk)
+                _current.set(None)
+                yield chunk
+                _current.set(stats)
+        finally:
+            _current.set(None)
+            self._finish(request, response, stats, start, memory_start, size)
+
+    async def _ameasure_stream(self, request, response, chunks, stats, start, memory_start):
+        size = 0
+        try:
+            _current.set(stats)
+            async for chunk in chunks:
+                size += len(chunk)
+                _current.set(None)
+                yield chunk
+                _current.set(stats)
+        finally:
+            _current.set(None)
+            self._finish(request, response, stats, start, memory_start, size)
+
+    def _finish(self, request, response, stats, start, memory_start, size):
+        elapsed = time.perf_counter() - start
+        match = request.resolver_match
+        view = match.view_name if match else 'unmatched'
+
+        registry.count_request(view, request.method, response.status_code)
+        registry.observe('http_request_duration_seconds', view, elapsed)
+        registry.observe('http_request_db_queries', view, stats.queries)
+        registry.observe('http_request_db_duration_seconds', view, stats.db_seconds)
+        registry.observe('http_response_size_bytes', view, size)
+        if memory_start is not None:
+            allocated = tracemalloc.get_traced_memory()[1] - memory_start
+            registry.observe('http_request_allocated_bytes', view, max(allocated, 0))
+
+        for seconds, sql in stats.slowest:
+            logger.info(
+                'Slow query in %s (%.1f ms): %s', view, -seconds * 1000, sql[:MAX_LOGGED_SQL]
+            )
+
+        budget = getattr(match.func, 'query_budget', None) if match else None
+        budget = budget or settings.QUERY_BUDGET
+        if budget and stats.queries > budget:
+            message = f'{view} ran {stats.queries} queries, over its budget of {budget}'
+            if settings.QUERY_BUDGET_ACTION == 'raise':
+                raise QueryBudgetExceeded(message)
+            logger.warning(message)
@@ -0,0 +1,158 @@
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from pathlib import Path
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = 'profile'
+
+
+class StackSampler:
+    '''
+    Samples the Python stack of one thread (or with thread_id None, of every
+    other thread, under its thread name) every interval seconds from a
+    background thread, counting how often each stack is seen.
+    '''
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            if self.thread_id is not None:
+                frame = frames.get(self.thread_id)
+                if frame is not None:
+                    self.stacks[self._stack(frame)] += 1
+                continue
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for thread_id, frame in frames.items():
+                if thread_id != threading.get_ident():
+                    thread = names.get(thread_id, str(thread_id)).replace(' ', '_')
+                    self.stacks[(f'thread:{thread}', *self._stack(frame))] += 1
+
+    def _stack(self, frame):
+        stack = []
+        while frame is not None:
+            module = frame.f_globals.get('__name__', '?')
+            stack.append(f'{module}:{frame.f_code.co_name}')
+            frame = frame.f_back
+        return tuple(reversed(stack))
+
+    def collapsed(self):
+        '''
+        The samples in the collapsed stack format ('root;...;leaf count' lines)
+        read by flamegraph.pl and speedscope.
+        '''
+        return ''.join(
+            f'{";".join(stack)} {count}\n' for stack, count in self.stacks.most_common()
+        )
+
+
+def evict_profiles(directory, max_bytes):
+    '''
+    Delete the oldest profiles in directory until the rest fit in max_bytes,
+    always keeping the newest one.
+    '''
+    profiles = []
+    for path in Path(directory).glob('*.collapsed'):
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        profiles.append((stat.st_mtime, stat.st_size, path))
+    profiles.sort()
+
+    total = sum(size for _, size, _ in profiles)
+    for _, size, path in profiles[:-1]:
+        if total <= max_bytes:
+            break
+        # Another process may have evicted it already.
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+class ProfilingMiddleware:
+    '''
+    Sample-profiles the requests of staff users that ask for it with an
+    X-Profile: 1 header or a ?profile=1 query parameter, and saves each
+    profile as collapsed stacks in PROFILING_DIR, evicting the oldest
+    profiles beyond PROFILING_MAX_BYTES. The profile file name is returned
+    in the X-Profile header.
+
+    Under WSGI, only the thread handling the request is sampled: background
+    imports and parse worker processes are not, so profile imports with
+    IMPORT_ASYNC off. Under ASGI, the request runs both on the event loop and
+    in threads, so every thread is sampled, concurrent requests included.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not (self._flagged(request) and request.user.is_staff):
+            return self.get_response(request)
+
+        sampler = StackSampler(threading.get_ident(), settings.PROFILING_INTERVAL)
+        sampler.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            sampler.stop()
+
+        response['X-Profile'] = self._save(request, sampler)
+        return response
+
+    async def __acall__(self, request):
+        if not (self._flagged(request) and (await request.auser()).is_staff):
+            return await self.get_response(request)
+
+        sampler = StackSampler(None, settings.PROFILING_INTERVAL)
+        sampler.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            sampler.stop()
+
+        response['X-Profile'] = self._save(request, sampler)
+        return response
+
+    def _flagged(self, request):
+        flag = request.META.get(PROFILE_HEADER) or request.GET.get(PROFILE_PARAM)
+        return flag in ('1', 'true', 'yes')
+
+    def _save(self, request, sampler):
+        match = request.resolver_match
+        view = re.sub(r'[^\w.-]', '_', match.view_name if match else 'unmatched')
+        name = f'{time.strftime("%Y%m%d-%H%M%S")}-{view}-{uuid.uuid4().hex[:8]}.collapsed'
+
+        os.makedirs(settings.PROFILING_DIR, exist_ok=True)
+        with open(Path(settings.PROFILING_DIR) / name, 'w') as file:
+            file.write(sampler.collapsed())
+        evict_profiles(settings.PROFILING_DIR, settings.PROFILING_MAX_BYTES)
+        return name
@@ -46,7 +46,8 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
-    
+    'program.metrics.MetricsMiddleware',
+    'program.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'program.urls'
@@ -89,9 +90,129 @@ DATABASES = {
          'PASSWORD': os.getenv('DATABASE_PASSWORD', 'dbpassword'),
          'HOST': os.getenv('DATABASE_HOST', 'db'),
          'PORT': os.getenv('DATABASE_PORT', 5432),
+         # Connections are kept open for DATABASE_CONN_MAX_AGE seconds and
+         # reused by the following requests of the same thread, after checking
+         # they still work. program/asgi.py defaults it to 0: under ASGI each
+         # request runs its queries in a thread of its own, so connections are
+         # pooled by PgBouncer instead (see docker-compose.yml).
+         'CONN_MAX_AGE': int(os.getenv('DATABASE_CONN_MAX_AGE', 60)),
+         'CONN_HEALTH_CHECKS': True,
      }
  }
 
+# Number of CSV rows read and persisted at a time by the importer.
+# Bounds the memory used by an import, whatever the size of the uploaded file.
+IMPORT_CHUNK_SIZE = int(os.getenv('IMPORT_CHUNK_SIZE', 50000))
+
+# 'upsert' imports are idempotent: a file that was imported before is skipped,
+# and existing projects, subjects and samples are reused so only new rows are
+# added. 'append' always creates new projects, as each upload did originally.
+# Can be overridden per upload with the 'mode' form field.
+IMPORT_MODE = os.getenv('IMPORT_MODE', 'upsert')
+
+# How cell counts are stored: 'rows' keeps one Cell row per sample and
+# population (plus the SampleSummary per sample), 'wide' only keeps the
+# SampleSummary, with a column per population. Existing data is moved between
+# the two with `python manage.py migrate_cell_storage`.
+CELL_STORAGE = os.getenv('CELL_STORAGE', 'rows')
+
+# Files of at least IMPORT_PARALLEL_MIN_BYTES are split into shards of about
+# IMPORT_SHARD_BYTES and parsed by a pool of IMPORT_PARSE_WORKERS processes.
+IMPORT_PARSE_WORKERS = int(os.getenv('IMPORT_PARSE_WORKERS', os.cpu_count() or 1))
+IMPORT_PARALLEL_MIN_BYTES = int(os.getenv('IMPORT_PARALLEL_MIN_BYTES', 64 * 1024 * 1024))
+IMPORT_SHARD_BYTES = int(os.getenv('IMPORT_SHARD_BYTES', 16 * 1024 * 1024))
+
+# Run imports as background jobs instead of inside the upload request.
+# IMPORT_JOB_RUNNER is either 'process' (a local process pool of
+# IMPORT_JOB_WORKERS processes) or 'queue' (jobs wait in the ImportJob table
+# until a `python manage.py run_import_worker` process picks them up).
+IMPORT_ASYNC = os.getenv('IMPORT_ASYNC', 'true').lower() in ('true', '1', 'yes')
+IMPORT_JOB_RUNNER = os.getenv('IMPORT_JOB_RUNNER', 'process')
+IMPORT_JOB_WORKERS = int(os.getenv('IMPORT_JOB_WORKERS', 2))
+
+# Running jobs without progress for IMPORT_JOB_STALE_SECONDS were lost by a
+# restart of their worker, and are marked failed (see jobs.recover_import_jobs).
+IMPORT_JOB_STALE_SECONDS = int(os.getenv('IMPORT_JOB_STALE_SECONDS', 600))
+
+# Cache for the results endpoints, entries are keyed by project data version
+# so an import never serves stale data. CACHE_BACKEND is one of:
+# - 'memory': per-process, least recently used entries are evicted beyond
+#   CACHE_MAX_ENTRIES.
+# - 'file': shared by the processes of a host, culled beyond CACHE_MAX_ENTRIES.
+# - 'redis': shared, needs the redis package; bound it with Redis' own
+#   maxmemory and an allkeys-lru maxmemory-policy.
+CACHE_BACKENDS = {
+    'memory': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+    'redis': 'django.core.cache.backends.redis.RedisCache',
+}
+CACHE_BACKEND = os.getenv('CACHE_BACKEND', 'memory')
+CACHE_LOCATIONS = {
+    'memory': 'cytometry',
+    'file': str(BASE_DIR / 'cache'),
+    'redis': 'redis://127.0.0.1:6379',
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS[CACHE_BACKEND],
+        'LOCATION': os.getenv('CACHE_LOCATION', CACHE_LOCATIONS[CACHE_BACKEND]),
+        'TIMEOUT': int(os.getenv('CACHE_TIMEOUT', 24 * 60 * 60)),
+    }
+}
+if CACHE_BACKEND != 'redis':
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 500)),
+    }
+# Response bodies larger than CACHE_MAX_BODY_BYTES are served without being
+# cached, so the memory and file caches hold at most CACHE_MAX_ENTRIES times
+# this many bytes (500 MB by default) rather than an unbounded amount.
+CACHE_MAX_BODY_BYTES = int(os.getenv('CACHE_MAX_BODY_BYTES', 1024 * 1024))
+
+# Page sizes of the results endpoints, when a client asks for pages with the
+# page_size or cursor query parameters.
+RESULTS_PAGE_SIZE = int(os.getenv('RESULTS_PAGE_SIZE', 1000))
+RESULTS_MAX_PAGE_SIZE = int(os.getenv('RESULTS_MAX_PAGE_SIZE', 10000))
+
+# Histogram and time series bins of the chart data endpoint (the bins query
+# parameter, up to CHART_MAX_BINS) and the outliers returned per box plot.
+CHART_BINS = int(os.getenv('CHART_BINS', 20))
+CHART_MAX_BINS = int(os.getenv('CHART_MAX_BINS', 100))
+CHART_MAX_OUTLIERS = int(os.getenv('CHART_MAX_OUTLIERS', 20))
+
+# JSON results of at least RESPONSE_COMPRESSION_MIN_BYTES are sent compressed
+# (brotli if installed, else gzip) to clients that accept it, and cached so.
+RESPONSE_COMPRESSION = os.getenv('RESPONSE_COMPRESSION', 'true').lower() in ('true', '1', 'yes')
+RESPONSE_COMPRESSION_MIN_BYTES = int(os.getenv('RESPONSE_COMPRESSION_MIN_BYTES', 1024))
+
+# Per-view request metrics, served at /metrics (see program/metrics.py).
+# METRICS_TRACK_MEMORY traces Python allocations, which slows requests down.
+# METRICS_LOG_SLOWEST_SQL logs the N slowest queries of each request.
+METRICS_TRACK_MEMORY = os.getenv('METRICS_TRACK_MEMORY', 'false').lower() in ('true', '1', 'yes')
+METRICS_LOG_SLOWEST_SQL = int(os.getenv('METRICS_LOG_SLOWEST_SQL', 0))
+
+# Maximum number of queries per request of views without their own
+# @query_budget (0 for none). Going over it is logged, or raises
+# QueryBudgetExceeded with QUERY_BUDGET_ACTION 'raise', failing tests.
+QUERY_BUDGET = int(os.getenv('QUERY_BUDGET', 0))
+QUERY_BUDGET_ACTION = os.getenv('QUERY_BUDGET_ACTION', 'log')
+
+# Staff requests with an X-Profile: 1 header or ?profile=1 are sampled every
+# PROFILING_INTERVAL seconds, and their profiles saved to PROFILING_DIR, the
+# oldest evicted beyond PROFILING_MAX_BYTES (see program/profiling.py).
+PROFILING_DIR = os.getenv('PROFILING_DIR', BASE_DIR / 'profiles')
+PROFILING_MAX_BYTES = int(os.getenv('PROFILING_MAX_BYTES', 100 * 1024 * 1024))
+PROFILING_INTERVAL = float(os.getenv('PROFILING_INTERVAL', 0.005))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {'console': {'class': 'logging.StreamHandler'}},
+    'loggers': {
+        'program.metrics': {'handlers': ['console'], 'level': 'INFO'},
+    },
+}
+
 # Password validation
 # https://docs.djangoproject.com/en/4.x/ref/settings/#auth-password-validators
 
@@ -128,6 +249,9 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Uploaded files, e.g. CSV files waiting to be imported by a background job.
+MEDIA_ROOT = os.getenv('MEDIA_ROOT', BASE_DIR / 'media')
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.x/ref/settings/#default-auto-field
 
@@ -8,4 +8,5 @@ urlpatterns = [
     path('admin/', admin.site.urls),
     path('csrf/', views.csrf),
     path('ping/', views.ping),
+    path('metrics', views.metrics),
 ]
\ No newline at end of file
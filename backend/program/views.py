@@ -1,8 +1,12 @@
-from django.http import JsonResponse
+from django.http import HttpResponse, JsonResponse
 from django.middleware.csrf import get_token
+from program.metrics import registry
 
 def csrf(request):
     return JsonResponse({'csrfToken': get_token(request)})
 
 def ping(request):
     return JsonResponse({'result': 'OK'})
+
+def metrics(request):
+    return HttpResponse(registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -20,10 +20,40 @@ const VisuallyHiddenInput = styled("input")({
   width: 1,
 });
 
+// Seconds between two polls of a background import job.
+const POLL_INTERVAL = 2;
+
+const sleep = (seconds) =>
+  new Promise((resolve) => setTimeout(resolve, seconds * 1000));
+
 export default function Import() {
   const csrfToken = useCsrfToken();
   const [file, setFile] = React.useState(null);
   const [loading, setLoading] = React.useState(false);
+  // The background import job of the upload (IMPORT_ASYNC), while it runs.
+  const [job, setJob] = React.useState(null);
+  const mounted = React.useRef(true);
+
+  React.useEffect(() => {
+    mounted.current = true;
+    return () => {
+      mounted.current = false;
+    };
+  }, []);
+
+  // Poll /api/import/<job_id> until the job has succeeded or failed.
+  const waitForJob = async (jobId) => {
+    while (mounted.current) {
+      const response = await axios.get(`/api/import/${jobId}`);
+      const current = response.data.job;
+      setJob(current);
+      if (current.status === "succeeded" || current.status === "failed") {
+        return current;
+      }
+      await sleep(POLL_INTERVAL);
+    }
+    return null;
+  };
 
   const handleFileChange = (event) => {
     setFile(event.target.files[0]);
@@ -51,15 +81,33 @@ export default function Import() {
           withCredentials: true,
         }
       );
+      if (response.status === 202) {
+        // Queued as a background job: follow its progress.
+        setJob({ id: response.data.job_id, status: "queued", rows_processed: 0 });
+        const finished = await waitForJob(response.data.job_id);
+        if (!finished) {
+          return;
+        }
+        if (finished.status === "failed") {
+          const last = finished.errors[finished.errors.length - 1];
+          alert("Import failed: " + (last ? last.reason : "unknown error"));
+          return;
+        }
+      }
       alert("File uploaded successfully!");
     } catch (error) {
       alert(
         "Error uploading file: " +
-          (error.response ? error.response.data : error.message)
+          (error.response && error.response.data.message
+            ? error.response.data.message
+            : error.message)
       );
     } finally {
-      setLoading(false);
-      setFile(null);
+      if (mounted.current) {
+        setLoading(false);
+        setFile(null);
+        setJob(null);
+      }
     }
   };
 
@@ -81,7 +129,7 @@ export default function Import() {
             Upload files
             <VisuallyHiddenInput
               type="file"
-              accept=".csv"
+              accept=".csv,.parquet,.arrow,.feather"
               onChange={handleFileChange}
             />
           </Button>
@@ -111,6 +159,16 @@ export default function Import() {
             {loading ? <CircularProgress size={24} color="inherit" /> : "Submit"}
           </Button>
         </div>
+        {job && (
+          <Typography
+            variant="body2"
+            style={{ marginTop: "10px", textAlign: "center" }}
+          >
+            {job.status === "queued"
+              ? "Import queued, waiting for a worker..."
+              : `Importing: ${job.rows_processed} rows processed`}
+          </Typography>
+        )}
       </form>
     </Container>
   );